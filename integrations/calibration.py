@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - Device Calibration
+Measures what this host actually does per denoising step instead of trusting
+constants tuned for one machine: a short synthetic SD 1.5-sized UNet workload
+is timed at each resolution bucket, attention and VAE slicing settings are
+compared, and the winning combination is persisted to a JSON profile used for
+step defaults, size caps and ETAs.
+"""
+
+import json
+import os
+import platform
+import threading
+import time
+import logging
+from datetime import datetime
+from pathlib import Path
+
+import psutil
+import torch
+
+from graph_compile import compile_module, uncompile_module
+
+logger = logging.getLogger(__name__)
+
+RESOLUTION_BUCKETS = (256, 384, 512, 640, 768)
+REFERENCE_BUCKET = 512
+ATTENTION_MODES = ("sdpa", "sliced")
+PROFILE_VERSION = 1
+
+# SD 1.5 UNet / VAE layouts; random weights cost exactly as much compute as real ones
+SD15_UNET_CONFIG = {
+    "sample_size": 64,
+    "cross_attention_dim": 768,
+    "attention_head_dim": 8
+}
+SD15_VAE_CONFIG = {
+    "block_out_channels": (128, 256, 512, 512),
+    "down_block_types": ("DownEncoderBlock2D",) * 4,
+    "up_block_types": ("UpDecoderBlock2D",) * 4,
+    "latent_channels": 4,
+    "layers_per_block": 2,
+    "sample_size": 512
+}
+
+
+def host_fingerprint(device):
+    """What a profile depends on; a mismatch means the profile is stale."""
+    return {
+        "device": str(device),
+        "cpu": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "ram_gb": round(psutil.virtual_memory().total / 1024 ** 3),
+        "torch": torch.__version__,
+        "cuda": torch.cuda.get_device_name(0) if str(device) == "cuda" and torch.cuda.is_available() else None
+    }
+
+
+def torch_device(device):
+    """Map the server's device name to something tensors can be moved to."""
+    if device == "dml":
+        import torch_directml
+        return torch_directml.device()
+    return torch.device(device)
+
+
+def _sync(device):
+    if str(device) == "cuda":
+        torch.cuda.synchronize()
+
+
+def set_attention_mode(unet, mode):
+    if mode == "sliced":
+        unet.set_attention_slice("auto")
+    else:
+        from diffusers.models.attention_processor import AttnProcessor2_0
+        unet.set_attn_processor(AttnProcessor2_0())
+
+
+def apply_pipeline_settings(pipe, profile):
+    """Apply the calibrated attention / VAE slicing choice to a loaded pipeline."""
+    if hasattr(pipe, "enable_attention_slicing"):
+        if profile["attention"] == "sliced":
+            pipe.enable_attention_slicing()
+        else:
+            pipe.disable_attention_slicing()
+    vae = getattr(pipe, "vae", None)
+    if vae is not None and hasattr(vae, "enable_slicing"):
+        if profile["vae_slicing"]:
+            vae.enable_slicing()
+        else:
+            vae.disable_slicing()
+
+
+def _time_unet(unet, size, device, dtype, steps, batch=2):
+    """Mean seconds per UNet call at `size` (batch 2 = one CFG step), after one warm-up call.
+
+    Returns (warm-up seconds, seconds per call); for a compiled UNet the warm-up is the compile.
+    """
+    latent = size // 8
+    sample = torch.randn(batch, unet.config.in_channels, latent, latent, device=device, dtype=dtype)
+    context = torch.randn(batch, 77, unet.config.cross_attention_dim, device=device, dtype=dtype)
+    timestep = torch.tensor(500, device=device)
+    with torch.inference_mode():
+        start = time.perf_counter()
+        unet(sample, timestep, encoder_hidden_states=context)
+        _sync(device)
+        warmup = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(steps):
+            unet(sample, timestep, encoder_hidden_states=context)
+        _sync(device)
+    return warmup, (time.perf_counter() - start) / steps
+
+
+def _time_vae(vae, size, device, dtype, sliced, batch=2):
+    latents = torch.randn(batch, vae.config.latent_channels, size // 8, size // 8, device=device, dtype=dtype)
+    if sliced:
+        vae.enable_slicing()
+    else:
+        vae.disable_slicing()
+    with torch.inference_mode():
+        start = time.perf_counter()
+        vae.decode(latents)
+        _sync(device)
+    return time.perf_counter() - start
+
+
+def _is_oom(error):
+    return isinstance(error, (torch.cuda.OutOfMemoryError, MemoryError)) or "out of memory" in str(error).lower()
+
+
+def run_calibration(device, dtype, unet=None, vae=None, buckets=RESOLUTION_BUCKETS, steps=2, compile_mode="off"):
+    """Time the UNet per bucket and pick the fastest attention / VAE slicing settings.
+
+    `unet` / `vae` default to randomly initialised SD 1.5-sized modules; pass a
+    resident model's modules to skip building them. Their attention processors
+    and slicing state are restored afterwards. With a `compile_mode` every
+    bucket is timed again compiled, and the profile keeps both sets of numbers.
+    """
+    from diffusers import AutoencoderKL, UNet2DConditionModel
+
+    target = torch_device(device)
+    started = time.time()
+    synthetic = unet is None
+    if unet is None:
+        unet = UNet2DConditionModel(**SD15_UNET_CONFIG).to(target, dtype).eval()
+    if vae is None:
+        vae = AutoencoderKL(**SD15_VAE_CONFIG).to(target, dtype).eval()
+    saved_processors = unet.attn_processors
+    # A resident UNet may already be compiled for serving; time it eager first
+    serving_forward = unet.__dict__.pop("forward", None)
+    saved_vae_slicing = getattr(vae, "use_slicing", False)
+
+    reference = min(buckets, key=lambda b: abs(b - REFERENCE_BUCKET))
+    attention_timings = {}
+    try:
+        for mode in ATTENTION_MODES:
+            set_attention_mode(unet, mode)
+            try:
+                attention_timings[mode] = round(_time_unet(unet, reference, target, dtype, steps)[1], 4)
+            except RuntimeError as e:
+                if not _is_oom(e):
+                    raise
+                logger.warning(f"⚠️ Calibration: {mode} attention ran out of memory at {reference}px")
+        if not attention_timings:
+            raise RuntimeError(f"Calibration could not run a single UNet step at {reference}px")
+        attention = min(attention_timings, key=attention_timings.get)
+        set_attention_mode(unet, attention)
+
+        seconds_per_step = {}
+        for size in buckets:
+            if size == reference:
+                seconds_per_step[str(size)] = attention_timings[attention]
+                continue
+            try:
+                seconds_per_step[str(size)] = round(_time_unet(unet, size, target, dtype, steps)[1], 4)
+            except RuntimeError as e:
+                if not _is_oom(e):
+                    raise
+                logger.warning(f"⚠️ Calibration: {size}px does not fit on {device}; capping below it")
+                break
+
+        vae_timings = {}
+        for sliced in (False, True):
+            try:
+                vae_timings["sliced" if sliced else "full"] = round(_time_vae(vae, reference, target, dtype, sliced), 4)
+            except RuntimeError as e:
+                if not _is_oom(e):
+                    raise
+        vae_slicing = vae_timings.get("sliced", 0) <= vae_timings.get("full", float("inf"))
+
+        compiled = {}
+        if compile_mode != "off":
+            compile_module(unet, compile_mode)
+            for size in seconds_per_step:
+                compiled[size] = _time_unet(unet, int(size), target, dtype, steps)
+                logger.info(
+                    f"📏 {size}px compiled: {compiled[size][1]:.3f}s/step vs {seconds_per_step[size]:.3f}s eager "
+                    f"(compile {compiled[size][0]:.0f}s)"
+                )
+    finally:
+        uncompile_module(unet)
+        if serving_forward is not None:
+            unet.forward = serving_forward
+        unet.set_attn_processor(saved_processors)
+        if hasattr(vae, "enable_slicing"):
+            vae.enable_slicing() if saved_vae_slicing else vae.disable_slicing()
+        if synthetic:
+            del unet, vae
+            if str(device) == "cuda":
+                torch.cuda.empty_cache()
+
+    profile = {
+        "version": PROFILE_VERSION,
+        "host": host_fingerprint(device),
+        "dtype": str(dtype).replace("torch.", ""),
+        "workload": "synthetic-sd15" if synthetic else "resident-model",
+        "compile_mode": compile_mode,
+        "attention": attention,
+        "vae_slicing": vae_slicing,
+        "reference_size": reference,
+        "seconds_per_step": seconds_per_step,
+        "vae_decode_seconds": vae_timings.get("sliced" if vae_slicing else "full"),
+        "candidates": {"attention": attention_timings, "vae": vae_timings},
+        "calibration_time": round(time.time() - started, 2),
+        "created": datetime.now().isoformat()
+    }
+    if compiled:
+        # Estimates should reflect how requests are actually served
+        profile["eager_seconds_per_step"] = seconds_per_step
+        profile["seconds_per_step"] = {size: round(t[1], 4) for size, t in compiled.items()}
+        profile["compile_seconds"] = {size: round(t[0], 2) for size, t in compiled.items()}
+        profile["compile_speedup"] = {
+            size: round(seconds_per_step[size] / t[1], 2) for size, t in compiled.items()
+        }
+    return profile
+
+
+class DeviceCalibrator:
+    """Owns the host profile: loads it, (re)calibrates in the background and answers tuning questions.
+
+    Until a profile exists every query returns the caller's fallback, so the
+    server behaves exactly as before while calibration is still running.
+    """
+
+    def __init__(self, profile_path, min_steps=8, max_steps=25, target_seconds=30.0, max_seconds=120.0,
+                 compile_mode="off"):
+        self.profile_path = Path(profile_path)
+        self.compile_mode = compile_mode
+        self.min_steps = min_steps
+        self.max_steps = max_steps
+        self.target_seconds = target_seconds
+        self.max_seconds = max_seconds
+        self.profile = None
+        self.state = "uncalibrated"
+        self.error = None
+        self._lock = threading.Lock()
+
+    def load(self, device, dtype=None):
+        """Load a saved profile if it was measured on this host with this device (and dtype)."""
+        try:
+            profile = json.loads(self.profile_path.read_text())
+        except (OSError, ValueError):
+            return False
+        if (
+            profile.get("version") != PROFILE_VERSION
+            or profile.get("host") != host_fingerprint(device)
+            or profile.get("compile_mode", "off") != self.compile_mode
+            or (dtype is not None and profile.get("dtype") != str(dtype).replace("torch.", ""))
+        ):
+            logger.info(f"📏 Calibration profile {self.profile_path} is stale for this host; ignoring it")
+            return False
+        self.profile = profile
+        self.state = "ready"
+        logger.info(f"📏 Loaded calibration profile: {self._summary()}")
+        return True
+
+    def adopt(self, profile):
+        """Use a profile measured by another process (a pool worker) without re-checking the host.
+
+        Pool workers run with fewer threads than the dispatcher, so their profile's
+        fingerprint never matches it, yet it is the one that describes how requests run.
+        """
+        self.profile = profile
+        self.state = "ready"
+        self.error = None
+        logger.info(f"📏 Using calibration profile: {self._summary()}")
+
+    def calibrate(self, device, dtype, unet=None, vae=None):
+        """Run calibration now (blocking) and persist the profile."""
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            self.state = "running"
+            self.error = None
+            logger.info(f"📏 Calibrating {device} ({dtype})...")
+            profile = run_calibration(device, dtype, unet=unet, vae=vae, compile_mode=self.compile_mode)
+            tmp_path = self.profile_path.with_name(f".{self.profile_path.name}.tmp")
+            tmp_path.write_text(json.dumps(profile, indent=2))
+            os.replace(tmp_path, self.profile_path)
+            self.profile = profile
+            self.state = "ready"
+            logger.info(f"✅ Calibration done in {profile['calibration_time']}s: {self._summary()}")
+            return True
+        except Exception as e:
+            self.error = str(e)
+            self.state = "ready" if self.profile else "failed"
+            logger.error(f"❌ Calibration failed: {e}")
+            return False
+        finally:
+            self._lock.release()
+
+    def calibrate_async(self, device, dtype, unet=None, vae=None):
+        if self.state == "running":
+            return False
+        self.state = "running"
+        threading.Thread(
+            target=self.calibrate, args=(device, dtype, unet, vae), daemon=True, name="calibration"
+        ).start()
+        return True
+
+    def _summary(self):
+        p = self.profile
+        ref = p["seconds_per_step"].get(str(p["reference_size"]))
+        summary = f"{p['attention']} attention, vae_slicing={p['vae_slicing']}, {ref}s/step @ {p['reference_size']}px"
+        speedup = p.get("compile_speedup", {}).get(str(p["reference_size"]))
+        return f"{summary}, compiled x{speedup}" if speedup else summary
+
+    def seconds_per_step(self, width, height):
+        """Interpolate measured s/step by pixel count (UNet cost is ~linear in latent area)."""
+        if not self.profile or not self.profile["seconds_per_step"]:
+            return None
+        points = sorted((int(size) ** 2, sps) for size, sps in self.profile["seconds_per_step"].items())
+        pixels = width * height
+        if pixels <= points[0][0]:
+            return points[0][1] * pixels / points[0][0]
+        for (p0, s0), (p1, s1) in zip(points, points[1:]):
+            if pixels <= p1:
+                return s0 + (s1 - s0) * (pixels - p0) / (p1 - p0)
+        return points[-1][1] * pixels / points[-1][0]
+
+    def estimate(self, steps, width, height, fallback):
+        """Expected seconds for a generation, or `fallback` without a profile."""
+        sps = self.seconds_per_step(width, height)
+        if sps is None:
+            return fallback
+        decode = (self.profile.get("vae_decode_seconds") or 0) * width * height / self.profile["reference_size"] ** 2
+        return round(steps * sps + decode, 1)
+
+    def default_steps(self, fallback):
+        """Steps that fit `target_seconds` at the reference size, within [min_steps, max_steps]."""
+        size = self.profile["reference_size"] if self.profile else None
+        sps = self.seconds_per_step(size, size) if size else None
+        if not sps:
+            return fallback
+        return max(self.min_steps, min(self.max_steps, int(self.target_seconds / sps)))
+
+    def max_size(self, steps, fallback):
+        """Largest measured bucket whose estimate at `steps` stays within `max_seconds`."""
+        if not self.profile or not self.profile["seconds_per_step"]:
+            return fallback
+        sizes = sorted(int(size) for size in self.profile["seconds_per_step"])
+        fitting = [s for s in sizes if self.estimate(steps, s, s, None) <= self.max_seconds]
+        return fitting[-1] if fitting else sizes[0]
+
+    def status(self):
+        return {
+            "state": self.state,
+            "profile_path": str(self.profile_path),
+            "error": self.error,
+            "target_seconds": self.target_seconds,
+            "max_seconds": self.max_seconds,
+            "profile": self.profile
+        }
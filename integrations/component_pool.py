@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - Shared Component Pool
+Deduplicates tokenizer, text encoder, VAE and UNet modules across pipelines
+built from the same architecture (SD 1.5 derivatives), so identical weights
+are held in memory once and only the differing parts stay resident per model.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import weakref
+import logging
+
+import torch
+
+from model_cache import module_nbytes
+
+logger = logging.getLogger(__name__)
+
+SHARED_COMPONENTS = ("tokenizer", "text_encoder", "vae", "unet")
+
+_fingerprint_sources = []  # (model_name, component_name) -> fingerprint or None, asked before the Hub cache
+
+
+def add_fingerprint_source(source):
+    """Let files_fingerprint answer from another local copy of the files (e.g. the model store)."""
+    _fingerprint_sources.append(source)
+
+
+def weights_fingerprint(component):
+    """Content hash of a module's tensors (or a tokenizer's vocabulary)."""
+    h = hashlib.blake2b(digest_size=16)
+    if isinstance(component, torch.nn.Module):
+        for name, tensor in component.state_dict().items():
+            data = tensor.detach().cpu().contiguous()
+            h.update(f"{name}:{data.dtype}:{tuple(data.shape)}".encode())
+            h.update(data.reshape(-1).view(torch.uint8).numpy())
+    else:
+        h.update(type(component).__name__.encode())
+        h.update(json.dumps(component.get_vocab(), sort_keys=True).encode())
+        h.update(json.dumps(getattr(component, "special_tokens_map", {}), sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def files_fingerprint(model_name, component_name):
+    """Cheap pre-load fingerprint from the Hugging Face cache blob names.
+
+    Hub cache blobs are named after their content hash, so the sorted list of
+    (file, blob) pairs identifies a component without reading its weights.
+    Sources registered with add_fingerprint_source are asked first. Returns
+    None when the snapshot is not available locally.
+    """
+    for source in _fingerprint_sources:
+        fingerprint = source(model_name, component_name)
+        if fingerprint is not None:
+            return fingerprint
+    try:
+        from huggingface_hub import try_to_load_from_cache
+        index_path = try_to_load_from_cache(model_name, "model_index.json")
+    except Exception:
+        return None
+    if not isinstance(index_path, str):
+        return None
+
+    component_dir = os.path.join(os.path.dirname(index_path), component_name)
+    if not os.path.isdir(component_dir):
+        return None
+
+    entries = sorted(
+        (filename, os.path.basename(os.path.realpath(os.path.join(component_dir, filename))))
+        for filename in os.listdir(component_dir)
+    )
+    return hashlib.blake2b(json.dumps(entries).encode(), digest_size=16).hexdigest()
+
+
+class ComponentPool:
+    """Weakly-held pool of pipeline components keyed by content hash.
+
+    Components drop out of the pool automatically once no cached pipeline
+    references them any more.
+    """
+
+    def __init__(self):
+        self._modules = weakref.WeakValueDictionary()  # (component, dtype, weights hash) -> module
+        self._file_index = {}  # (component, dtype, files hash) -> weights hash
+        self._lock = threading.Lock()
+        self.stats = {
+            "reused_before_load": 0,
+            "deduplicated_after_load": 0,
+            "unique": 0,
+            "bytes_saved": 0
+        }
+
+    def lookup(self, model_name, torch_dtype):
+        """Components already in the pool for `model_name`, to pass to `from_pretrained`."""
+        reuse = {}
+        with self._lock:
+            for name in SHARED_COMPONENTS:
+                files_hash = files_fingerprint(model_name, name)
+                weights_hash = self._file_index.get((name, str(torch_dtype), files_hash))
+                if files_hash is None or weights_hash is None:
+                    continue
+                component = self._modules.get((name, str(torch_dtype), weights_hash))
+                if component is not None:
+                    reuse[name] = component
+                    self.stats["reused_before_load"] += 1
+                    if isinstance(component, torch.nn.Module):
+                        self.stats["bytes_saved"] += module_nbytes(component)
+        if reuse:
+            logger.info(f"♻️ Reusing pooled components for {model_name}: {', '.join(reuse)}")
+        return reuse
+
+    def register(self, pipe, model_name, torch_dtype):
+        """Swap freshly loaded components for identical pooled ones and pool the rest.
+
+        Must run before the pipeline is moved to its device so hashes see CPU tensors.
+        """
+        shared = {}
+        with self._lock:
+            pooled_ids = {id(c) for c in self._modules.values()}
+            for name in SHARED_COMPONENTS:
+                component = getattr(pipe, name, None)
+                if component is None or id(component) in pooled_ids:
+                    continue
+
+                weights_hash = weights_fingerprint(component)
+                key = (name, str(torch_dtype), weights_hash)
+                files_hash = files_fingerprint(model_name, name)
+                if files_hash is not None:
+                    self._file_index[(name, str(torch_dtype), files_hash)] = weights_hash
+
+                existing = self._modules.get(key)
+                if existing is not None:
+                    shared[name] = existing
+                    self.stats["deduplicated_after_load"] += 1
+                    if isinstance(component, torch.nn.Module):
+                        self.stats["bytes_saved"] += module_nbytes(component)
+                else:
+                    self._modules[key] = component
+                    self.stats["unique"] += 1
+
+        if shared:
+            pipe.register_modules(**shared)
+            logger.info(f"🔗 {model_name} shares identical {', '.join(shared)} with a loaded model")
+        return pipe
+
+    def summary(self):
+        with self._lock:
+            pooled = {}
+            for (name, _, _), _component in self._modules.items():
+                pooled[name] = pooled.get(name, 0) + 1
+            return {
+                "pooled_components": pooled,
+                **self.stats,
+                "gb_saved": round(self.stats["bytes_saved"] / 1024 ** 3, 2)
+            }
@@ -0,0 +1,27 @@
+"""
+Shared fixtures for the integrations tests.
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+
+@pytest.fixture(scope="session")
+def server(tmp_path_factory):
+    """ultra_optimized_server imported on the CPU inside a scratch directory (no model is loaded)."""
+    for module in ("torch", "diffusers", "fastapi"):
+        pytest.importorskip(module)
+    workdir = tmp_path_factory.mktemp("server")
+    previous = os.getcwd()
+    os.environ.update({"FORCE_CPU": "true", "CALIBRATION": "off", "PRELOAD_MODELS": "", "WORKER_PROCESSES": "0"})
+    os.chdir(workdir)
+    try:
+        import ultra_optimized_server
+        yield ultra_optimized_server
+    finally:
+        os.chdir(previous)
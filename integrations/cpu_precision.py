@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - CPU Precision Selection
+Chooses between bfloat16 and float32 weights for CPU pipelines (CPU_DTYPE),
+runs the UNet and text encoder under CPU autocast and keeps the VAE decode
+in float32 for quality.
+"""
+
+import contextlib
+import time
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+CPU_DTYPES = ("fp32", "bf16", "auto")
+MIN_BF16_SPEEDUP = 1.1
+
+
+def cpu_bf16_support():
+    """(supported, evidence) from oneDNN and the CPU flags (AVX512-BF16 / AMX)."""
+    flags = set()
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    flags.update(line.split(":", 1)[1].split())
+                    break
+    except OSError:
+        pass
+    native = sorted(flags & {"avx512_bf16", "amx_bf16"})
+    try:
+        onednn = bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        onednn = False
+    return onednn or bool(native), {"onednn_bf16": onednn, "cpu_flags": native}
+
+
+def benchmark_bf16(iterations=5):
+    """Time a UNet-like conv + linear block in fp32 and bf16; returns seconds and speedup."""
+    torch.manual_seed(0)
+    conv = torch.nn.Conv2d(320, 320, 3, padding=1)
+    linear = torch.nn.Linear(320, 1280)
+    x = torch.randn(2, 320, 64, 64)
+    tokens = torch.randn(2 * 4096, 320)
+    timings = {}
+    for name, dtype in (("fp32", torch.float32), ("bf16", torch.bfloat16)):
+        c, l = conv.to(dtype), linear.to(dtype)
+        xi, ti = x.to(dtype), tokens.to(dtype)
+        with torch.inference_mode():
+            c(xi), l(ti)
+            start = time.perf_counter()
+            for _ in range(iterations):
+                c(xi), l(ti)
+        timings[name] = (time.perf_counter() - start) / iterations
+    return {
+        "fp32_s": round(timings["fp32"], 4),
+        "bf16_s": round(timings["bf16"], 4),
+        "speedup": round(timings["fp32"] / timings["bf16"], 2)
+    }
+
+
+def resolve_cpu_dtype(mode):
+    """Map CPU_DTYPE to a torch dtype; `auto` enables bf16 only if supported and measurably faster.
+
+    Returns (dtype, report) where the report explains the decision for /health.
+    """
+    mode = (mode or "fp32").lower()
+    if mode not in CPU_DTYPES:
+        logger.warning(f"⚠️ Unknown CPU_DTYPE '{mode}', expected one of {CPU_DTYPES}; using fp32")
+        mode = "fp32"
+    report = {"mode": mode}
+    if mode == "fp32":
+        return torch.float32, {**report, "dtype": "float32"}
+
+    supported, evidence = cpu_bf16_support()
+    report.update(evidence)
+    if mode == "bf16":
+        if not supported:
+            logger.warning("⚠️ CPU_DTYPE=bf16 but no native bf16 support detected; expect slow emulation")
+        return torch.bfloat16, {**report, "dtype": "bfloat16"}
+
+    if not supported:
+        logger.info("ℹ️ CPU_DTYPE=auto: no native bf16 support, staying on fp32")
+        return torch.float32, {**report, "dtype": "float32", "reason": "bf16 not supported"}
+    bench = benchmark_bf16()
+    report["benchmark"] = bench
+    if bench["speedup"] < MIN_BF16_SPEEDUP:
+        logger.info(f"ℹ️ CPU_DTYPE=auto: bf16 only x{bench['speedup']} faster, staying on fp32")
+        return torch.float32, {**report, "dtype": "float32", "reason": "bf16 not faster"}
+    logger.info(f"✅ CPU_DTYPE=auto: bf16 x{bench['speedup']} faster than fp32, enabling it")
+    return torch.bfloat16, {**report, "dtype": "bfloat16"}
+
+
+def keep_vae_fp32(pipe):
+    """Hold the VAE in float32 and decode outside autocast, casting latents on the way in."""
+    vae = getattr(pipe, "vae", None)
+    if vae is None or getattr(vae, "_fp32_decode", False):
+        return pipe
+    vae.to(torch.float32)
+    decode = vae.decode
+
+    def decode_fp32(z, *args, **kwargs):
+        with torch.autocast("cpu", enabled=False):
+            return decode(z.to(torch.float32), *args, **kwargs)
+
+    vae.decode = decode_fp32
+    vae._fp32_decode = True
+    return pipe
+
+
+def autocast_context(pipe):
+    """CPU bf16 autocast for pipelines whose UNet holds bf16 weights, else a no-op."""
+    unet = getattr(pipe, "unet", None)
+    if isinstance(unet, torch.nn.Module) and unet.dtype == torch.bfloat16 and unet.device.type == "cpu":
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
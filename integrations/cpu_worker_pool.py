@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - CPU Worker Pool
+Runs inference in N worker processes instead of one process using every core.
+Each worker is pinned to a disjoint CPU set (split along shared-L3 / NUMA
+domains where the kernel exposes them) and sizes its intra-op threads to that
+set; a dispatcher hands each task to an idle worker.
+
+Benchmark the split on the target host with:
+    python cpu_worker_pool.py --benchmark --splits 1,2,3,4,6
+"""
+
+import argparse
+import glob
+import importlib
+import json
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import time
+import logging
+from multiprocessing.connection import Client, Listener
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INIT = "ultra_optimized_server:pool_worker_init"
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+
+def _parse_cpulist(text):
+    """'0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11]"""
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def _read_cpulist(path):
+    try:
+        with open(path) as f:
+            return _parse_cpulist(f.read())
+    except (OSError, ValueError):
+        return []
+
+
+def allowed_cpus():
+    try:
+        return sorted(psutil.Process().cpu_affinity())
+    except (AttributeError, psutil.Error):
+        return list(range(os.cpu_count() or 1))
+
+
+def _core_key(cpu):
+    """Sort key keeping SMT siblings next to each other so they land in the same worker."""
+    siblings = _read_cpulist(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list")
+    return (min(siblings) if siblings else cpu, cpu)
+
+
+def cpu_groups():
+    """Allowed CPUs grouped by shared L3 (CCD/CCX), else by NUMA node, else one group."""
+    allowed = set(allowed_cpus())
+    for pattern in (
+        "/sys/devices/system/cpu/cpu*/cache/index3/shared_cpu_list",
+        "/sys/devices/system/node/node*/cpulist"
+    ):
+        groups = {tuple(sorted(set(_read_cpulist(path)) & allowed)) for path in glob.glob(pattern)}
+        groups = sorted(g for g in groups if g)
+        if len(groups) > 1:
+            return [sorted(g, key=_core_key) for g in groups]
+    return [sorted(allowed, key=_core_key)]
+
+
+def _chunks(items, count):
+    size, extra = divmod(len(items), count)
+    out, start = [], 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        out.append(items[start:end])
+        start = end
+    return out
+
+
+def partition_cpus(workers, groups=None):
+    """Split the CPUs into `workers` disjoint sets without straddling domains when possible."""
+    groups = groups or cpu_groups()
+    total = sum(len(g) for g in groups)
+    if workers < 1 or workers > total:
+        raise ValueError(f"cannot split {total} CPUs across {workers} workers")
+    if workers % len(groups) == 0:
+        return [chunk for g in groups for chunk in _chunks(g, workers // len(groups))]
+    if len(groups) % workers == 0:
+        per = len(groups) // workers
+        return [sum(groups[i:i + per], []) for i in range(0, len(groups), per)]
+    return _chunks(sum(groups, []), workers)
+
+
+class _Worker:
+    def __init__(self, index, cpus):
+        self.index = index
+        self.cpus = cpus
+        self.process = None
+        self.conn = None
+        self.state = "stopped"
+        self.pid = None
+        self.started_at = None
+        self.tasks = 0
+        self.failures = 0
+        self.restarts = 0
+        self.busy_seconds = 0.0
+
+
+class CpuWorkerPool:
+    """N pinned inference processes plus a dispatcher routing tasks to idle ones.
+
+    `init` names a "module:function" imported inside each worker after pinning;
+    it is called as `init(index, emit)` and returns the task handler. Handlers
+    may call `emit(event)` to stream events back to the `submit()` caller.
+    """
+
+    def __init__(self, size, init=DEFAULT_INIT, env=None, cpu_sets=None):
+        self.size = int(size)
+        self.init = init
+        self.env = dict(env or {})
+        self.cpu_sets = cpu_sets or partition_cpus(self.size)
+        self.workers = [_Worker(i, cpus) for i, cpus in enumerate(self.cpu_sets)]
+        self._cond = threading.Condition()
+        self._authkey = secrets.token_bytes(16)
+        self._listener = None
+        self._stopping = False
+
+    def start(self):
+        """Launch the workers; they become idle (and eligible for tasks) once their init finishes."""
+        if self._listener is not None:
+            return
+        self._listener = Listener(authkey=self._authkey)
+        threading.Thread(target=self._accept_loop, name="worker-pool-accept", daemon=True).start()
+        for worker in self.workers:
+            self._spawn(worker)
+        logger.info(f"👷 Starting {self.size} CPU workers: " + " | ".join(
+            f"#{w.index} cpus {w.cpus}" for w in self.workers
+        ))
+
+    def _spawn(self, worker):
+        env = {**os.environ, **self.env, "APIBR2_POOL_AUTHKEY": self._authkey.hex()}
+        env.update({name: str(len(worker.cpus)) for name in THREAD_ENV_VARS})
+        worker.process = subprocess.Popen(
+            [
+                sys.executable, os.path.abspath(__file__), "--worker",
+                "--index", str(worker.index),
+                "--cpus", ",".join(map(str, worker.cpus)),
+                "--init", self.init,
+                "--address", str(self._listener.address)
+            ],
+            env=env
+        )
+        worker.state = "starting"
+        worker.started_at = time.time()
+        threading.Thread(target=self._watch, args=(worker, worker.process), daemon=True).start()
+
+    def _watch(self, worker, process):
+        """Mark a worker dead (and respawn it) if its process exits outside stop()."""
+        code = process.wait()
+        with self._cond:
+            if self._stopping or worker.process is not process:
+                return
+            crashed_in_init = worker.state == "starting"
+            worker.state = "failed" if crashed_in_init else "dead"
+            worker.conn = None
+            self._cond.notify_all()
+        if crashed_in_init:
+            # An init error would just repeat; leave the slot failed instead of crash-looping
+            logger.error(f"❌ Worker #{worker.index} exited with code {code} during startup")
+            return
+        logger.error(f"❌ Worker #{worker.index} exited with code {code}; restarting")
+        worker.restarts += 1
+        self._spawn(worker)
+
+    def _accept_loop(self):
+        while not self._stopping:
+            try:
+                conn = self._listener.accept()
+                kind, index, info = conn.recv()
+            except Exception as e:
+                if not self._stopping:
+                    logger.warning(f"Worker handshake failed: {e}")
+                continue
+            worker = self.workers[index]
+            with self._cond:
+                worker.conn = conn
+                worker.pid = info.get("pid")
+                worker.state = "idle"
+                self._cond.notify_all()
+            logger.info(f"✅ Worker #{index} ready (pid {worker.pid}, {info.get('threads')} threads, "
+                        f"{time.time() - worker.started_at:.1f}s)")
+
+    def _acquire(self, worker=None, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                candidates = [worker] if worker is not None else self.workers
+                idle = [w for w in candidates if w.state == "idle"]
+                if idle:
+                    chosen = min(idle, key=lambda w: w.tasks)
+                    chosen.state = "busy"
+                    return chosen
+                if all(w.state == "failed" for w in candidates):
+                    raise RuntimeError("CPU workers failed to start; see worker logs")
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("no idle CPU worker")
+                self._cond.wait(remaining)
+
+    def _release(self, worker):
+        with self._cond:
+            if worker.state == "busy":
+                worker.state = "idle"
+            self._cond.notify_all()
+
+    def _run(self, worker, task, on_event):
+        started = time.time()
+        try:
+            worker.conn.send(task)
+            while True:
+                kind, payload = worker.conn.recv()
+                if kind == "event":
+                    if on_event is not None:
+                        on_event(payload)
+                    continue
+                if kind == "error":
+                    worker.failures += 1
+                    raise RuntimeError(payload)
+                return payload
+        except (EOFError, OSError) as e:
+            worker.failures += 1
+            with self._cond:
+                worker.state = "dead"
+            raise RuntimeError(f"CPU worker #{worker.index} died mid-task: {e}")
+        finally:
+            worker.tasks += 1
+            worker.busy_seconds += time.time() - started
+            self._release(worker)
+
+    def submit(self, task, on_event=None, timeout=None):
+        """Run `task` on the next idle worker and return its result."""
+        worker = self._acquire(timeout=timeout)
+        return self._run(worker, task, on_event)
+
+    def broadcast(self, task, timeout=None, parallel=True):
+        """Run `task` once on every worker; returns results in worker order.
+
+        `parallel=False` runs one worker at a time, e.g. to avoid N concurrent
+        transient copies of a model while it loads.
+        """
+        results = [None] * len(self.workers)
+        errors = []
+
+        def run_on(worker):
+            try:
+                results[worker.index] = self._run(self._acquire(worker, timeout), task, None)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run_on, args=(w,), daemon=True) for w in self.workers]
+        for t in threads:
+            t.start()
+            if not parallel:
+                t.join()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return results
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+        for worker in self.workers:
+            if worker.conn is not None:
+                try:
+                    worker.conn.send(None)
+                except OSError:
+                    pass
+            if worker.process is not None:
+                try:
+                    worker.process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    worker.process.kill()
+            worker.state = "stopped"
+        if self._listener is not None:
+            self._listener.close()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "mode": "processes",
+                "workers": [
+                    {
+                        "index": w.index,
+                        "pid": w.pid,
+                        "state": w.state,
+                        "cpus": w.cpus,
+                        "threads": len(w.cpus),
+                        "tasks": w.tasks,
+                        "failures": w.failures,
+                        "restarts": w.restarts,
+                        "busy_seconds": round(w.busy_seconds, 1)
+                    }
+                    for w in self.workers
+                ],
+                "idle": sum(w.state == "idle" for w in self.workers)
+            }
+
+
+def _worker_main(args):
+    """Worker process: pin, import the init hook, then serve tasks until told to stop."""
+    cpus = _parse_cpulist(args.cpus)
+    try:
+        psutil.Process().cpu_affinity(cpus)
+    except (AttributeError, psutil.Error) as e:
+        logger.warning(f"⚠️ Worker #{args.index}: CPU pinning unavailable ({e})")
+
+    module_name, _, function_name = args.init.partition(":")
+    conn_lock = threading.Lock()
+    conn = None
+
+    def emit(event):
+        with conn_lock:
+            conn.send(("event", event))
+
+    handler = getattr(importlib.import_module(module_name), function_name)(args.index, emit)
+
+    conn = Client(args.address, authkey=bytes.fromhex(os.environ["APIBR2_POOL_AUTHKEY"]))
+    conn.send(("ready", args.index, {"pid": os.getpid(), "threads": len(cpus)}))
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        try:
+            result = handler(task)
+            with conn_lock:
+                conn.send(("result", result))
+        except Exception as e:
+            logger.error(f"❌ Worker #{args.index} task failed: {e}")
+            with conn_lock:
+                conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+def benchmark(splits, task, tasks_per_worker, init=DEFAULT_INIT, setup=()):
+    """Aggregate throughput (tasks/minute) of `task` for each pool size in `splits`.
+
+    `setup` tasks (e.g. model load + warm-up) are broadcast to every worker before timing.
+    """
+    total_cpus = len(allowed_cpus())
+    report = []
+    for size in splits:
+        if size > total_cpus:
+            report.append({"workers": size, "skipped": f"only {total_cpus} CPUs available"})
+            continue
+        pool = CpuWorkerPool(size, init=init)
+        pool.start()
+        try:
+            for setup_task in setup:
+                pool.broadcast(setup_task)
+            count = tasks_per_worker * size
+            latencies = []
+
+            def client():
+                for _ in range(tasks_per_worker):
+                    started = time.time()
+                    pool.submit(task)
+                    latencies.append(time.time() - started)
+
+            started = time.time()
+            clients = [threading.Thread(target=client) for _ in range(size)]
+            for c in clients:
+                c.start()
+            for c in clients:
+                c.join()
+            elapsed = time.time() - started
+            report.append({
+                "workers": size,
+                "threads_per_worker": [len(c) for c in pool.cpu_sets],
+                "images": count,
+                "seconds": round(elapsed, 1),
+                "images_per_minute": round(count * 60 / elapsed, 2),
+                "mean_latency": round(sum(latencies) / len(latencies), 2)
+            })
+            logger.info(f"📊 {size} workers: {report[-1]['images_per_minute']} images/min")
+        finally:
+            pool.stop()
+    measured = [r for r in report if "images_per_minute" in r]
+    best = max(measured, key=lambda r: r["images_per_minute"])["workers"] if measured else None
+    return {"cpus": total_cpus, "results": report, "best_workers": best}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="APIBR2 CPU worker pool")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--index", type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument("--cpus", default="", help=argparse.SUPPRESS)
+    parser.add_argument("--address", default="", help=argparse.SUPPRESS)
+    parser.add_argument("--init", default=DEFAULT_INIT)
+    parser.add_argument("--benchmark", action="store_true", help="measure images/minute per worker count")
+    parser.add_argument("--splits", default="1,2,3,4,6")
+    parser.add_argument("--model", default="runwayml/stable-diffusion-v1-5")
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--steps", type=int, default=15)
+    parser.add_argument("--images-per-worker", type=int, default=3)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.worker:
+        return _worker_main(args)
+    if args.benchmark:
+        payload = {"prompt": "a lighthouse on a cliff at sunset", "negative_prompt": None,
+                   "guidance_scale": 7.5, "seed": 42, "progress_key": None}
+        result = benchmark(
+            [int(n) for n in args.splits.split(",") if n.strip()],
+            # Same key as the server's batches; the trailing None is a plain (non-hires) run
+            ("generate", (args.model, args.size, args.size, args.steps, "auto", None), [payload]),
+            args.images_per_worker,
+            init=args.init,
+            setup=[("load", args.model), ("warmup", args.model)]
+        )
+        print(json.dumps(result, indent=2))
+        return
+    print(json.dumps({"groups": cpu_groups(), "splits": {
+        n: partition_cpus(n) for n in (1, 2, 3, 4, 6) if n <= len(allowed_cpus())
+    }}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
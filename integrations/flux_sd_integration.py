@@ -13,14 +13,18 @@ import logging
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
 
+from image_responses import encode_image, image_encoder
+
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def generate_image_flux(prompt, model="FLUX.1-dev"):
+def generate_image_flux(prompt, model="FLUX.1-dev", return_bytes=False):
     """
     Gera imagem usando Flux
     Por enquanto, cria uma imagem de placeholder
+    
+    Com return_bytes=True o PNG volta em "image_bytes" e o arquivo é gravado em background.
     """
     logger.info(f"Generating image with Flux for prompt: {prompt} using model: {model}")
     
@@ -62,24 +66,34 @@ def generate_image_flux(prompt, model="FLUX.1-dev"):
     filename = f"flux_{timestamp}_{uuid.uuid4().hex[:8]}.png"
     filepath = output_dir / filename
     
-    image.save(filepath)
+    image_bytes = None
+    if return_bytes:
+        image_bytes = encode_image(image)
+        image_encoder.write(filepath, image_bytes)
+    else:
+        image.save(filepath)
     
     generation_time = time.time() - start_time
     
     logger.info(f"Flux image generated: {filepath}")
     
-    return {
+    result = {
         "image_url": f"http://localhost:5001/images/{filename}",
         "local_path": str(filepath),
         "generation_time": generation_time,
         "model": model,
         "prompt": prompt
     }
+    if return_bytes:
+        result["image_bytes"] = image_bytes
+    return result
 
-def generate_image_sd35(prompt, model="stabilityai/stable-diffusion-3.5-large"):
+def generate_image_sd35(prompt, model="stabilityai/stable-diffusion-3.5-large", return_bytes=False):
     """
     Gera imagem usando Stable Diffusion 3.5
     Por enquanto, cria uma imagem de placeholder
+    
+    Com return_bytes=True o PNG volta em "image_bytes" e o arquivo é gravado em background.
     """
     logger.info(f"Generating image with Stable Diffusion 3.5 for prompt: {prompt} using model: {model}")
     
@@ -121,19 +135,27 @@ def generate_image_sd35(prompt, model="stabilityai/stable-diffusion-3.5-large"):
     filename = f"sd35_{timestamp}_{uuid.uuid4().hex[:8]}.png"
     filepath = output_dir / filename
     
-    image.save(filepath)
+    image_bytes = None
+    if return_bytes:
+        image_bytes = encode_image(image)
+        image_encoder.write(filepath, image_bytes)
+    else:
+        image.save(filepath)
     
     generation_time = time.time() - start_time
     
     logger.info(f"Stable Diffusion 3.5 image generated: {filepath}")
     
-    return {
+    result = {
         "image_url": f"http://localhost:5001/images/{filename}",
         "local_path": str(filepath),
         "generation_time": generation_time,
         "model": model,
         "prompt": prompt
     }
+    if return_bytes:
+        result["image_bytes"] = image_bytes
+    return result
 
 def edit_image_sd35(image_url, prompt):
     """
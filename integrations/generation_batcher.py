@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - Generation Micro-Batcher
+Collects compatible /generate requests that arrive within a short window and
+hands them to a single batched pipeline call, then splits results per caller.
+"""
+
+import threading
+import time
+import logging
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class BatchItem:
+    """One caller waiting for its slice of a batched pipeline run."""
+
+    def __init__(self, key, payload):
+        self.key = key
+        self.payload = payload
+        self.future = Future()
+        self.enqueued_at = time.time()
+        self.queue_wait = 0.0
+
+
+class GenerationBatcher:
+    """Group requests by key and run them through `run_batch` on dispatcher threads.
+
+    `run_batch(key, items)` must return one result per item, in order. Items
+    sharing a key are batched together; the oldest group is dispatched once its
+    window expires or as soon as any group reaches `max_batch_size`. With
+    `concurrency > 1` that many batches may run at once (e.g. one per worker process).
+    """
+
+    def __init__(self, run_batch, window_ms=50, max_batch_size=4, concurrency=1):
+        self.run_batch = run_batch
+        self.window = max(float(window_ms), 0.0) / 1000.0
+        self.max_batch_size = max(int(max_batch_size), 1)
+        self._pending = {}  # key -> [BatchItem] in arrival order
+        self.concurrency = max(int(concurrency), 1)
+        self._cond = threading.Condition()
+        self._workers = []
+        self.stats = {
+            "batches": 0,
+            "items": 0,
+            "max_observed_batch": 0
+        }
+
+    def submit(self, key, payload, timeout=None):
+        """Queue a payload and block until its result is available."""
+        item = BatchItem(key, payload)
+        self.enqueue([item])
+        return item.future.result(timeout)
+
+    def enqueue(self, items):
+        """Queue several items at once, so the dispatcher sees them together."""
+        with self._cond:
+            self._ensure_worker()
+            for item in items:
+                self._pending.setdefault(item.key, []).append(item)
+            self._cond.notify_all()
+
+    def group(self, size):
+        return BatchGroup(self, size)
+
+    def queue_depth(self):
+        with self._cond:
+            return sum(len(items) for items in self._pending.values())
+
+    def _ensure_worker(self):
+        self._workers = [w for w in self._workers if w.is_alive()]
+        while len(self._workers) < self.concurrency:
+            worker = threading.Thread(
+                target=self._loop, name=f"generation-batcher-{len(self._workers)}", daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if not self._pending:
+                    self._cond.wait()
+                    continue
+
+                # Full groups go first, otherwise the group holding the oldest request
+                key = next(
+                    (k for k, items in self._pending.items() if len(items) >= self.max_batch_size),
+                    None
+                )
+                if key is None:
+                    key = min(self._pending, key=lambda k: self._pending[k][0].enqueued_at)
+                    deadline = self._pending[key][0].enqueued_at + self.window
+                    remaining = deadline - time.time()
+                    if remaining > 0:
+                        self._cond.wait(remaining)
+                        continue
+
+                items = self._pending.pop(key)
+                batch, rest = items[:self.max_batch_size], items[self.max_batch_size:]
+                if rest:
+                    self._pending[key] = rest
+                return key, batch
+
+    def _loop(self):
+        while True:
+            key, batch = self._next_batch()
+            started = time.time()
+            for item in batch:
+                item.queue_wait = started - item.enqueued_at
+
+            with self._cond:
+                self.stats["batches"] += 1
+                self.stats["items"] += len(batch)
+                self.stats["max_observed_batch"] = max(self.stats["max_observed_batch"], len(batch))
+
+            try:
+                results = self.run_batch(key, batch)
+                for item, result in zip(batch, results):
+                    item.future.set_result(result)
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_exception(RuntimeError("Batch returned fewer results than requests"))
+            except Exception as e:
+                logger.error(f"❌ Batch {key} failed: {e}")
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_exception(e)
+
+
+class BatchGroup:
+    """Sibling requests (e.g. the images of one multi-image request) that should share a batch.
+
+    Each member either submits through `member.submit()` or drops out with
+    `member.leave()` (served from cache, coalesced, failed); once every member
+    has done one or the other, the submitted items are queued together instead
+    of racing the batching window one by one. A member that submits after
+    leaving is queued on its own.
+    """
+
+    def __init__(self, batcher, size):
+        self.batcher = batcher
+        self._lock = threading.Lock()
+        self._waiting = size
+        self._items = []
+
+    def member(self):
+        return _GroupMember(self)
+
+    def _arrive(self, item=None):
+        with self._lock:
+            if item is not None:
+                self._items.append(item)
+            self._waiting -= 1
+            ready = self._items if self._waiting == 0 else None
+        if ready:
+            self.batcher.enqueue(ready)
+
+
+class _GroupMember:
+    def __init__(self, group):
+        self.group = group
+        self.arrived = False
+
+    def submit(self, key, payload, timeout=None):
+        if self.arrived:
+            return self.group.batcher.submit(key, payload, timeout)
+        item = BatchItem(key, payload)
+        self.arrived = True
+        self.group._arrive(item)
+        return item.future.result(timeout)
+
+    def leave(self):
+        if not self.arrived:
+            self.arrived = True
+            self.group._arrive()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - Compiled Graph Execution
+Opt-in torch.compile (inductor) + channels_last for the UNet and VAE decoder,
+resolution bucketing so compiled graphs get reused, and a persistent inductor
+cache so restarts skip most of the compile work.
+"""
+
+import math
+import os
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# off disables compilation; the rest are torch.compile modes
+COMPILE_MODES = ("off", "default", "reduce-overhead", "max-autotune")
+DEFAULT_BUCKETS = "256x256,384x384,512x512,640x640,768x768,512x768,768x512,448x640,640x448"
+
+
+def parse_buckets(spec):
+    """'512x512,512x768' -> [(512, 512), (512, 768)]"""
+    buckets = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        width, height = item.lower().split("x")
+        buckets.append(((int(width) // 8) * 8, (int(height) // 8) * 8))
+    return buckets
+
+
+def snap_to_bucket(width, height, buckets, max_size=None):
+    """Closest bucket by aspect ratio, then area; keeps (width, height) when no bucket fits."""
+    candidates = [
+        (w, h) for w, h in buckets
+        if max_size is None or (w <= max_size and h <= max_size)
+    ]
+    if not candidates:
+        return width, height
+    aspect = math.log(width / height)
+    return min(
+        candidates,
+        key=lambda b: (round(abs(math.log(b[0] / b[1]) - aspect), 2), abs(b[0] * b[1] - width * height))
+    )
+
+
+def configure_compile_cache(cache_dir):
+    """Point inductor's FX graph / AOTAutograd caches at a persistent directory."""
+    cache_dir = os.path.abspath(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", cache_dir)
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    os.environ.setdefault("TORCHINDUCTOR_AUTOGRAD_CACHE", "1")
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except Exception as e:
+        logger.warning(f"Inductor cache configuration skipped: {e}")
+    return os.environ["TORCHINDUCTOR_CACHE_DIR"]
+
+
+def _mark_batch_dynamic(args, kwargs):
+    """Mark dim 0 of every input sharing the sample's batch size as dynamic.
+
+    Sizes are static (bucketed), but the batcher hands the UNet anything from 1 to
+    BATCH_MAX_SIZE images (twice that with CFG); without this each batch size would
+    compile its own graph on live traffic. Batch 1 still gets its own specialization.
+    """
+    tensors = [value for value in (*args, *kwargs.values()) if isinstance(value, torch.Tensor) and value.dim() > 0]
+    if not tensors or tensors[0].shape[0] < 2:
+        return
+    batch = tensors[0].shape[0]
+    for tensor in tensors:
+        if tensor.shape[0] == batch:
+            torch._dynamo.maybe_mark_dynamic(tensor, 0)
+
+
+def compile_module(module, mode):
+    """channels_last + compiled `forward` with a dynamic batch dimension; hooks stay eager.
+
+    Compiling `forward` instead of the whole module keeps forward hooks (e.g. per-item
+    guidance) out of the graph, so hooks registered per batch don't trigger recompiles.
+    Idempotent, since shared components may reach here through several pipelines.
+    """
+    if "forward" in module.__dict__:
+        return module
+    module.to(memory_format=torch.channels_last)
+    options = {} if mode == "default" else {"mode": mode}
+    compiled = torch.compile(module.forward, dynamic=False, **options)
+
+    def forward(*args, **kwargs):
+        _mark_batch_dynamic(args, kwargs)
+        return compiled(*args, **kwargs)
+
+    module.forward = forward
+    return module
+
+
+def uncompile_module(module):
+    module.__dict__.pop("forward", None)
+    return module
+
+
+def compile_pipeline(pipe, mode):
+    """Compile the UNet and VAE decoder of a loaded pipeline in place."""
+    compiled = []
+    if getattr(pipe, "unet", None) is not None:
+        compile_module(pipe.unet, mode)
+        compiled.append("unet")
+    vae = getattr(pipe, "vae", None)
+    if vae is not None and getattr(vae, "decoder", None) is not None:
+        compile_module(vae.decoder, mode)
+        compiled.append("vae.decoder")
+    if compiled:
+        logger.info(f"⚙️ torch.compile ({mode}) + channels_last: {', '.join(compiled)}")
+    return pipe
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - Hires Fix
+Two-pass generation for sizes above the draft resolution: the base steps run
+at a smaller draft size, the draft latents are upscaled to the target size and
+a short img2img-style refinement pass restores detail there. Both passes use
+the UNet, VAE and scheduler of the already cached pipeline.
+"""
+
+import math
+import time
+import logging
+
+import torch
+import torch.nn.functional as F
+
+from tiled_diffusion import decode, denoise, vae_scale
+
+logger = logging.getLogger(__name__)
+
+UPSCALE_MODES = ("bicubic", "bilinear", "nearest-exact")
+
+
+def draft_size(width, height, base, multiple=64):
+    """Target aspect ratio with the long side at `base`, in multiples of `multiple`."""
+    scale = base / max(width, height)
+    if scale >= 1:
+        return width, height
+    return (
+        max(round(width * scale / multiple) * multiple, multiple),
+        max(round(height * scale / multiple) * multiple, multiple)
+    )
+
+
+def refine_steps(steps, hires_steps=None):
+    return hires_steps or max(steps // 2, 1)
+
+
+def refine_timesteps(scheduler, steps, strength, device):
+    """img2img schedule: `steps` steps covering the last `strength` of the noise schedule."""
+    total = max(math.ceil(steps / strength), steps)
+    scheduler.set_timesteps(total, device=device)
+    start = (total - min(int(total * strength), total)) * scheduler.order
+    if hasattr(scheduler, "set_begin_index"):
+        scheduler.set_begin_index(start)
+    return scheduler.timesteps[start:]
+
+
+def upscale_latents(latents, height, width, mode="bicubic"):
+    kwargs = {} if mode == "nearest-exact" else {"align_corners": False}
+    return F.interpolate(latents, size=(height, width), mode=mode, **kwargs)
+
+
+def hires_generate(pipe, embeds, seeds, guidances, steps, width, height, draft_width, draft_height,
+                   strength=0.5, hires_steps=None, upscale="bicubic", tile=None, overlap=0,
+                   tile_batch=4, on_step=None):
+    """Draft at draft_width x draft_height, upscale the latents, refine at width x height.
+
+    `tile` / `overlap` (pixels) make the refinement pass tiled, for targets above
+    the size cap. Returns (images, report) with the per-phase timings.
+    """
+    scheduler = pipe.scheduler
+    device = pipe._execution_device
+    scale = vae_scale(pipe)
+    channels = pipe.unet.config.in_channels
+    hires_steps = refine_steps(steps, hires_steps)
+    timings = {}
+
+    # One generator per seed draws the draft noise, then the refinement noise
+    generators = [torch.Generator("cpu").manual_seed(seed) for seed in seeds]
+
+    started = time.perf_counter()
+    scheduler.set_timesteps(steps, device=device)
+    latents = torch.cat([
+        torch.randn((1, channels, draft_height // scale, draft_width // scale), generator=g) for g in generators
+    ]).to(device) * scheduler.init_noise_sigma
+    latents = denoise(pipe, embeds, latents, guidances, scheduler.timesteps, generators, on_step=on_step)
+    timings["draft"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    latents = upscale_latents(latents, height // scale, width // scale, upscale)
+    timesteps = refine_timesteps(scheduler, hires_steps, strength, device)
+    noise = torch.cat([torch.randn((1, *latents.shape[1:]), generator=g) for g in generators]).to(device)
+    latents = scheduler.add_noise(latents, noise, timesteps[:1])
+    timings["upscale"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    latents = denoise(
+        pipe, embeds, latents, guidances, timesteps, generators,
+        tile=tile // scale if tile else None, overlap=overlap // scale, tile_batch=tile_batch,
+        on_step=on_step, step_offset=steps
+    )
+    timings["refine"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    images = decode(pipe, latents, tile, overlap)
+    timings["decode"] = time.perf_counter() - started
+
+    logger.info(
+        f"🔍 Hires {draft_width}x{draft_height} → {width}x{height} | "
+        + " | ".join(f"{phase}: {seconds:.1f}s" for phase, seconds in timings.items())
+    )
+    return images, {
+        "draft_size": f"{draft_width}x{draft_height}",
+        "strength": strength,
+        "draft_steps": steps,
+        "refine_steps": len(timesteps),
+        "upscale": upscale,
+        "timings": {phase: round(seconds, 3) for phase, seconds in timings.items()}
+    }
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - Image Editing
+img2img and inpainting on the already cached text-to-image pipeline: the edit
+pipelines are assembled from its own UNet, VAE, text encoder and scheduler (no
+second weight load), and VAE encodings of source images are cached by content
+hash so repeated edits of the same picture skip the encoder.
+"""
+
+import base64
+import binascii
+import hashlib
+import io
+import inspect
+import ipaddress
+import socket
+import threading
+import logging
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import requests
+import torch
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+def decode_image_data(data):
+    """Bytes of a base64 image, with or without a `data:image/...;base64,` prefix."""
+    if data.startswith("data:"):
+        data = data.partition(",")[2]
+    try:
+        return base64.b64decode(data, validate=True)
+    except (binascii.Error, ValueError):
+        raise ValueError("not valid base64")
+
+
+def check_fetch_url(url, allowed_hosts=()):
+    """Raise ValueError unless `url` is http(s) to a public address (and an allowed host, if listed).
+
+    Every address the host resolves to must be globally routable, so a URL can
+    not reach loopback, private, link-local (cloud metadata) or reserved ranges.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("URL must be http(s)")
+    host = parts.hostname.lower()
+    if allowed_hosts and host not in allowed_hosts:
+        raise ValueError(f"host {host} is not allowed")
+    try:
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, ValueError) as e:
+        raise ValueError(f"could not resolve {host}: {e}")
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split("%")[0])
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(f"host {host} resolves to a non-public address")
+
+
+def fetch_image(url, max_bytes, timeout=15, allowed_hosts=()):
+    """Download an http(s) image from a public host, refusing anything larger than `max_bytes`.
+
+    Redirects are not followed, since their target would skip the address check.
+    """
+    check_fetch_url(url, allowed_hosts)
+    content = bytearray()
+    try:
+        with requests.get(url, stream=True, timeout=timeout, allow_redirects=False) as response:
+            if response.is_redirect:
+                raise ValueError("URL redirects; send the final image URL")
+            response.raise_for_status()
+            for chunk in response.iter_content(64 * 1024):
+                content.extend(chunk)
+                if len(content) > max_bytes:
+                    raise ValueError(f"larger than {max_bytes // (1024 * 1024)} MB")
+    except requests.RequestException as e:
+        raise ValueError(f"could not fetch {url}: {e}")
+    return bytes(content)
+
+
+def open_image(content, mode="RGB"):
+    """(PIL image, digest) of encoded image bytes; the digest hashes the decoded pixels.
+
+    Hashing pixels rather than file bytes lets the same picture sent as PNG, WebP or
+    from a URL share its cached encoding.
+    """
+    try:
+        image = Image.open(io.BytesIO(content))
+        image.load()
+    except Exception as e:
+        raise ValueError(f"could not decode image: {e}")
+    image = image.convert(mode)
+    digest = hashlib.sha256(f"{mode}:{image.width}x{image.height}:".encode() + image.tobytes()).hexdigest()
+    return image, digest
+
+
+def effective_steps(steps, strength):
+    """Denoising steps an edit actually runs: the last `strength` of a `steps` schedule."""
+    return min(int(steps * strength), steps)
+
+
+def masked_source(image, mask):
+    """Source with the repainted (white) mask area blanked to mid-gray, as inpainting UNets expect."""
+    return Image.composite(Image.new("RGB", image.size, (128, 128, 128)), image, mask.convert("L").resize(image.size))
+
+
+def edit_pipeline(pipe, inpaint=False):
+    """img2img / inpaint pipeline sharing every module of a loaded SD 1.x/2.x pipeline.
+
+    Construction only registers the existing modules, so it is cheap enough to do per
+    call, and always picks up the scheduler currently set on `pipe`.
+    """
+    from diffusers import StableDiffusionImg2ImgPipeline, StableDiffusionInpaintPipeline
+
+    pipeline_cls = StableDiffusionInpaintPipeline if inpaint else StableDiffusionImg2ImgPipeline
+    accepted = inspect.signature(pipeline_cls.__init__).parameters
+    components = {name: module for name, module in pipe.components.items() if name in accepted}
+    components.setdefault("safety_checker", None)
+    components.setdefault("feature_extractor", None)
+    edit_pipe = pipeline_cls(**components, requires_safety_checker=False)
+    edit_pipe.set_progress_bar_config(disable=True)
+    return edit_pipe
+
+
+class LatentCache:
+    """LRU of VAE-encoded source images keyed by model, pixel digest and size.
+
+    Encodings use the mean of the VAE's latent distribution instead of a sample, so
+    they are deterministic and the same for every seed that edits the image.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def encode(self, pipe, model_name, image, digest, width, height):
+        """(scaled latents of `image` at width x height, cache hit) on the pipeline's device."""
+        vae = pipe.vae
+        key = (model_name, digest, width, height, str(vae.dtype))
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+                self.counters["hits"] += 1
+        if cached is not None:
+            return cached.to(pipe._execution_device), True
+
+        pixels = pipe.image_processor.preprocess(image.resize((width, height), Image.LANCZOS))
+        with torch.no_grad():
+            latents = vae.encode(pixels.to(pipe._execution_device, vae.dtype)).latent_dist.mode()
+        latents = latents * vae.config.scaling_factor
+
+        stored = latents.detach().to("cpu")
+        size = stored.numel() * stored.element_size()
+        with self._lock:
+            self.counters["misses"] += 1
+            if size <= self.max_bytes and key not in self._entries:
+                self._entries[key] = stored
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._bytes -= evicted.numel() * evicted.element_size()
+                    self.counters["evictions"] += 1
+        return latents, False
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters["hits"] + self.counters["misses"]
+            return {
+                "entries": len(self._entries),
+                "size_mb": round(self._bytes / (1024 * 1024), 2),
+                "max_mb": round(self.max_bytes / (1024 * 1024), 2),
+                "hit_rate": round(self.counters["hits"] / lookups, 3) if lookups else 0.0,
+                **self.counters
+            }
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - Image Response Helpers
+Shared by the image servers: encode generated images (PNG, WebP, JPEG, AVIF) on
+a background pool, persist them atomically into a sharded output directory and
+shape the response as base64 JSON, URL-only JSON or raw bytes with metadata in
+headers.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+
+from PIL import features
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_FORMATS = ("base64", "url", "binary")
+
+# format -> (PIL format name, media type, default quality for lossy formats)
+IMAGE_FORMATS = {
+    "png": ("PNG", "image/png", None),
+    "webp": ("WEBP", "image/webp", 90),
+    "jpeg": ("JPEG", "image/jpeg", 90),
+    "avif": ("AVIF", "image/avif", 80)
+}
+FORMAT_ALIASES = {"jpg": "jpeg"}
+DEFAULT_PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", "6"))
+
+
+def available_formats():
+    """Output formats this Pillow build can actually encode."""
+    optional = {"webp": "webp", "avif": "avif"}
+    return [
+        name for name in IMAGE_FORMATS
+        if name not in optional or features.check(optional[name])
+    ]
+
+
+def normalize_format(image_format):
+    """Canonical format name; raises ValueError for unknown or unsupported formats."""
+    name = FORMAT_ALIASES.get((image_format or "png").lower(), (image_format or "png").lower())
+    if name not in available_formats():
+        raise ValueError(f"image_format must be one of: {', '.join(available_formats())}")
+    return name
+
+
+def media_type(image_format):
+    return IMAGE_FORMATS[normalize_format(image_format)][1]
+
+
+def validate_encoding(quality=None, compress_level=None):
+    """Raise ValueError for out-of-range quality (1-100) or PNG compress level (0-9)."""
+    if quality is not None and not 1 <= quality <= 100:
+        raise ValueError("quality must be between 1 and 100")
+    if compress_level is not None and not 0 <= compress_level <= 9:
+        raise ValueError("compress_level must be between 0 and 9")
+
+
+def encode_image(image, format="png", quality=None, compress_level=None):
+    """Encode a PIL image into bytes without touching the disk.
+
+    `quality` applies to WebP/JPEG/AVIF, `compress_level` (0-9) to PNG.
+    """
+    name = normalize_format(format)
+    pil_format, _, default_quality = IMAGE_FORMATS[name]
+    options = {}
+    if name == "png":
+        options["compress_level"] = DEFAULT_PNG_COMPRESS_LEVEL if compress_level is None else compress_level
+    else:
+        options["quality"] = default_quality if quality is None else quality
+        if image.mode not in ("RGB", "RGBA") or (name == "jpeg" and image.mode == "RGBA"):
+            image = image.convert("RGB")
+    buffer = BytesIO()
+    image.save(buffer, format=pil_format, **options)
+    return buffer.getvalue()
+
+
+def shard_path(root, filename):
+    """`root/ab/<filename>` with a stable two-character shard derived from the name."""
+    shard = hashlib.md5(filename.encode()).hexdigest()[:2]
+    return Path(root) / shard / filename
+
+
+def resolve_output(root, filename):
+    """Locate a stored image: sharded layout first, then the legacy flat directory."""
+    for path in (shard_path(root, filename), Path(root) / filename):
+        if path.exists():
+            return path
+    return None
+
+
+def metadata_headers(metadata, image_url=None):
+    """Response headers carrying generation metadata for `binary` responses."""
+    headers = {
+        "X-Generation-Metadata": json.dumps(metadata, default=str),
+    }
+    if image_url:
+        headers["X-Image-Url"] = image_url
+    for key in ("model", "generation_time", "seed", "steps"):
+        if metadata.get(key) is not None:
+            headers[f"X-{key.replace('_', '-').title()}"] = str(metadata[key])
+    return headers
+
+
+def with_image_payload(response, image_bytes, response_format):
+    """Attach `image_base64` to a JSON response only when the client asked for it.
+
+    Multi-image responses pass a list of image bytes, one per entry of `data.images`.
+    """
+    if response_format != "base64":
+        return response
+    if isinstance(image_bytes, list):
+        return {
+            **response,
+            "data": {
+                **response["data"],
+                "images": [
+                    {**entry, "image_base64": base64.b64encode(data).decode("utf-8")}
+                    for entry, data in zip(response["data"]["images"], image_bytes)
+                ]
+            }
+        }
+    return {
+        **response,
+        "data": {
+            **response["data"],
+            "image_base64": base64.b64encode(image_bytes).decode("utf-8")
+        }
+    }
+
+
+class ImageEncoder:
+    """Background encode-and-persist stage for generated images.
+
+    `encode()` compresses a PIL image on the pool and then writes it atomically
+    (temp file + rename); the caller gets a future of (bytes, encode_time) and
+    the inference worker never waits on compression or disk I/O. Until a write
+    lands the bytes stay available through `pending()`, so an image URL handed
+    out in the response can be served right away.
+
+    Threads are enough here: Pillow releases the GIL inside its zlib, libwebp,
+    libjpeg and libavif encoders.
+    """
+
+    def __init__(self, max_workers=2):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-encoder")
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.counters = {"encoded": 0, "written": 0, "write_errors": 0, "encode_time": 0.0}
+
+    def encode(self, image, path, format="png", quality=None, compress_level=None):
+        """Encode `image` in the background and persist it to `path`."""
+        path = Path(path)
+        future = self._executor.submit(self._encode, image, path, format, quality, compress_level)
+        with self._lock:
+            self._pending[str(path)] = future
+        return future
+
+    def write(self, path, data):
+        """Persist already-encoded bytes to `path` in the background."""
+        path = Path(path)
+        with self._lock:
+            self._pending[str(path)] = data
+        return self._executor.submit(self._write, path, data)
+
+    def pending(self, path):
+        """Bytes of an image that is still being encoded or written, else None."""
+        with self._lock:
+            entry = self._pending.get(str(Path(path)))
+        if entry is None or isinstance(entry, bytes):
+            return entry
+        try:
+            return entry.result()[0]
+        except Exception:
+            return None
+
+    def _encode(self, image, path, format, quality, compress_level):
+        started = time.time()
+        try:
+            data = encode_image(image, format, quality, compress_level)
+        except Exception:
+            with self._lock:
+                self._pending.pop(str(path), None)
+            raise
+        encode_time = time.time() - started
+        with self._lock:
+            self._pending[str(path)] = data
+            self.counters["encoded"] += 1
+            self.counters["encode_time"] += encode_time
+        self._executor.submit(self._write, path, data)
+        return data, encode_time
+
+    def _write(self, path, data):
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f".{path.name}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+            with self._lock:
+                self.counters["written"] += 1
+        except OSError as e:
+            logger.error(f"❌ Could not write {path}: {e}")
+            with self._lock:
+                self.counters["write_errors"] += 1
+        finally:
+            with self._lock:
+                if self._pending.get(str(path)) is data:
+                    self._pending.pop(str(path), None)
+
+    def stats(self):
+        with self._lock:
+            encoded = self.counters["encoded"]
+            return {
+                "workers": self.max_workers,
+                "pending": len(self._pending),
+                "formats": available_formats(),
+                **{k: v for k, v in self.counters.items() if k != "encode_time"},
+                "avg_encode_time": round(self.counters["encode_time"] / encoded, 4) if encoded else None
+            }
+
+
+image_encoder = ImageEncoder(max_workers=int(os.getenv("IMAGE_ENCODER_WORKERS", "2")))
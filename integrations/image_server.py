@@ -4,7 +4,7 @@ APIBR2 - Image Generation Server
 Servidor Flask para geração de imagens com Flux e Stable Diffusion
 """
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response
 from flask_cors import CORS
 import os
 import sys
@@ -23,6 +23,7 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 # Importar as funções de geração de imagem
 from flux_sd_integration import generate_image_flux, generate_image_sd35
+from image_responses import RESPONSE_FORMATS, image_encoder, metadata_headers, with_image_payload
 
 app = Flask(__name__)
 CORS(app)  # Permitir CORS para o frontend
@@ -57,9 +58,12 @@ def generate_image():
         prompt = data.get('prompt')
         model = data.get('model', 'stabilityai/stable-diffusion-3.5-large')
         size = data.get('size', '1024x1024')
+        response_format = data.get('response_format', 'base64')
         
         if not prompt:
             return jsonify({"error": "Prompt is required"}), 400
+        if response_format not in RESPONSE_FORMATS:
+            return jsonify({"error": f"response_format must be one of: {', '.join(RESPONSE_FORMATS)}"}), 400
         
         logger.info(f"Generating image with model: {model}, prompt: {prompt}")
         
@@ -70,9 +74,9 @@ def generate_image():
         
         # Escolher o modelo correto
         if model == 'FLUX.1-dev':
-            result = generate_image_flux(prompt, model)
+            result = generate_image_flux(prompt, model, return_bytes=True)
         elif 'stable-diffusion' in model:
-            result = generate_image_sd35(prompt, model)
+            result = generate_image_sd35(prompt, model, return_bytes=True)
         else:
             return jsonify({"error": f"Unsupported model: {model}"}), 400
         
@@ -82,19 +86,12 @@ def generate_image():
         
         logger.info(f"Image generation completed: {filename}")
         
-        # Converter imagem para base64
-        try:
-            with open(filepath, "rb") as image_file:
-                image_base64 = base64.b64encode(image_file.read()).decode('utf-8')
-        except FileNotFoundError:
-            logger.error(f"File not found: {filepath}")
-            return jsonify({"error": f"Generated file not found: {filepath}"}), 500
-        
-        # Retornar resposta com base64
-        return jsonify({
+        # A imagem já vem codificada em memória; o arquivo é gravado em background
+        image_bytes = result["image_bytes"]
+        
+        response = {
             "success": True,
             "data": {
-                "image_base64": image_base64,
                 "image_url": f"http://apibr.giesel.com.br/images/{filename}",
                 "local_path": str(filepath),
                 "prompt": prompt,
@@ -107,7 +104,15 @@ def generate_image():
                 "generation_time": result.get('generation_time', 5.0),
                 "timestamp": datetime.now().isoformat()
             }
-        })
+        }
+        
+        if response_format == "binary":
+            return Response(
+                image_bytes,
+                mimetype='image/png',
+                headers=metadata_headers(response["metadata"], response["data"]["image_url"])
+            )
+        return jsonify(with_image_payload(response, image_bytes, response_format))
         
     except Exception as e:
         logger.error(f"Error generating image: {str(e)}")
@@ -215,6 +220,9 @@ def serve_image(filename):
     """Servir imagens geradas"""
     try:
         filepath = UPLOAD_FOLDER / filename
+        pending = image_encoder.pending(filepath)
+        if pending is not None:
+            return Response(pending, mimetype='image/png')
         if filepath.exists():
             return send_file(filepath, mimetype='image/png')
         else:
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - Image Job Queue
+In-process priority queue with dedicated inference workers, journaled to SQLite
+so queued work survives a server restart.
+"""
+
+import json
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """Priority job queue backed by a local SQLite journal.
+
+    `handler(payload)` runs on a worker thread and must return a JSON-serializable
+    result. Higher `priority` values are picked first; ties run in arrival order.
+    Finished jobs older than `retention_hours` are deleted (0 keeps them forever).
+    """
+
+    def __init__(self, db_path, handler, workers=1, retention_hours=0):
+        self.db_path = str(db_path)
+        self.handler = handler
+        self.num_workers = max(int(workers), 1)
+        self.retention = max(float(retention_hours), 0.0) * 3600
+        self._pruned_at = 0.0
+        self.pruned = 0
+        self._queue = queue.PriorityQueue()
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._workers = []
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock:
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )"""
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_finished_at ON jobs(finished_at)")
+            self._db.commit()
+
+    def start(self):
+        """Re-queue journaled work and launch the worker threads."""
+        if self._workers:
+            return
+        with self._lock:
+            # Anything that was mid-flight when we died goes back to the queue
+            self._db.execute("UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'running'")
+            self._db.commit()
+            rows = self._db.execute(
+                "SELECT id, priority FROM jobs WHERE status = 'queued' ORDER BY created_at"
+            ).fetchall()
+        for row in rows:
+            self._enqueue(row["id"], row["priority"])
+        if rows:
+            logger.info(f"♻️ Restored {len(rows)} queued job(s) from {self.db_path}")
+        self.prune()
+
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self._loop, name=f"inference-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        logger.info(f"🧵 Started {self.num_workers} inference worker(s)")
+
+    def submit(self, payload, priority=0):
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (id, priority, status, payload, created_at) VALUES (?, ?, 'queued', ?, ?)",
+                (job_id, int(priority), json.dumps(payload), time.time())
+            )
+            self._db.commit()
+        self._enqueue(job_id, priority)
+        return job_id
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+
+        job = {
+            "job_id": row["id"],
+            "status": row["status"],
+            "priority": row["priority"],
+            "created_at": row["created_at"],
+            "started_at": row["started_at"],
+            "finished_at": row["finished_at"]
+        }
+        if row["status"] == "queued":
+            job["queue_position"] = self._position(row["id"])
+        if row["result"] is not None:
+            job["result"] = json.loads(row["result"])
+        if row["error"] is not None:
+            job["error"] = row["error"]
+        return job
+
+    def stats(self):
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {
+            "workers": self.num_workers,
+            "queue_depth": self._queue.qsize(),
+            "jobs": {row["status"]: row["n"] for row in rows},
+            "retention_hours": self.retention / 3600,
+            "pruned": self.pruned
+        }
+
+    def prune(self):
+        """Delete completed / failed jobs that finished more than the retention period ago."""
+        if not self.retention:
+            return 0
+        now = time.time()
+        with self._lock:
+            self._pruned_at = now
+            deleted = self._db.execute(
+                "DELETE FROM jobs WHERE status IN ('completed', 'failed') AND finished_at < ?",
+                (now - self.retention,)
+            ).rowcount
+            self._db.commit()
+            self.pruned += deleted
+        if deleted:
+            logger.info(f"🧹 Pruned {deleted} finished job(s) older than {self.retention / 3600:g}h")
+        return deleted
+
+    def _enqueue(self, job_id, priority):
+        with self._lock:
+            self._seq += 1
+            self._queue.put((-int(priority), self._seq, job_id))
+
+    def _position(self, job_id):
+        with self._queue.mutex:
+            ordered = sorted(self._queue.queue)
+        for position, entry in enumerate(ordered):
+            if entry[2] == job_id:
+                return position
+        return None
+
+    def _finish(self, job_id, status, result=None, error=None):
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+                (status, json.dumps(result) if result is not None else None, error, time.time(), job_id)
+            )
+            self._db.commit()
+        if self.retention and time.time() - self._pruned_at >= 60:
+            self.prune()
+
+    def _loop(self):
+        while True:
+            _, _, job_id = self._queue.get()
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT payload, status FROM jobs WHERE id = ?", (job_id,)
+                ).fetchone()
+                if row is None or row["status"] != "queued":
+                    continue
+                self._db.execute(
+                    "UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?",
+                    (time.time(), job_id)
+                )
+                self._db.commit()
+
+            try:
+                result = self.handler(json.loads(row["payload"]))
+                self._finish(job_id, "completed", result=result)
+                logger.info(f"✅ Job {job_id} completed")
+            except Exception as e:
+                error = getattr(e, "detail", None) or str(e)
+                self._finish(job_id, "failed", error=str(error))
+                logger.error(f"❌ Job {job_id} failed: {error}")
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - Pre-flight Memory Planner
+Predicts the peak weight and activation memory of a generation from the
+model configs, batch size, resolution, dtype and attention / VAE slicing,
+compares it with the memory actually free on the device (torch / psutil) and
+picks the cheapest settings that fit before the pipeline runs.
+"""
+
+import contextlib
+import threading
+import logging
+
+import psutil
+import torch
+
+from model_cache import GB, pipeline_nbytes
+
+logger = logging.getLogger(__name__)
+
+# Rough multipliers of the activation model, kept conservative:
+UNET_FEATURE_MAPS = 16  # live full-resolution UNet feature maps (resnets + skip connections)
+VAE_FEATURE_MAPS = 3    # live full-resolution VAE decoder feature maps
+FUSED_ATTENTION_BLOCK = 1024  # query rows a fused (SDPA / xformers) kernel holds scores for
+SAFETY_FACTOR = 1.3     # allocator fragmentation, temporaries, scheduler state
+FALLBACK_SIZE = 512     # smallest size a request is reduced to before leaving the device
+
+
+def is_memory_error(error):
+    """True for allocation failures on any backend (CUDA, DirectML, host)."""
+    if isinstance(error, (torch.cuda.OutOfMemoryError, MemoryError)):
+        return True
+    message = str(error).lower()
+    return any(s in message for s in ("out of memory", "not enough memory", "failed to allocate", "cannot allocate"))
+
+
+def _dtype_bytes(module):
+    return torch.empty(0, dtype=module.dtype).element_size()
+
+
+def _heads(unet_config):
+    """Attention heads of the highest-resolution UNet block (SD 2.x configs list them per block)."""
+    heads = unet_config.get("num_attention_heads") or unet_config.get("attention_head_dim", 8)
+    return heads[0] if isinstance(heads, (list, tuple)) else heads
+
+
+def attention_mode(unet):
+    """("classic" | "sliced" | "fused", slice size) of the UNet's attention processors."""
+    modes = {}
+    for processor in unet.attn_processors.values():
+        name = type(processor).__name__
+        if "Sliced" in name:
+            modes["sliced"] = getattr(processor, "slice_size", 1)
+        elif "2_0" in name or "XFormers" in name:
+            modes["fused"] = None
+        else:
+            modes["classic"] = None
+    # The most memory-hungry processor in use decides the peak
+    for mode in ("classic", "sliced", "fused"):
+        if mode in modes:
+            return mode, modes[mode]
+    return "classic", None
+
+
+def pipeline_settings(pipe):
+    """Current memory-relevant settings of a torch pipeline."""
+    mode, slice_size = attention_mode(pipe.unet)
+    vae = pipe.vae
+    return {
+        "attention": mode,
+        "attention_slice": slice_size,
+        "vae_slicing": bool(getattr(vae, "use_slicing", False)),
+        "vae_tiling": bool(getattr(vae, "use_tiling", False))
+    }
+
+
+def estimate_activations(unet_config, vae_config, batch, width, height, unet_bytes, vae_bytes,
+                         guidance=True, attention="classic", attention_slice=None,
+                         vae_slicing=False, vae_tiling=False, vae_tile=512):
+    """(UNet peak, VAE decode peak) activation bytes of one generation; they never overlap."""
+    scale = 2 ** (len(vae_config["block_out_channels"]) - 1)
+    tokens = (height // scale) * (width // scale)
+    rows = batch * (2 if guidance else 1)  # CFG runs the conditional and unconditional halves together
+    heads = _heads(unet_config)
+
+    # Highest-resolution self-attention dominates: scores + softmax of tokens x tokens per head
+    if attention == "sliced" or attention_slice:
+        scores = 2 * min(attention_slice or 1, rows * heads) * tokens ** 2
+    elif attention == "fused":
+        scores = rows * heads * tokens * min(tokens, FUSED_ATTENTION_BLOCK)
+    else:
+        scores = 2 * rows * heads * tokens ** 2
+    features = UNET_FEATURE_MAPS * rows * tokens * unet_config["block_out_channels"][0]
+    unet = (scores + features) * unet_bytes
+
+    decoded = 1 if vae_slicing else batch
+    tile_h, tile_w = (min(height, vae_tile), min(width, vae_tile)) if vae_tiling else (height, width)
+    vae_tokens = (tile_h // scale) * (tile_w // scale)
+    vae = decoded * (VAE_FEATURE_MAPS * tile_h * tile_w * vae_config["block_out_channels"][0] + 2 * vae_tokens ** 2) * vae_bytes
+    vae += batch * 3 * height * width * 4  # the decoded float images themselves
+    return unet, vae
+
+
+def available_bytes(device, device_capacity=0, device_used=0):
+    """Memory free for activations right now on `device`.
+
+    DirectML has no query API, so there it is `device_capacity` minus what the
+    model cache has placed on the device.
+    """
+    if device == "cuda" and torch.cuda.is_available():
+        free, _ = torch.cuda.mem_get_info()
+        # Blocks torch holds cached but unused are free to this process too
+        return free + torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+    if device == "dml":
+        return max(device_capacity - device_used, 0)
+    return psutil.virtual_memory().available
+
+
+class MemoryPlanner:
+    """Chooses attention / VAE slicing, size and placement so a generation fits in memory.
+
+    Candidates are tried cheapest first: current settings, sliced attention,
+    one-head-at-a-time attention (both skipped under fused kernels, which
+    already need less than either), sliced VAE decode, tiled VAE decode, a
+    smaller size, and finally a CPU replica of the model. Measured CUDA peaks
+    feed a correction factor back into the estimates.
+    """
+
+    def __init__(self, headroom=0.1, allow_downscale=True):
+        self.headroom = headroom
+        self.allow_downscale = allow_downscale
+        self.correction = 1.0
+        self._lock = threading.Lock()
+        self.counters = {"plans": 0, "adjusted": 0, "downscaled": 0, "cpu_replica": 0, "rejected": 0, "observed": 0}
+
+    def _needed(self, activations, weights=0):
+        return int(activations * SAFETY_FACTOR * self.correction) + weights
+
+    def _candidates(self, pipe, width, height):
+        current = pipeline_settings(pipe)
+        heads = _heads(pipe.unet.config)
+        base = {
+            "width": width,
+            "height": height,
+            "attention": current["attention"],
+            "attention_slice": current["attention_slice"],
+            "vae_slicing": current["vae_slicing"],
+            "vae_tiling": current["vae_tiling"]
+        }
+        yield base
+        # Later rungs build on these, so swapping fused SDPA for slicing would make them all worse
+        for slice_size in (max(heads // 2, 1), 1) if base["attention"] != "fused" else ():
+            if base["attention_slice"] is None or slice_size < base["attention_slice"]:
+                base = {**base, "attention": "sliced", "attention_slice": slice_size}
+                yield base
+        if not base["vae_slicing"]:
+            base = {**base, "vae_slicing": True}
+            yield base
+        if not base["vae_tiling"] and hasattr(pipe.vae, "enable_tiling"):
+            base = {**base, "vae_tiling": True}
+            yield base
+        if self.allow_downscale and width * height > FALLBACK_SIZE ** 2:
+            yield {**base, "width": FALLBACK_SIZE, "height": FALLBACK_SIZE}
+
+    def _estimate(self, pipe, batch, guidance, settings, unet_bytes=None, vae_bytes=None):
+        unet, vae = estimate_activations(
+            pipe.unet.config, pipe.vae.config, batch, settings["width"], settings["height"],
+            unet_bytes or _dtype_bytes(pipe.unet), vae_bytes or _dtype_bytes(pipe.vae),
+            guidance=guidance,
+            attention=settings["attention"],
+            attention_slice=settings["attention_slice"],
+            vae_slicing=settings["vae_slicing"],
+            vae_tiling=settings["vae_tiling"],
+            vae_tile=getattr(pipe.vae, "tile_sample_min_size", FALLBACK_SIZE)
+        )
+        return max(unet, vae)
+
+    def plan(self, pipe, batch, width, height, guidance, device, device_capacity=0, device_used=0):
+        """Settings to run `batch` images at width x height with, or why nothing fits.
+
+        The pipeline is resident already, so only activations have to fit on
+        its device; a CPU replica has to fit its fp32 weights as well.
+        """
+        with self._lock:
+            self.counters["plans"] += 1
+        if not hasattr(pipe, "unet") or not hasattr(pipe, "vae") or not isinstance(pipe.unet, torch.nn.Module):
+            # Flux (offloaded) and ONNX pipelines manage their own memory
+            return {"planned": False, "fits": True, "target": "device", "width": width, "height": height}
+
+        weights = pipeline_nbytes(pipe)
+        free = int(available_bytes(device, device_capacity, device_used) * (1 - self.headroom))
+        best = None
+        for index, settings in enumerate(self._candidates(pipe, width, height)):
+            activations = self._estimate(pipe, batch, guidance, settings)
+            candidate = {**settings, "activations": activations, "needed": self._needed(activations)}
+            if candidate["needed"] <= free:
+                downscaled = (settings["width"], settings["height"]) != (width, height)
+                return self._result(candidate, "device", free, weights, adjusted=index > 0, downscaled=downscaled)
+            best = candidate
+
+        if device != "cpu":
+            # fp32 copy of every torch module, on host RAM
+            replica_weights = sum(
+                p.numel() * 4 for m in (pipe.unet, pipe.vae, getattr(pipe, "text_encoder", None))
+                if isinstance(m, torch.nn.Module) for p in m.parameters()
+            )
+            host_free = int(available_bytes("cpu") * (1 - self.headroom))
+            settings = {
+                "width": width, "height": height, "attention": "sliced", "attention_slice": max(_heads(pipe.unet.config) // 2, 1),
+                "vae_slicing": True, "vae_tiling": False
+            }
+            activations = self._estimate(pipe, batch, guidance, settings, unet_bytes=4, vae_bytes=4)
+            candidate = {**settings, "activations": activations, "needed": self._needed(activations, replica_weights)}
+            if candidate["needed"] <= host_free:
+                return self._result(candidate, "cpu-replica", host_free, replica_weights, adjusted=True)
+
+        with self._lock:
+            self.counters["rejected"] += 1
+        result = self._result(best, "device", free, weights, adjusted=True)
+        result["fits"] = False
+        return result
+
+    def _result(self, candidate, target, free, weights, adjusted, downscaled=False):
+        with self._lock:
+            if adjusted:
+                self.counters["adjusted"] += 1
+            if downscaled:
+                self.counters["downscaled"] += 1
+            if target == "cpu-replica":
+                self.counters["cpu_replica"] += 1
+        return {
+            "planned": True,
+            "fits": True,
+            "target": target,
+            "width": candidate["width"],
+            "height": candidate["height"],
+            "attention_slice": candidate["attention_slice"],
+            "vae_slicing": candidate["vae_slicing"],
+            "vae_tiling": candidate["vae_tiling"],
+            "activations": candidate["activations"],
+            "weights_gb": round(weights / GB, 2),
+            "needed_gb": round(candidate["needed"] / GB, 2),
+            "available_gb": round(free / GB, 2)
+        }
+
+    def observe(self, plan, peak_bytes):
+        """Fold a measured activation peak (CUDA) into the correction factor."""
+        if not plan.get("planned") or not plan.get("activations") or peak_bytes <= 0:
+            return
+        ratio = peak_bytes / (plan["activations"] * SAFETY_FACTOR)
+        with self._lock:
+            self.correction = min(max(0.8 * self.correction + 0.2 * ratio, 0.5), 3.0)
+            self.counters["observed"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {"headroom": self.headroom, "correction": round(self.correction, 3), **self.counters}
+
+
+@contextlib.contextmanager
+def applied_plan(pipe, plan):
+    """Run with the plan's slicing / tiling, restoring the pipeline's own settings afterwards."""
+    if not plan.get("planned"):
+        yield
+        return
+    unet, vae = pipe.unet, pipe.vae
+    current = pipeline_settings(pipe)
+    saved_processors = None
+    if plan["attention_slice"] is not None and plan["attention_slice"] != current["attention_slice"]:
+        saved_processors = unet.attn_processors
+        unet.set_attention_slice(plan["attention_slice"])
+    if plan["vae_slicing"] and not current["vae_slicing"]:
+        vae.enable_slicing()
+    if plan["vae_tiling"] and not current["vae_tiling"]:
+        vae.enable_tiling()
+    try:
+        yield
+    finally:
+        if saved_processors is not None:
+            unet.set_attn_processor(saved_processors)
+        if plan["vae_slicing"] and not current["vae_slicing"]:
+            vae.disable_slicing()
+        if plan["vae_tiling"] and not current["vae_tiling"]:
+            vae.disable_tiling()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - Tiered Model Cache
+Memory-budgeted LRU cache for loaded pipelines. Entries live on the active
+device first, get demoted to host RAM when the device budget is exceeded and
+are only dropped from memory once the RAM budget is exceeded as well.
+"""
+
+import gc
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+
+TIER_DEVICE = "device"
+TIER_HOST = "host"
+
+
+def pipeline_modules(pipe):
+    """Torch modules (unet, vae, text encoder...) registered on a pipeline."""
+    return [c for c in getattr(pipe, "components", {}).values() if isinstance(c, torch.nn.Module)]
+
+
+def module_nbytes(module):
+    """Bytes held by the parameters and buffers of a module (int8 packed weights included)."""
+    total = sum(
+        t.numel() * t.element_size()
+        for t in list(module.parameters()) + list(module.buffers())
+    )
+    # Dynamically quantized linears keep weight and bias in packed params, not parameters
+    for sub in module.modules():
+        packed = getattr(sub, "_packed_params", None)
+        if packed is not None and hasattr(packed, "_weight_bias"):
+            total += sum(t.numel() * t.element_size() for t in packed._weight_bias() if t is not None)
+    return total
+
+
+def pipeline_nbytes(pipe):
+    """Bytes held by every torch module in the pipeline, plus any non-torch weights it declares."""
+    return sum(module_nbytes(m) for m in pipeline_modules(pipe)) + getattr(pipe, "external_nbytes", 0)
+
+
+class _Entry:
+    def __init__(self, pipe, device, movable):
+        self.pipe = pipe
+        self.device = device
+        self.movable = movable
+        self.nbytes = pipeline_nbytes(pipe)
+        self.tier = TIER_DEVICE if movable and str(device) != "cpu" else TIER_HOST
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        self.uses = 0
+
+
+class TieredModelCache:
+    """LRU pipeline cache with a device tier, a host RAM tier and eviction.
+
+    A budget of 0 disables the limit for that tier. On CPU-only hosts the
+    device tier is host RAM, so only the RAM budget applies.
+    """
+
+    def __init__(self, device_budget_bytes=0, ram_budget_bytes=0):
+        self.device_budget = int(device_budget_bytes)
+        self.ram_budget = int(ram_budget_bytes)
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "promotions": 0,
+            "demotions": 0,
+            "evictions": 0
+        }
+
+    def get(self, key):
+        """Return the pipeline for `key`, promoting it back to its device if demoted."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+
+            self.counters["hits"] += 1
+            self._entries.move_to_end(key)
+            entry.last_used = time.time()
+            entry.uses += 1
+
+            if entry.tier == TIER_HOST and entry.movable and str(entry.device) != "cpu":
+                start = time.time()
+                entry.pipe = entry.pipe.to(entry.device)
+                entry.tier = TIER_DEVICE
+                self.counters["promotions"] += 1
+                logger.info(f"⬆️ Promoted {key} to {entry.device} in {time.time() - start:.2f}s")
+                self._enforce_budgets()
+
+            return entry.pipe
+
+    def peek(self, key):
+        """Return the pipeline for `key` without touching LRU order or counters."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.pipe if entry is not None else None
+
+    def put(self, key, pipe, device="cpu", movable=True):
+        """Register a freshly loaded pipeline as the most recently used entry.
+
+        `movable=False` marks pipelines that manage their own placement (e.g. with
+        CPU offload hooks); they are never demoted, only evicted.
+        """
+        with self._lock:
+            entry = _Entry(pipe, device, movable)
+            entry.uses = 1
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            logger.info(f"📦 Cached {key} ({entry.nbytes / GB:.2f} GB, tier: {entry.tier})")
+            self._enforce_budgets()
+            return pipe
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _usage(self):
+        """Bytes per tier, counting modules shared between pipelines once.
+
+        A shared module sits on the device as long as any device-tier pipeline uses it.
+        """
+        device_modules = {
+            id(m): m
+            for e in self._entries.values() if e.tier == TIER_DEVICE
+            for m in pipeline_modules(e.pipe)
+        }
+        host_modules = {
+            id(m): m
+            for e in self._entries.values() if e.tier == TIER_HOST
+            for m in pipeline_modules(e.pipe)
+            if id(m) not in device_modules
+        }
+        # Weights held outside torch (e.g. ONNX Runtime sessions) are never shared
+        external = {TIER_DEVICE: 0, TIER_HOST: 0}
+        for e in self._entries.values():
+            external[e.tier] += getattr(e.pipe, "external_nbytes", 0)
+        return {
+            TIER_DEVICE: sum(module_nbytes(m) for m in device_modules.values()) + external[TIER_DEVICE],
+            TIER_HOST: sum(module_nbytes(m) for m in host_modules.values()) + external[TIER_HOST]
+        }
+
+    def _demote(self, key, entry):
+        """Move a pipeline to host RAM, leaving modules other device pipelines still use."""
+        in_use = {
+            id(m)
+            for k, e in self._entries.items() if k != key and e.tier == TIER_DEVICE
+            for m in pipeline_modules(e.pipe)
+        }
+        for module in pipeline_modules(entry.pipe):
+            if id(module) not in in_use:
+                module.to("cpu")
+        entry.tier = TIER_HOST
+
+    def _shared_components(self, key, entry):
+        others = {
+            id(m)
+            for k, e in self._entries.items() if k != key
+            for m in pipeline_modules(e.pipe)
+        }
+        return [
+            name for name, c in getattr(entry.pipe, "components", {}).items()
+            if isinstance(c, torch.nn.Module) and id(c) in others
+        ]
+
+    def _enforce_budgets(self):
+        """Demote LRU device entries, then evict LRU host entries, sparing the MRU one."""
+        released = False
+        mru = next(reversed(self._entries), None)
+
+        if self.device_budget:
+            for key, entry in list(self._entries.items()):
+                if self._usage()[TIER_DEVICE] <= self.device_budget:
+                    break
+                if key == mru or entry.tier != TIER_DEVICE:
+                    continue
+                self._demote(key, entry)
+                self.counters["demotions"] += 1
+                released = True
+                logger.info(f"⬇️ Demoted {key} to host RAM")
+
+        if self.ram_budget:
+            for key, entry in list(self._entries.items()):
+                if self._usage()[TIER_HOST] <= self.ram_budget:
+                    break
+                if key == mru or entry.tier != TIER_HOST:
+                    continue
+                del self._entries[key]
+                self.counters["evictions"] += 1
+                released = True
+                logger.info(f"🗑️ Evicted {key} from memory")
+
+        if released:
+            self._release_memory()
+
+    def _release_memory(self):
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def stats(self):
+        """Budgets, per-tier usage and hit/miss/evict counters."""
+        with self._lock:
+            lookups = self.counters["hits"] + self.counters["misses"]
+            usage = self._usage()
+            return {
+                "budgets_gb": {
+                    "device": round(self.device_budget / GB, 2) if self.device_budget else None,
+                    "ram": round(self.ram_budget / GB, 2) if self.ram_budget else None
+                },
+                "usage_gb": {
+                    "device": round(usage[TIER_DEVICE] / GB, 2),
+                    "ram": round(usage[TIER_HOST] / GB, 2)
+                },
+                "counters": dict(self.counters),
+                "hit_ratio": round(self.counters["hits"] / lookups, 3) if lookups else None
+            }
+
+    def residency(self):
+        """Per-model tier/size info, most recently used last."""
+        with self._lock:
+            return [
+                {
+                    "model": key,
+                    "tier": entry.tier,
+                    "device": str(entry.device),
+                    "size_gb": round(entry.nbytes / GB, 2),
+                    "shared_components": self._shared_components(key, entry),
+                    "movable": entry.movable,
+                    "uses": entry.uses,
+                    "loaded_at": entry.loaded_at,
+                    "last_used": entry.last_used
+                }
+                for key, entry in self._entries.items()
+            ]
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - Model Preloading
+Loads configured pipelines in the background at boot, runs a tiny warm-up
+generation for each and tracks per-model load state, load time and warm-up
+time for the readiness endpoint.
+"""
+
+import threading
+import time
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+MODEL_STATES = ("pending", "loading", "warming", "ready", "failed")
+
+
+class ModelPreloader:
+    """Background loader plus per-model load / warm-up bookkeeping.
+
+    `load_fn(model)` loads (and caches) a pipeline, `warmup_fn(model)` runs a
+    throwaway generation on it. Models loaded lazily by requests can report
+    their load time through `record_load()` so metrics cover both paths.
+    """
+
+    def __init__(self, load_fn, warmup_fn):
+        self.load_fn = load_fn
+        self.warmup_fn = warmup_fn
+        self.targets = []
+        self._models = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _entry(self, model):
+        return self._models.setdefault(model, {
+            "state": "pending",
+            "load_time": None,
+            "warmup_time": None,
+            "loads": 0,
+            "error": None,
+            "updated": None
+        })
+
+    def _update(self, model, **fields):
+        with self._lock:
+            entry = self._entry(model)
+            entry.update(fields, updated=datetime.now().isoformat())
+
+    def record_load(self, model, seconds, components=None):
+        """Record a finished load; `components` optionally maps component -> seconds."""
+        with self._lock:
+            entry = self._entry(model)
+            entry["load_time"] = round(seconds, 2)
+            if components:
+                entry["component_load_times"] = dict(components)
+            entry["loads"] += 1
+            if entry["state"] == "pending" and model not in self.targets:
+                entry["state"] = "ready"
+            entry["updated"] = datetime.now().isoformat()
+
+    def start(self, models):
+        """Preload `models` one after another on a daemon thread."""
+        self.targets = list(dict.fromkeys(models))
+        if not self.targets:
+            return
+        for model in self.targets:
+            self._update(model, state="pending")
+        self._thread = threading.Thread(target=self._run, daemon=True, name="model-preloader")
+        self._thread.start()
+
+    def _run(self):
+        for model in self.targets:
+            try:
+                self._update(model, state="loading")
+                logger.info(f"🔥 Preloading {model}")
+                self.load_fn(model)
+
+                self._update(model, state="warming")
+                started = time.time()
+                self.warmup_fn(model)
+                warmup_time = time.time() - started
+                self._update(model, state="ready", warmup_time=round(warmup_time, 2), error=None)
+                logger.info(f"✅ {model} ready (warm-up {warmup_time:.1f}s)")
+            except Exception as e:
+                detail = getattr(e, "detail", None) or str(e)
+                self._update(model, state="failed", error=detail)
+                logger.error(f"❌ Preload of {model} failed: {detail}")
+
+    def is_ready(self):
+        with self._lock:
+            return all(self._models.get(m, {}).get("state") == "ready" for m in self.targets)
+
+    def status(self):
+        with self._lock:
+            return {
+                "ready": all(self._models.get(m, {}).get("state") == "ready" for m in self.targets),
+                "preload": list(self.targets),
+                "models": {model: dict(entry) for model, entry in self._models.items()}
+            }
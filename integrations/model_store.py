@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - Local Model Store
+Prefetches Hugging Face snapshots (configs, tokenizers and safetensors weights
+only) into a local directory with a checksum manifest, verifies them, keeps a
+vendored copy of the LPW community pipeline and loads pipelines strictly
+offline from the store, timing each component.
+
+    python model_store.py prefetch runwayml/stable-diffusion-v1-5
+    python model_store.py verify runwayml/stable-diffusion-v1-5
+    python model_store.py import my-org/my-model /path/to/diffusers/dir
+    python model_store.py vendor-lpw
+    python model_store.py list
+"""
+
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import logging
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+STORE_MODES = ("off", "prefer", "strict")
+MANIFEST = "store_manifest.json"
+LPW_PIPELINE_PATH = Path(__file__).resolve().parent / "community_pipelines" / "lpw_stable_diffusion.py"
+COMMUNITY_PIPELINES_MIRROR = "diffusers/community-pipelines-mirror"
+CONFIG_SUFFIXES = (".json", ".txt", ".model")
+SKIPPED_COMPONENTS = ("safety_checker",)  # the servers always pass safety_checker=None
+
+
+def sha256_file(path, chunk_size=8 * 1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def git_blob_sha1(path):
+    """Git object id of a file, which the Hub reports for non-LFS files."""
+    h = hashlib.sha1(f"blob {os.path.getsize(path)}\0".encode())
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _is_variant(filename):
+    # diffusion_pytorch_model.fp16.safetensors, model.non_ema.bin...
+    stem = filename.split("/")[-1].split("-0000")[0]
+    return stem.count(".") > 1 and not stem.endswith(".index.json")
+
+
+def select_files(repo_files):
+    """Component configs/tokenizers plus one weights format per component, safetensors first.
+
+    Root-level single-file checkpoints, variants (fp16, non_ema), other
+    frameworks' weights and SKIPPED_COMPONENTS are left out.
+    Returns (files, safetensors_only).
+    """
+    weights = [f for f in repo_files if "/" in f and not _is_variant(f)]
+    with_safetensors = {f.split("/")[0] for f in weights if f.endswith(".safetensors")}
+    selected, safetensors_only = [], True
+    for f in repo_files:
+        if "/" not in f:
+            if f == "model_index.json":
+                selected.append(f)
+            continue
+        component = f.split("/")[0]
+        if component in SKIPPED_COMPONENTS:
+            continue
+        if f.endswith(CONFIG_SUFFIXES):
+            if f.endswith(".bin.index.json") and component in with_safetensors:
+                continue
+            selected.append(f)
+        elif f.endswith(".safetensors") and f in weights:
+            selected.append(f)
+        elif f.endswith(".bin") and f in weights and component not in with_safetensors:
+            selected.append(f)
+            safetensors_only = False
+    return sorted(selected), safetensors_only
+
+
+class ModelStore:
+    """Local directory of verified model snapshots, loaded without touching the network."""
+
+    def __init__(self, root, token=None):
+        self.root = Path(root)
+        self.token = token
+        self.timings = {}  # model -> per-component load seconds of the last load
+        self.tasks = {}  # model -> prefetch state for the async API
+        self._lock = threading.Lock()
+
+    def model_dir(self, model_name):
+        return self.root / "models" / model_name.replace("/", "--")
+
+    def manifest(self, model_name):
+        path = self.model_dir(model_name) / MANIFEST
+        try:
+            return json.loads(path.read_text())
+        except (OSError, ValueError):
+            return None
+
+    def has(self, model_name):
+        return self.manifest(model_name) is not None
+
+    def files_fingerprint(self, model_name, component_name):
+        """Pre-load fingerprint of a stored component from its manifest checksums (None if not stored)."""
+        manifest = self.manifest(model_name)
+        if manifest is None:
+            return None
+        prefix = f"{component_name}/"
+        entries = sorted((name, entry["sha256"]) for name, entry in manifest["files"].items() if name.startswith(prefix))
+        if not entries:
+            return None
+        return hashlib.blake2b(json.dumps(entries).encode(), digest_size=16).hexdigest()
+
+    def _write_manifest(self, model_dir, model_name, revision, files, safetensors_only, source):
+        manifest = {
+            "model": model_name,
+            "revision": revision,
+            "source": source,
+            "safetensors_only": safetensors_only,
+            "fetched_at": datetime.now().isoformat(),
+            "files": files,
+            "size_bytes": sum(f["size"] for f in files.values())
+        }
+        (model_dir / MANIFEST).write_text(json.dumps(manifest, indent=2))
+        return manifest
+
+    def _install(self, tmp_dir, model_name):
+        final_dir = self.model_dir(model_name)
+        shutil.rmtree(final_dir, ignore_errors=True)
+        final_dir.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_dir, final_dir)
+        return final_dir
+
+    def prefetch(self, model_name, revision=None):
+        """Download a snapshot into the store and check every file against the Hub's hashes."""
+        from huggingface_hub import HfApi, snapshot_download
+
+        started = time.time()
+        info = HfApi(token=self.token).model_info(model_name, revision=revision, files_metadata=True)
+        siblings = {s.rfilename: s for s in info.siblings}
+        files, safetensors_only = select_files(list(siblings))
+        logger.info(f"⬇️ Prefetching {model_name}@{info.sha[:8]}: {len(files)} files")
+
+        tmp_dir = self.root / "models" / f".{model_name.replace('/', '--')}.fetching"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        snapshot_download(
+            model_name, revision=info.sha, allow_patterns=files, local_dir=tmp_dir, token=self.token
+        )
+        shutil.rmtree(tmp_dir / ".cache", ignore_errors=True)
+
+        entries, mismatched = {}, []
+        for name in files:
+            path = tmp_dir / name
+            sibling = siblings[name]
+            digest = sha256_file(path)
+            if sibling.lfs is not None:
+                ok = digest == sibling.lfs.sha256
+            else:
+                ok = sibling.blob_id is None or git_blob_sha1(path) == sibling.blob_id
+            if not ok:
+                mismatched.append(name)
+            entries[name] = {"size": path.stat().st_size, "sha256": digest}
+        if mismatched:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise ValueError(f"checksum mismatch for {model_name}: {', '.join(mismatched)}")
+
+        self._write_manifest(tmp_dir, model_name, info.sha, entries, safetensors_only, "hub")
+        final_dir = self._install(tmp_dir, model_name)
+        logger.info(f"✅ {model_name} stored in {final_dir} ({time.time() - started:.0f}s)")
+        return self.manifest(model_name)
+
+    def import_dir(self, model_name, source_dir):
+        """Copy a local diffusers directory into the store (air-gapped hosts)."""
+        source_dir = Path(source_dir)
+        repo_files = [p.relative_to(source_dir).as_posix() for p in source_dir.rglob("*") if p.is_file()]
+        files, safetensors_only = select_files(repo_files)
+        tmp_dir = self.root / "models" / f".{model_name.replace('/', '--')}.fetching"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        entries = {}
+        for name in files:
+            target = tmp_dir / name
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(source_dir / name, target)
+            entries[name] = {"size": target.stat().st_size, "sha256": sha256_file(target)}
+        self._write_manifest(tmp_dir, model_name, None, entries, safetensors_only, str(source_dir))
+        self._install(tmp_dir, model_name)
+        logger.info(f"✅ Imported {source_dir} as {model_name} ({len(files)} files)")
+        return self.manifest(model_name)
+
+    def verify(self, model_name):
+        """Re-hash every stored file against the manifest."""
+        manifest = self.manifest(model_name)
+        if manifest is None:
+            return {"model": model_name, "ok": False, "error": "not in store"}
+        model_dir = self.model_dir(model_name)
+        missing, mismatched = [], []
+        for name, entry in manifest["files"].items():
+            path = model_dir / name
+            if not path.exists():
+                missing.append(name)
+            elif path.stat().st_size != entry["size"] or sha256_file(path) != entry["sha256"]:
+                mismatched.append(name)
+        return {
+            "model": model_name,
+            "ok": not missing and not mismatched,
+            "checked": len(manifest["files"]),
+            "missing": missing,
+            "mismatched": mismatched
+        }
+
+    def prefetch_async(self, model_name, revision=None):
+        """Start a background prefetch; progress is reported by `status()`."""
+        with self._lock:
+            if self.tasks.get(model_name, {}).get("state") == "downloading":
+                return False
+            self.tasks[model_name] = {"state": "downloading", "started": datetime.now().isoformat(), "error": None}
+
+        def run():
+            try:
+                self.prefetch(model_name, revision)
+                state = {"state": "ready"}
+            except Exception as e:
+                logger.error(f"❌ Prefetch of {model_name} failed: {e}")
+                state = {"state": "failed", "error": str(e)}
+            with self._lock:
+                self.tasks[model_name].update(state, finished=datetime.now().isoformat())
+
+        threading.Thread(target=run, name=f"prefetch-{model_name}", daemon=True).start()
+        return True
+
+    def list(self):
+        models_dir = self.root / "models"
+        entries = []
+        for path in sorted(models_dir.glob("*/" + MANIFEST)) if models_dir.exists() else []:
+            manifest = json.loads(path.read_text())
+            entries.append({
+                "model": manifest["model"],
+                "revision": manifest["revision"],
+                "files": len(manifest["files"]),
+                "size_gb": round(manifest["size_bytes"] / 1024 ** 3, 2),
+                "safetensors_only": manifest["safetensors_only"],
+                "fetched_at": manifest["fetched_at"]
+            })
+        return entries
+
+    def status(self):
+        with self._lock:
+            tasks = {k: dict(v) for k, v in self.tasks.items()}
+        return {
+            "root": str(self.root),
+            "models": self.list(),
+            "prefetch": tasks,
+            "lpw_pipeline": str(LPW_PIPELINE_PATH) if LPW_PIPELINE_PATH.exists() else None,
+            "load_timings": dict(self.timings)
+        }
+
+    def load(self, pipeline_cls, model_name, **kwargs):
+        """Offline `from_pretrained` from the store, loading components one by one to time them.
+
+        Components passed in `kwargs` (pooled ones, safety_checker=None...) are not loaded.
+        """
+        import torch
+        from diffusers import ModelMixin
+        from diffusers.utils import is_accelerate_available
+
+        model_dir = self.model_dir(model_name)
+        index = json.loads((model_dir / "model_index.json").read_text())
+        use_safetensors = True if self.manifest(model_name).get("safetensors_only") else None
+        torch_dtype = kwargs.get("torch_dtype")
+        timings, components = {}, {}
+        started = time.perf_counter()
+
+        for name, spec in index.items():
+            if name.startswith("_") or name in kwargs or not isinstance(spec, list) or spec[0] is None:
+                continue
+            library, class_name = spec
+            try:
+                module = importlib.import_module(library)
+            except ImportError:
+                module = importlib.import_module(f"diffusers.pipelines.{library}")
+            component_cls = getattr(module, class_name)
+
+            load_kwargs = {"subfolder": name, "local_files_only": True}
+            if isinstance(component_cls, type) and issubclass(component_cls, torch.nn.Module):
+                load_kwargs.update(torch_dtype=torch_dtype, use_safetensors=use_safetensors)
+                if issubclass(component_cls, ModelMixin):
+                    load_kwargs["low_cpu_mem_usage"] = is_accelerate_available()
+            component_started = time.perf_counter()
+            components[name] = component_cls.from_pretrained(model_dir, **load_kwargs)
+            timings[name] = round(time.perf_counter() - component_started, 3)
+
+        assemble_started = time.perf_counter()
+        pipe = pipeline_cls.from_pretrained(model_dir, local_files_only=True, **components, **kwargs)
+        timings["pipeline"] = round(time.perf_counter() - assemble_started, 3)
+        timings["total"] = round(time.perf_counter() - started, 3)
+        self.timings[model_name] = timings
+        logger.info(f"📂 Loaded {model_name} from the model store: " + ", ".join(
+            f"{k} {v:.2f}s" for k, v in timings.items()
+        ))
+        return pipe
+
+
+def vendor_lpw(revision=None, dest=LPW_PIPELINE_PATH):
+    """Copy the LPW community pipeline matching the installed diffusers into the repo."""
+    import diffusers
+    from huggingface_hub import hf_hub_download
+
+    candidates = [revision] if revision else ["v" + ".".join(diffusers.__version__.split(".")[:3]), "main"]
+    for candidate in candidates:
+        try:
+            path = hf_hub_download(
+                COMMUNITY_PIPELINES_MIRROR, f"{candidate}/lpw_stable_diffusion.py", repo_type="dataset"
+            )
+            break
+        except Exception as e:
+            logger.warning(f"LPW pipeline {candidate} not available: {e}")
+    else:
+        raise RuntimeError("could not download the LPW community pipeline")
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(path, dest)
+    logger.info(f"✅ Vendored LPW pipeline ({candidate}) → {dest} (sha256 {sha256_file(dest)[:12]})")
+    return dest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="APIBR2 local model store")
+    parser.add_argument("--root", default=os.getenv("MODEL_STORE_DIR", "model_store"))
+    sub = parser.add_subparsers(dest="command", required=True)
+    prefetch = sub.add_parser("prefetch", help="download snapshots into the store")
+    prefetch.add_argument("models", nargs="+")
+    prefetch.add_argument("--revision")
+    verify = sub.add_parser("verify", help="re-check stored files against the manifest")
+    verify.add_argument("models", nargs="*")
+    imported = sub.add_parser("import", help="copy a local diffusers directory into the store")
+    imported.add_argument("model")
+    imported.add_argument("path")
+    lpw = sub.add_parser("vendor-lpw", help="vendor the LPW community pipeline")
+    lpw.add_argument("--revision")
+    sub.add_parser("list")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    store = ModelStore(args.root, token=os.getenv("HUGGINGFACE_HUB_TOKEN"))
+    if args.command == "prefetch":
+        for model in args.models:
+            store.prefetch(model, args.revision)
+    elif args.command == "verify":
+        results = [store.verify(m) for m in (args.models or [e["model"] for e in store.list()])]
+        print(json.dumps(results, indent=2))
+        sys.exit(0 if all(r["ok"] for r in results) else 1)
+    elif args.command == "import":
+        store.import_dir(args.model, args.path)
+    elif args.command == "vendor-lpw":
+        vendor_lpw(args.revision)
+    else:
+        print(json.dumps(store.list(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
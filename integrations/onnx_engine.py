@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - ONNX Runtime Engine
+Exports the text encoder, UNet and VAE decoder of an SD 1.x/2.x pipeline to
+ONNX once, keeps them in a local model cache and serves them through ONNX
+Runtime's CPU execution provider with full graph optimizations.
+"""
+
+import json
+import os
+import shutil
+import time
+import logging
+from pathlib import Path
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+ENGINES = ("torch", "onnx")
+ONNX_COMPONENTS = ("text_encoder", "unet", "vae_decoder")
+EXPORT_VERSION = 1
+OPSET = 17
+
+
+class _TextEncoder(torch.nn.Module):
+    def __init__(self, text_encoder):
+        super().__init__()
+        self.text_encoder = text_encoder
+
+    def forward(self, input_ids):
+        return self.text_encoder(input_ids, return_dict=False)[0]
+
+
+class _UNet(torch.nn.Module):
+    def __init__(self, unet):
+        super().__init__()
+        self.unet = unet
+
+    def forward(self, sample, timestep, encoder_hidden_states):
+        return self.unet(sample, timestep, encoder_hidden_states, return_dict=False)[0]
+
+
+class _VAEDecoder(torch.nn.Module):
+    def __init__(self, vae):
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, latent_sample):
+        return self.vae.decode(latent_sample, return_dict=False)[0]
+
+
+def onnx_model_dir(cache_root, model_name):
+    return Path(cache_root) / model_name.replace("/", "--")
+
+
+def is_exported(model_dir):
+    manifest = Path(model_dir) / "onnx_manifest.json"
+    if not manifest.exists():
+        return False
+    try:
+        return json.loads(manifest.read_text()).get("version") == EXPORT_VERSION
+    except ValueError:
+        return False
+
+
+def _export(module, args, path, input_names, output_names, dynamic_axes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with torch.inference_mode(False), torch.no_grad():
+        torch.onnx.export(
+            module,
+            args,
+            str(path),
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=OPSET,
+            do_constant_folding=True,
+            dynamo=False
+        )
+    # UNet weights exceed protobuf's 2 GB limit; keep every component's weights next to its graph
+    import onnx
+    model = onnx.load(str(path))
+    onnx.save_model(model, str(path), save_as_external_data=True, all_tensors_to_one_file=True, location="weights.pb")
+
+
+def export_pipeline(pipe, model_dir):
+    """Export a float32 torch SD pipeline into `model_dir` (atomically, via a temp dir)."""
+    model_dir = Path(model_dir)
+    tmp_dir = model_dir.with_name(f".{model_dir.name}.exporting")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    started = time.time()
+
+    text_encoder, unet, vae = pipe.text_encoder.float(), pipe.unet.float(), pipe.vae.float()
+    seq_len = pipe.tokenizer.model_max_length
+    hidden = text_encoder.config.hidden_size
+    latent_channels = unet.config.in_channels
+    latent = unet.config.sample_size
+
+    logger.info(f"📦 Exporting text encoder to ONNX...")
+    _export(
+        _TextEncoder(text_encoder).eval(),
+        (torch.zeros(1, seq_len, dtype=torch.int32),),
+        tmp_dir / "text_encoder" / "model.onnx",
+        ["input_ids"], ["last_hidden_state"],
+        {"input_ids": {0: "batch", 1: "sequence"}, "last_hidden_state": {0: "batch", 1: "sequence"}}
+    )
+    logger.info(f"📦 Exporting UNet to ONNX...")
+    _export(
+        _UNet(unet).eval(),
+        (
+            torch.randn(2, latent_channels, latent, latent),
+            torch.tensor([1.0, 1.0]),
+            torch.randn(2, seq_len, hidden)
+        ),
+        tmp_dir / "unet" / "model.onnx",
+        ["sample", "timestep", "encoder_hidden_states"], ["out_sample"],
+        {
+            "sample": {0: "batch", 2: "height", 3: "width"},
+            "timestep": {0: "batch"},
+            "encoder_hidden_states": {0: "batch", 1: "sequence"},
+            "out_sample": {0: "batch", 2: "height", 3: "width"}
+        }
+    )
+    logger.info(f"📦 Exporting VAE decoder to ONNX...")
+    _export(
+        _VAEDecoder(vae).eval(),
+        (torch.randn(1, vae.config.latent_channels, latent, latent),),
+        tmp_dir / "vae_decoder" / "model.onnx",
+        ["latent_sample"], ["sample"],
+        {"latent_sample": {0: "batch", 2: "height", 3: "width"}, "sample": {0: "batch", 2: "height", 3: "width"}}
+    )
+
+    pipe.tokenizer.save_pretrained(tmp_dir / "tokenizer")
+    pipe.scheduler.save_config(tmp_dir / "scheduler")
+    (tmp_dir / "onnx_manifest.json").write_text(json.dumps({
+        "version": EXPORT_VERSION,
+        "opset": OPSET,
+        "torch": torch.__version__,
+        "export_time": round(time.time() - started, 1)
+    }, indent=2))
+
+    shutil.rmtree(model_dir, ignore_errors=True)
+    os.replace(tmp_dir, model_dir)
+    logger.info(f"✅ ONNX export finished in {time.time() - started:.1f}s → {model_dir}")
+    return model_dir
+
+
+def session_options(intra_op_threads, inter_op_threads):
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL if inter_op_threads <= 1 else ort.ExecutionMode.ORT_PARALLEL
+    return options
+
+
+def load_onnx_pipeline(model_dir, intra_op_threads, inter_op_threads):
+    """Build a diffusers ONNX pipeline on CPUExecutionProvider from an exported model dir."""
+    from diffusers import DDIMScheduler, OnnxRuntimeModel, OnnxStableDiffusionPipeline
+    from transformers import CLIPTokenizer
+
+    model_dir = Path(model_dir)
+    options = session_options(intra_op_threads, inter_op_threads)
+    sessions = {
+        name: OnnxRuntimeModel(model=OnnxRuntimeModel.load_model(
+            model_dir / name / "model.onnx", provider="CPUExecutionProvider", sess_options=options
+        ))
+        for name in ONNX_COMPONENTS
+    }
+    pipe = OnnxStableDiffusionPipeline(
+        vae_encoder=None,
+        vae_decoder=sessions["vae_decoder"],
+        text_encoder=sessions["text_encoder"],
+        tokenizer=CLIPTokenizer.from_pretrained(model_dir / "tokenizer"),
+        unet=sessions["unet"],
+        scheduler=DDIMScheduler.from_pretrained(model_dir / "scheduler"),
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False
+    )
+    # Lets the model cache budget ORT-held weights like torch ones
+    pipe.external_nbytes = onnx_model_nbytes(model_dir)
+    return pipe
+
+
+def is_onnx_pipeline(pipe):
+    from diffusers import OnnxStableDiffusionPipeline
+    return isinstance(pipe, OnnxStableDiffusionPipeline)
+
+
+def initial_latents(seeds, width, height):
+    """Per-seed starting noise drawn exactly like the torch path, as numpy for ORT."""
+    shape = (1, 4, height // 8, width // 8)  # the ONNX SD pipeline assumes an 8x VAE
+    return torch.cat([
+        torch.randn(shape, generator=torch.Generator("cpu").manual_seed(seed))
+        for seed in seeds
+    ]).numpy().astype(np.float32)
+
+
+def onnx_model_nbytes(model_dir):
+    """Bytes of the exported graphs and weights on disk (their resident size once loaded)."""
+    return sum(p.stat().st_size for p in Path(model_dir).rglob("*") if p.is_file())
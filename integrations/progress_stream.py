@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - Generation Progress Streaming
+Fan-out of per-step diffusion progress (step, elapsed, ETA) to subscribers,
+plus cheap latent previews decoded with a linear latent-to-RGB approximation
+instead of the full VAE.
+"""
+
+import base64
+import inspect
+import threading
+import time
+import logging
+from io import BytesIO
+
+import torch
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Linear projection of SD 1.x/2.x VAE latents to RGB (good enough for thumbnails)
+LATENT_RGB_FACTORS = torch.tensor([
+    [0.298, 0.207, 0.208],
+    [0.187, 0.286, 0.173],
+    [-0.158, 0.189, 0.264],
+    [-0.184, -0.271, -0.473]
+])
+
+
+def latent_preview_base64(latents, max_size=128):
+    """Approximate RGB preview of one (4, h, w) latent as a base64 JPEG."""
+    if latents.dim() != 3 or latents.shape[0] != LATENT_RGB_FACTORS.shape[0]:
+        return None
+    rgb = torch.einsum("chw,cr->hwr", latents.detach().float().cpu(), LATENT_RGB_FACTORS)
+    rgb = ((rgb + 1.0) * 127.5).clamp(0, 255).to(torch.uint8).numpy()
+    image = Image.fromarray(rgb)
+    image.thumbnail((max_size, max_size))
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=70)
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+class ProgressHub:
+    """Routes step events of a running generation to every subscriber of its key.
+
+    Several callers can watch the same key (e.g. coalesced followers). Previews
+    are rendered lazily and at most once per step, only if a subscriber asks.
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, key, callback):
+        with self._lock:
+            self._subscribers.setdefault(key, []).append(callback)
+
+    def unsubscribe(self, key, callback):
+        with self._lock:
+            callbacks = self._subscribers.get(key, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self._subscribers.pop(key, None)
+
+    def has_subscribers(self, key):
+        with self._lock:
+            return bool(self._subscribers.get(key))
+
+    def publish(self, key, event, latents=None):
+        with self._lock:
+            callbacks = list(self._subscribers.get(key, []))
+        if not callbacks:
+            return
+
+        preview = {}
+
+        def render_preview():
+            if "image" not in preview:
+                preview["image"] = latent_preview_base64(latents) if latents is not None else None
+            return preview["image"]
+
+        for callback in callbacks:
+            try:
+                callback(event, render_preview)
+            except Exception as e:
+                logger.warning(f"Progress subscriber failed: {e}")
+
+
+class ProgressRelay:
+    """Stand-in for ProgressHub inside a worker process.
+
+    Every keyed step is forwarded through `emit((key, event, latents))` so the
+    parent can publish it on its own hub, where the subscribers live. Latents
+    travel as numpy arrays: pickled tensors would go through torch's shared
+    memory handles, which only work between processes of the same multiprocessing tree.
+    """
+
+    def __init__(self, emit):
+        self.emit = emit
+
+    def has_subscribers(self, key):
+        return key is not None
+
+    def publish(self, key, event, latents=None):
+        self.emit((key, event, latents.detach().float().cpu().numpy() if latents is not None else None))
+
+
+def step_callback_kwargs(pipe, keys, total_steps, hub):
+    """Pipeline kwargs that publish per-item progress for a batched call.
+
+    Supports both `callback_on_step_end` (current diffusers pipelines) and the
+    legacy `callback`/`callback_steps` pair used by the LPW community pipeline.
+    Returns {} when nobody is listening so the hot loop stays untouched.
+    """
+    if not any(hub.has_subscribers(key) for key in keys):
+        return {}
+
+    timing = {"start": time.time(), "first_step": None}
+
+    def on_step(step_index, latents):
+        if latents is not None and not isinstance(latents, torch.Tensor):
+            latents = torch.from_numpy(latents)  # ONNX pipelines hand out numpy latents
+        now = time.time()
+        done = step_index + 1
+        if timing["first_step"] is None or done == 1:
+            timing["first_step"] = now
+            per_step = now - timing["start"]
+        else:
+            per_step = (now - timing["first_step"]) / (done - 1)
+        event = {
+            "step": done,
+            "total_steps": total_steps,
+            "elapsed": round(now - timing["start"], 2),
+            "per_step": round(per_step, 3),
+            "eta": round(per_step * (total_steps - done), 2)
+        }
+        for index, key in enumerate(keys):
+            item_latents = latents[index] if latents is not None and index < latents.shape[0] else None
+            hub.publish(key, event, item_latents)
+
+    params = inspect.signature(pipe.__call__).parameters
+    if "callback_on_step_end" in params:
+        def callback_on_step_end(pipeline, step_index, timestep, callback_kwargs):
+            on_step(step_index, callback_kwargs.get("latents"))
+            return callback_kwargs
+        return {"callback_on_step_end": callback_on_step_end}
+
+    if "callback" in params:
+        def callback(step_index, timestep, latents):
+            on_step(step_index, latents)
+        return {"callback": callback, "callback_steps": 1}
+
+    return {}
+
+
+def step_function(pipe, callback_kwargs):
+    """Turn step_callback_kwargs() output into on_step(step_index, timestep, latents) for custom loops."""
+    if "callback_on_step_end" in callback_kwargs:
+        return lambda step_index, timestep, latents: callback_kwargs["callback_on_step_end"](
+            pipe, step_index, timestep, {"latents": latents}
+        )
+    if "callback" in callback_kwargs:
+        return callback_kwargs["callback"]
+    return None
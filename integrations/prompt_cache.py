@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - Prompt Embedding Cache
+Bounded LRU cache of text encoder outputs so repeated prompts, negative prompts
+and templates skip CLIP (and LPW weight parsing) on every request.
+"""
+
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_prompt(text):
+    """Collapse whitespace so trivially different spellings share an entry."""
+    return " ".join((text or "").split())
+
+
+def supports_prompt_embeds(pipe):
+    """Single-encoder torch SD pipelines (standard or LPW) accept precomputed embeddings."""
+    return (
+        isinstance(getattr(pipe, "text_encoder", None), torch.nn.Module)
+        and getattr(pipe, "tokenizer", None) is not None
+        and getattr(pipe, "text_encoder_2", None) is None
+    )
+
+
+def _encode_pair(pipe, prompt, negative_prompt, device):
+    """Run the pipeline's own encoder so LPW weighting is applied exactly as usual."""
+    from diffusers import StableDiffusionPipeline
+
+    with torch.no_grad():
+        if isinstance(pipe, StableDiffusionPipeline):
+            prompt_embeds, negative_embeds = pipe.encode_prompt(
+                prompt, device, 1, True, negative_prompt
+            )
+        else:
+            # LPW returns torch.cat([negative, positive]) padded to a common length
+            negative_embeds, prompt_embeds = pipe._encode_prompt(
+                prompt, device, 1, True, negative_prompt
+            ).chunk(2)
+    return prompt_embeds, negative_embeds
+
+
+class PromptEmbeddingCache:
+    """LRU of prompt / negative-prompt embeddings keyed by model, tokenizer and text.
+
+    Negative embeddings are keyed by sequence length too, because LPW pads them
+    to the length of the positive prompt they were encoded with. When `disk_dir`
+    is set, entries are also written as .npy files and reloaded on a memory miss.
+    """
+
+    def __init__(self, max_bytes, disk_dir=None):
+        self.max_bytes = int(max_bytes)
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0
+        }
+
+    def encode(self, pipe, model_name, prompts, negative_prompts):
+        """Return stacked (prompt_embeds, negative_prompt_embeds) for a batch.
+
+        Returns None when the pipeline cannot take embeddings or when LPW long
+        prompts in the batch ended up with different sequence lengths.
+        """
+        if not supports_prompt_embeds(pipe):
+            return None
+
+        device = pipe._execution_device
+        dtype = pipe.text_encoder.dtype
+        tokenizer_id = getattr(pipe.tokenizer, "name_or_path", "") or type(pipe.tokenizer).__name__
+
+        positives, negatives = [], []
+        for prompt, negative_prompt in zip(prompts, negative_prompts):
+            pos_key = (model_name, tokenizer_id, "prompt", normalize_prompt(prompt))
+            pos = self._get(pos_key)
+            neg = None
+            if pos is not None:
+                neg_key = (model_name, tokenizer_id, "negative", normalize_prompt(negative_prompt), pos.shape[1])
+                neg = self._get(neg_key)
+
+            if pos is None or neg is None:
+                pos, neg = _encode_pair(pipe, prompt, negative_prompt or "", device)
+                neg_key = (model_name, tokenizer_id, "negative", normalize_prompt(negative_prompt), pos.shape[1])
+                self._put(pos_key, pos)
+                self._put(neg_key, neg)
+
+            positives.append(pos)
+            negatives.append(neg)
+
+        if len({p.shape[1] for p in positives}) > 1:
+            return None
+
+        return (
+            torch.cat(positives).to(device, dtype),
+            torch.cat(negatives).to(device, dtype)
+        )
+
+    def _disk_path(self, key):
+        return self.disk_dir / f"{hashlib.sha1(repr(key).encode()).hexdigest()}.npy"
+
+    def _get(self, key):
+        with self._lock:
+            tensor = self._entries.get(key)
+            if tensor is not None:
+                self._entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return tensor
+
+        if self.disk_dir:
+            path = self._disk_path(key)
+            if path.exists():
+                try:
+                    tensor = torch.from_numpy(np.load(path))
+                    self._put(key, tensor, persist=False)
+                    with self._lock:
+                        self.counters["disk_hits"] += 1
+                    return tensor
+                except Exception as e:
+                    logger.warning(f"Could not read cached embedding {path.name}: {e}")
+
+        with self._lock:
+            self.counters["misses"] += 1
+        return None
+
+    def _put(self, key, tensor, persist=True):
+        # Kept on CPU in fp32 so entries survive model demotion and round-trip through numpy
+        tensor = tensor.detach().to("cpu", torch.float32)
+        nbytes = tensor.numel() * tensor.element_size()
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = tensor
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.numel() * evicted.element_size()
+                self.counters["evictions"] += 1
+
+        if persist and self.disk_dir:
+            try:
+                np.save(self._disk_path(key), tensor.numpy())
+            except Exception as e:
+                logger.warning(f"Could not spill embedding to disk: {e}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters["hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            hits = self.counters["hits"] + self.counters["disk_hits"]
+            return {
+                "entries": len(self._entries),
+                "memory_mb": round(self._bytes / 1024 ** 2, 2),
+                "max_memory_mb": round(self.max_bytes / 1024 ** 2, 2),
+                "disk_dir": str(self.disk_dir) if self.disk_dir else None,
+                **self.counters,
+                "hit_ratio": round(hits / lookups, 3) if lookups else None
+            }
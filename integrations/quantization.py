@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - CPU Weight Quantization
+int8 quantization of the text encoder and UNet linear layers for CPU-served
+pipelines, with the quantized state dicts cached on disk so later loads skip
+re-quantization, plus the similarity metrics used to benchmark it against fp32.
+"""
+
+import hashlib
+import time
+import logging
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from component_pool import files_fingerprint, weights_fingerprint
+
+logger = logging.getLogger(__name__)
+
+QUANTIZATION_MODES = ("none", "int8-dynamic", "int8-weight-only")
+QUANTIZED_COMPONENTS = ("text_encoder", "unet")
+
+
+class Int8WeightOnlyLinear(torch.nn.Module):
+    """Linear layer storing int8 weights with a per-output-channel scale.
+
+    Weights are dequantized to the activation dtype on every call: RAM for the
+    weights drops 4x versus fp32, compute stays in floating point.
+    """
+
+    def __init__(self, in_features, out_features, bias=True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("weight_int8", torch.zeros(out_features, in_features, dtype=torch.int8))
+        self.register_buffer("weight_scale", torch.ones(out_features, dtype=torch.float32))
+        self.bias = torch.nn.Parameter(torch.zeros(out_features)) if bias else None
+
+    @classmethod
+    def from_float(cls, linear):
+        module = cls(linear.in_features, linear.out_features, bias=linear.bias is not None)
+        weight = linear.weight.detach().float()
+        scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127.0
+        module.weight_int8.copy_(torch.round(weight / scale[:, None]).clamp(-127, 127).to(torch.int8))
+        module.weight_scale.copy_(scale)
+        if linear.bias is not None:
+            module.bias.data.copy_(linear.bias.detach().float())
+        return module
+
+    def forward(self, x):
+        weight = self.weight_int8.to(x.dtype) * self.weight_scale.to(x.dtype)[:, None]
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        return F.linear(x, weight, bias)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}"
+
+
+def _replace_linears(module, factory):
+    """Swap every nn.Linear below `module` for `factory(linear)` in place."""
+    for name, child in module.named_children():
+        if isinstance(child, torch.nn.Linear):
+            setattr(module, name, factory(child))
+        else:
+            _replace_linears(child, factory)
+    return module
+
+
+def is_quantized(module):
+    return any(
+        isinstance(m, Int8WeightOnlyLinear) or hasattr(m, "_packed_params")
+        for m in module.modules()
+    )
+
+
+def quantize_module(module, mode):
+    """Quantize the linear layers of a float module in place (eval mode, CPU)."""
+    module.eval()
+    if mode == "int8-dynamic":
+        from torch.ao.quantization import quantize_dynamic
+        return quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    if mode == "int8-weight-only":
+        return _replace_linears(module, Int8WeightOnlyLinear.from_float)
+    raise ValueError(f"quantization must be one of: {', '.join(QUANTIZATION_MODES)}")
+
+
+def quantized_skeleton(module, mode):
+    """Replace linears with empty quantized layers, ready for a cached state dict."""
+    if mode == "int8-dynamic":
+        import torch.ao.nn.quantized.dynamic as nnqd
+        return _replace_linears(module, lambda l: nnqd.Linear(
+            l.in_features, l.out_features, bias_=l.bias is not None, dtype=torch.qint8
+        ))
+    return _replace_linears(module, lambda l: Int8WeightOnlyLinear(
+        l.in_features, l.out_features, bias=l.bias is not None
+    ))
+
+
+class QuantizedWeightCache:
+    """On-disk cache of quantized component state dicts.
+
+    Keyed by the Hugging Face blob names of the source weights when the model is
+    in the hub cache (cheap), else by a content hash of the float weights.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.counters = {"hits": 0, "misses": 0}
+
+    def _path(self, model_name, component_name, component, mode):
+        source = files_fingerprint(model_name, component_name) or weights_fingerprint(component)
+        digest = hashlib.sha1(f"{source}:{mode}:{torch.__version__}".encode()).hexdigest()[:16]
+        safe_name = model_name.replace("/", "--")
+        return self.cache_dir / f"{safe_name}-{component_name}-{mode}-{digest}.pt"
+
+    def quantize(self, module, model_name, component_name, mode):
+        """Quantize `module` in place, loading the result from disk when cached."""
+        if is_quantized(module):
+            return module
+        path = self._path(model_name, component_name, module, mode)
+        started = time.time()
+        state_dict = None
+        if path.exists():
+            try:
+                state_dict = torch.load(path, map_location="cpu", weights_only=True)
+            except Exception as e:
+                logger.warning(f"Quantized cache entry {path.name} unreadable ({e}); re-quantizing")
+        if state_dict is not None:
+            quantized_skeleton(module, mode).load_state_dict(state_dict)
+            self.counters["hits"] += 1
+            logger.info(f"⚡ Loaded cached {mode} {component_name} for {model_name} ({time.time() - started:.1f}s)")
+            return module.eval()
+        self.counters["misses"] += 1
+        quantize_module(module, mode)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        torch.save(module.state_dict(), tmp_path)
+        tmp_path.replace(path)
+        logger.info(f"🗜️ Quantized {component_name} of {model_name} to {mode} ({time.time() - started:.1f}s)")
+        return module
+
+    def stats(self):
+        entries = list(self.cache_dir.glob("*.pt"))
+        return {
+            "dir": str(self.cache_dir),
+            "entries": len(entries),
+            "size_mb": round(sum(p.stat().st_size for p in entries) / 1024 ** 2, 1),
+            **self.counters
+        }
+
+
+def quantize_pipeline(pipe, model_name, mode, cache):
+    """Quantize the text encoder and UNet of a CPU pipeline; returns component names touched."""
+    done = []
+    for name in QUANTIZED_COMPONENTS:
+        module = getattr(pipe, name, None)
+        if isinstance(module, torch.nn.Module):
+            cache.quantize(module, model_name, name, mode)
+            done.append(name)
+    return done
+
+
+def image_similarity(reference, candidate):
+    """PSNR (dB) and mean SSIM (7x7 windows, luma) between two PIL images."""
+    a = np.asarray(reference.convert("L"), dtype=np.float64)
+    b = np.asarray(candidate.convert("L").resize(reference.size), dtype=np.float64)
+    mse = np.mean((a - b) ** 2)
+    psnr = float("inf") if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+    def window_mean(x, k=7):
+        c = np.cumsum(np.cumsum(np.pad(x, ((1, 0), (1, 0))), axis=0), axis=1)
+        return (c[k:, k:] - c[:-k, k:] - c[k:, :-k] + c[:-k, :-k]) / (k * k)
+
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mu_a, mu_b = window_mean(a), window_mean(b)
+    var_a = window_mean(a * a) - mu_a ** 2
+    var_b = window_mean(b * b) - mu_b ** 2
+    cov = window_mean(a * b) - mu_a * mu_b
+    ssim = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return {"psnr_db": round(float(psnr), 2), "ssim": round(float(ssim.mean()), 4)}
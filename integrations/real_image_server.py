@@ -5,7 +5,7 @@ Servidor FastAPI para geração real de imagens com Stable Diffusion
 """
 
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from pathlib import Path
@@ -14,10 +14,13 @@ import torch
 import uuid
 import time
 import os
-import base64
 import logging
 from datetime import datetime
 
+from image_responses import (
+    RESPONSE_FORMATS, encode_image, image_encoder, metadata_headers, with_image_payload
+)
+
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -48,6 +51,7 @@ class ImageRequest(BaseModel):
     width: int = 1024
     height: int = 1024
     size: str = "1024x1024"
+    response_format: str = "base64"  # base64, url, binary
 
 def get_pipe(model_name):
     """Carrega o pipeline do modelo (com cache)"""
@@ -94,6 +98,8 @@ def health_check():
 @app.post("/generate")
 def generate_image(req: ImageRequest):
     """Endpoint para geração real de imagem"""
+    if req.response_format not in RESPONSE_FORMATS:
+        raise HTTPException(status_code=422, detail=f"response_format must be one of: {', '.join(RESPONSE_FORMATS)}")
     try:
         logger.info(f"Generating image with model: {req.model}, prompt: {req.prompt}")
         
@@ -121,17 +127,14 @@ def generate_image(req: ImageRequest):
         filename = f"{model_short_name}_{timestamp}_{uuid.uuid4().hex[:8]}.png"
         filepath = OUT_DIR / filename
         
-        image.save(filepath)
-        logger.info(f"Image saved: {filepath}")
+        # Codificar uma vez em memória; a gravação em disco roda em background
+        image_bytes = encode_image(image)
+        image_encoder.write(filepath, image_bytes)
+        logger.info(f"Image encoded: {filepath}")
         
-        # Converter para base64
-        with open(filepath, "rb") as image_file:
-            image_base64 = base64.b64encode(image_file.read()).decode('utf-8')
-        
-        return {
+        response = {
             "success": True,
             "data": {
-                "image_base64": image_base64,
                 "image_url": f"http://apibr.giesel.com.br/images/{filename}",
                 "local_path": str(filepath),
                 "prompt": req.prompt,
@@ -148,6 +151,14 @@ def generate_image(req: ImageRequest):
             }
         }
         
+        if req.response_format == "binary":
+            return Response(
+                content=image_bytes,
+                media_type="image/png",
+                headers=metadata_headers(response["metadata"], response["data"]["image_url"])
+            )
+        return with_image_payload(response, image_bytes, req.response_format)
+        
     except Exception as e:
         logger.error(f"Error generating image: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -181,6 +192,9 @@ def serve_image(filename: str):
     """Servir imagens geradas"""
     try:
         filepath = OUT_DIR / filename
+        pending = image_encoder.pending(filepath)
+        if pending is not None:
+            return Response(content=pending, media_type='image/png')
         if filepath.exists():
             return FileResponse(filepath, media_type='image/png')
         else:
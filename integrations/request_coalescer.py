@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - In-flight Request Coalescing
+Single-flight helper: while a request with a given key is running, identical
+requests attach to it and receive its result instead of starting a new run.
+"""
+
+import threading
+import logging
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT_POLICIES = ("run", "fail")
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.followers = 0
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Deduplicate concurrent calls sharing a key.
+
+    Followers wait up to `follower_timeout` seconds. On timeout the policy
+    decides: "run" starts an independent run, "fail" raises a 504.
+    """
+
+    def __init__(self, follower_timeout=300.0, timeout_policy="run"):
+        if timeout_policy not in TIMEOUT_POLICIES:
+            raise ValueError(f"timeout_policy must be one of: {', '.join(TIMEOUT_POLICIES)}")
+        self.follower_timeout = float(follower_timeout)
+        self.timeout_policy = timeout_policy
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.counters = {"leaders": 0, "followers": 0, "follower_timeouts": 0}
+
+    def run(self, key, fn, on_follow=None):
+        """Return (result, role, followers) where role is "leader" or "follower".
+
+        `on_follow()` is called before a follower starts waiting on the leader.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.counters["leaders"] += 1
+                leader = True
+            else:
+                flight.followers += 1
+                self.counters["followers"] += 1
+                leader = False
+
+        if leader:
+            try:
+                flight.result = fn()
+            except BaseException as e:
+                flight.error = e
+                raise
+            finally:
+                with self._lock:
+                    self._flights.pop(key, None)
+                flight.done.set()
+            return flight.result, "leader", flight.followers
+
+        logger.info(f"🔗 Attached to in-flight request {key[:12]} ({flight.followers} follower(s))")
+        if on_follow is not None:
+            on_follow()
+        if not flight.done.wait(self.follower_timeout):
+            with self._lock:
+                self.counters["follower_timeouts"] += 1
+            if self.timeout_policy == "fail":
+                raise HTTPException(status_code=504, detail="Timed out waiting for identical in-flight request")
+            logger.warning(f"⏱️ Follower timed out on {key[:12]}; running independently")
+            return fn(), "independent", 0
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.result, "follower", flight.followers
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._flights),
+                "follower_timeout_s": self.follower_timeout,
+                "timeout_policy": self.timeout_policy,
+                **self.counters
+            }
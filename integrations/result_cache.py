@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - Generation Result Cache
+Content-addressed, size-bounded on-disk store for finished images, keyed by a
+canonical hash of every parameter that determines the output.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+CACHE_MODES = ("bypass", "prefer", "only")
+
+
+def generation_key(params):
+    """Canonical hash of generation parameters (order and float formatting independent)."""
+    canonical = json.dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResultStore:
+    """Sharded content store (`root/ab/cd/<key>.<ext>`) with LRU eviction by total size.
+
+    Access order is persisted through file mtimes, so the LRU order survives restarts.
+    Each entry has a JSON sidecar with the metadata of the run that produced it.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = int(max_bytes)
+        self._index = OrderedDict()  # key -> (data path, total bytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self._load_index()
+
+    def _shard(self, key):
+        return self.root / key[:2] / key[2:4]
+
+    def _load_index(self):
+        entries = []
+        for meta_path in self.root.glob("*/*/*.json"):
+            key = meta_path.stem
+            data_paths = [p for p in meta_path.parent.glob(f"{key}.*") if p.suffix != ".json"]
+            if not data_paths:
+                continue
+            size = data_paths[0].stat().st_size + meta_path.stat().st_size
+            entries.append((data_paths[0].stat().st_mtime, key, data_paths[0], size))
+        for _, key, data_path, size in sorted(entries):
+            self._index[key] = (data_path, size)
+            self._bytes += size
+        if entries:
+            logger.info(f"🗄️ Result cache: {len(entries)} entries ({self._bytes / 1024 ** 2:.1f} MB)")
+
+    def get(self, key):
+        """Return (bytes, metadata) for a stored result, or None."""
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self._index.move_to_end(key)
+            self.counters["hits"] += 1
+        data_path = entry[0]
+        try:
+            data = data_path.read_bytes()
+            metadata = json.loads(data_path.with_suffix(".json").read_text())
+            os.utime(data_path)
+            return data, metadata
+        except OSError as e:
+            logger.warning(f"Result cache entry {key} unreadable: {e}")
+            self._drop(key)
+            return None
+
+    def put(self, key, data, extension, metadata):
+        """Store bytes atomically under `key` and evict LRU entries past the budget."""
+        shard = self._shard(key)
+        shard.mkdir(parents=True, exist_ok=True)
+        data_path = shard / f"{key}.{extension}"
+        meta_path = shard / f"{key}.json"
+        meta_bytes = json.dumps(metadata, default=str).encode()
+
+        for path, payload in ((data_path, data), (meta_path, meta_bytes)):
+            tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{time.time_ns()}.tmp")
+            tmp_path.write_bytes(payload)
+            os.replace(tmp_path, path)
+
+        size = len(data) + len(meta_bytes)
+        with self._lock:
+            previous = self._index.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._index[key] = (data_path, size)
+            self._bytes += size
+            self.counters["stores"] += 1
+            evicted = []
+            while self._bytes > self.max_bytes and len(self._index) > 1:
+                _, (old_path, old_size) = self._index.popitem(last=False)
+                self._bytes -= old_size
+                self.counters["evictions"] += 1
+                evicted.append(old_path)
+
+        for old_path in evicted:
+            for path in (old_path, old_path.with_suffix(".json")):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+
+    def path_for(self, key):
+        with self._lock:
+            entry = self._index.get(key)
+        return entry[0] if entry else None
+
+    def _drop(self, key):
+        with self._lock:
+            entry = self._index.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters["hits"] + self.counters["misses"]
+            return {
+                "entries": len(self._index),
+                "size_mb": round(self._bytes / 1024 ** 2, 2),
+                "max_size_mb": round(self.max_bytes / 1024 ** 2, 2),
+                **self.counters,
+                "hit_ratio": round(self.counters["hits"] / lookups, 3) if lookups else None
+            }
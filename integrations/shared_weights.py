@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - Shared Model Weights
+Moves the parameters and buffers of CPU pipeline components into flat weight
+files that every process maps with MAP_SHARED, so local workers serving the
+same model share one physical copy of the read-only weights via the page cache.
+Components quantized with int8-dynamic keep their linear weights in opaque
+packed params that cannot be mapped, so they are reported as not shared.
+
+Prove it on a host with:
+    python shared_weights.py --self-check --workers 3 --quantization all
+"""
+
+import argparse
+import contextlib
+import ctypes
+import gc
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import logging
+from pathlib import Path
+
+import psutil
+import torch
+
+from component_pool import files_fingerprint, weights_fingerprint
+from quantization import QUANTIZATION_MODES, quantize_module, quantized_skeleton
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 ** 2
+ALIGNMENT = 64
+SHARED_COMPONENTS = ("text_encoder", "unet", "vae")
+
+
+def _tensors(module):
+    """(module, attr, kind, tensor) for every parameter and buffer slot, tied slots included."""
+    for sub in module.modules():
+        for attr, tensor in sub._parameters.items():
+            if tensor is not None:
+                yield sub, attr, "param", tensor
+        for attr, tensor in sub._buffers.items():
+            if tensor is not None:
+                yield sub, attr, "buffer", tensor
+
+
+def _memory_order(tensor):
+    """A 1-D view of a dense tensor in storage order, plus the stride to rebuild it."""
+    if tensor.is_contiguous() or tensor.is_contiguous(memory_format=torch.channels_last):
+        flat = torch.as_strided(tensor, (tensor.numel(),), (1,), tensor.storage_offset())
+        return flat, tuple(tensor.stride())
+    tensor = tensor.contiguous()
+    return tensor.reshape(-1), tuple(tensor.stride())
+
+
+def module_layout(module):
+    """Unique tensors (by identity) with dtype/shape/stride; defines the weight file format."""
+    seen, layout = set(), []
+    for index, (_, _, kind, tensor) in enumerate(_tensors(module)):
+        if id(tensor) in seen:
+            continue
+        seen.add(id(tensor))
+        _, stride = _memory_order(tensor.detach())
+        layout.append({
+            "index": index,
+            "kind": kind,
+            "dtype": str(tensor.dtype).replace("torch.", ""),
+            "shape": list(tensor.shape),
+            "stride": list(stride)
+        })
+    return layout
+
+
+def packed_layers(module):
+    """Submodules whose weights live in packed params (int8-dynamic linears) rather than tensors."""
+    return sum(isinstance(getattr(sub, "_packed_params", None), torch.ScriptObject) for sub in module.modules())
+
+
+def is_shared(module):
+    return getattr(module, "_shared_weights_path", None) is not None
+
+
+def process_memory(pid=None):
+    """RSS / unique / proportional / shared memory (MB) of a process."""
+    try:
+        info = psutil.Process(pid).memory_full_info()
+    except (psutil.Error, AttributeError):
+        return None
+    return {
+        "pid": pid or os.getpid(),
+        "rss_mb": round(info.rss / MB, 1),
+        "uss_mb": round(getattr(info, "uss", 0) / MB, 1),
+        "pss_mb": round(getattr(info, "pss", 0) / MB, 1),
+        "shared_mb": round(getattr(info, "shared", 0) / MB, 1)
+    }
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    """Inter-process exclusive lock (no-op where fcntl is unavailable)."""
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def release_freed_memory():
+    """Hand freed private weight copies back to the OS (glibc keeps them otherwise)."""
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class SharedWeightStore:
+    """Directory of flat weight files (64-byte aligned tensors) mapped into every process.
+
+    Entries are keyed by the source weights (Hugging Face blob names, else a
+    content hash) plus the tensor layout, so dtype, quantization and memory
+    format changes get their own file. The first process writes an entry
+    under a file lock, the others wait for it and map it.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._mapped = {}  # path -> bytes mapped by this process
+        self.counters = {"written": 0, "attached": 0}
+        self.not_shared = {}  # source -> reason the module kept private weights
+
+    def _path(self, source, layout):
+        digest = hashlib.sha1(json.dumps([source, layout]).encode()).hexdigest()[:16]
+        return self.root / f"{digest}.weights"
+
+    def share_module(self, module, source):
+        """Swap a module's tensors for mapped ones, writing the weight file if needed."""
+        if is_shared(module):
+            return False
+        packed = packed_layers(module)
+        if packed:
+            # Mapping only the plain tensors would leave most of the weights private
+            reason = f"{packed} int8-dynamic layers hold their weights in packed params"
+            with self._lock:
+                self.not_shared[source] = reason
+            logger.warning(f"⚠️ Not sharing weights of {source}: {reason}")
+            return False
+        layout = module_layout(module)
+        path = self._path(source, layout)
+        with self._lock, _file_lock(self.root / ".lock"):
+            if not path.exists():
+                self._write(module, layout, path)
+            self._attach(module, path)
+        return True
+
+    def _write(self, module, layout, path):
+        started = time.time()
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        slots = list(_tensors(module))
+        offset = 0
+        with open(tmp_path, "wb") as f:
+            for entry in layout:
+                flat, _ = _memory_order(slots[entry["index"]][3].detach().cpu())
+                pad = -offset % ALIGNMENT
+                f.write(b"\0" * pad)
+                offset += pad
+                entry["offset"] = offset
+                data = flat.view(torch.uint8).numpy() if flat.numel() else b""
+                f.write(data)
+                offset += flat.numel() * flat.element_size()
+        path.with_suffix(".json").write_text(json.dumps({"bytes": offset, "tensors": layout}))
+        os.replace(tmp_path, path)
+        self.counters["written"] += 1
+        logger.info(f"💾 Wrote shared weights {path.name} ({offset / MB:.0f} MB, {time.time() - started:.1f}s)")
+
+    def _attach(self, module, path):
+        index = json.loads(path.with_suffix(".json").read_text())
+        nbytes = index["bytes"]
+        storage = torch.UntypedStorage.from_file(str(path), shared=True, nbytes=nbytes)
+
+        mapped = {}
+        slots = list(_tensors(module))
+        for entry in index["tensors"]:
+            dtype = getattr(torch, entry["dtype"])
+            itemsize = torch.empty(0, dtype=dtype).element_size()
+            original = slots[entry["index"]][3]
+            mapped[id(original)] = torch.empty(0, dtype=dtype).set_(
+                storage, entry["offset"] // itemsize, entry["shape"], entry["stride"]
+            )
+
+        # Every slot pointing at a tensor (tied weights too) gets the mapped copy
+        for sub, attr, kind, tensor in slots:
+            shared = mapped[id(tensor)]
+            if kind == "param":
+                sub._parameters[attr] = torch.nn.Parameter(shared, requires_grad=False)
+            else:
+                sub._buffers[attr] = shared
+
+        module._shared_weights_path = str(path)
+        self._mapped[str(path)] = nbytes
+        self.counters["attached"] += 1
+
+    def share_pipeline(self, pipe, model_name):
+        """Map the torch components of a CPU pipeline; returns the component names shared."""
+        shared = []
+        for name in SHARED_COMPONENTS:
+            module = getattr(pipe, name, None)
+            if not isinstance(module, torch.nn.Module) or is_shared(module):
+                continue
+            source = files_fingerprint(model_name, name) or weights_fingerprint(module)
+            if self.share_module(module, f"{model_name}/{name}:{source}"):
+                shared.append(name)
+        if shared:
+            release_freed_memory()
+        return shared
+
+    def stats(self):
+        with self._lock:
+            files = list(self.root.glob("*.weights"))
+            return {
+                "dir": str(self.root),
+                "files": len(files),
+                "size_mb": round(sum(p.stat().st_size for p in files) / MB, 1),
+                "mapped_mb": round(sum(self._mapped.values()) / MB, 1),
+                "not_shared": dict(self.not_shared),
+                **self.counters
+            }
+
+
+def _self_check_worker(args):
+    """Child of --self-check: map (or privately copy) the test model, touch it, report memory growth."""
+    root, mode, quantization, size_mb, results, barrier = args
+    if mode == "shared":
+        _meta_model(1, quantization)  # the first meta module loads ~35 MB of torch kernels; keep it out of the delta
+    before = process_memory()
+    if mode == "shared":
+        module = _meta_model(size_mb, quantization)
+        store = SharedWeightStore(root)
+        store.share_module(module, f"self-check:{quantization}")
+    else:
+        module = _test_model(size_mb, quantization)
+    with torch.no_grad():
+        checksum = _checksum(module)
+    # Measure once every sibling has touched its copy, or pages only this one mapped yet count as private
+    barrier.wait(600)
+    after = process_memory()
+    results.put({
+        "mode": mode,
+        "checksum": checksum,
+        **{f"{k}_delta": round(after[k] - before[k], 1) for k in ("rss_mb", "uss_mb", "pss_mb")}
+    })
+    barrier.wait(600)  # Stay alive while the siblings measure, so their PSS sees the pages shared
+
+
+def _checksum(module):
+    """Sum of every weight, in small chunks so int8 tensors are not copied to float in one go."""
+    return float(sum(
+        chunk.float().sum() for t in module.state_dict().values() for chunk in t.reshape(-1).split(1 << 16)
+    ))
+
+
+def _meta_model(size_mb, quantization):
+    """Storage-less skeleton of `_test_model`, ready to have the mapped weights attached."""
+    with torch.device("meta"):
+        module = _test_model(size_mb)
+        return module if quantization == "none" else quantized_skeleton(module, quantization)
+
+
+def _test_model(size_mb, quantization="none"):
+    """fp32 stack of `size_mb` of linears, quantized like the server would with `quantization`."""
+    layers = max(int(size_mb * MB // (4 * 1024 * 1024)), 1)
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(*[torch.nn.Linear(1024, 1024, bias=False) for _ in range(layers)])
+    return model if quantization == "none" else quantize_module(model, quantization)
+
+
+def self_check(workers=3, size_mb=256, root=None, tolerance=0.25, quantization="none"):
+    """Start `workers` processes mapping one model and compare with private copies.
+
+    Passes when the workers' proportional memory growth adds up to about one
+    model copy (within `tolerance`) and no worker holds a private copy. For
+    int8-dynamic, which cannot be mapped, it passes when sharing is refused.
+    """
+    import multiprocessing
+    import tempfile
+
+    root = root or tempfile.mkdtemp(prefix="apibr2-shared-weights-")
+    store = SharedWeightStore(root)
+    if not store.share_module(_test_model(size_mb, quantization), f"self-check:{quantization}"):
+        return {"quantization": quantization, "shared": False, "passed": quantization == "int8-dynamic", **store.stats()}
+    model_mb = store.stats()["mapped_mb"]
+
+    ctx = multiprocessing.get_context("spawn")
+    report = {}
+    for mode in ("shared", "private"):
+        results, barrier = ctx.Queue(), ctx.Barrier(workers)
+        procs = [
+            ctx.Process(target=_self_check_worker, args=((root, mode, quantization, size_mb, results, barrier),))
+            for _ in range(workers)
+        ]
+        for p in procs:
+            p.start()
+        rows = [results.get(timeout=600) for _ in procs]
+        for p in procs:
+            p.join()
+        report[mode] = {
+            "workers": rows,
+            "total_pss_growth_mb": round(sum(r["pss_mb_delta"] for r in rows), 1),
+            "max_uss_growth_mb": max(r["uss_mb_delta"] for r in rows)
+        }
+
+    shared = report["shared"]
+    checksums = {round(r["checksum"], 3) for mode in report.values() for r in mode["workers"]}
+    passed = (
+        shared["total_pss_growth_mb"] <= model_mb * (1 + tolerance)
+        and shared["max_uss_growth_mb"] <= model_mb * tolerance
+        and len(checksums) == 1  # mapped weights are bit-identical to a private load
+    )
+    return {"quantization": quantization, "model_mb": model_mb, "workers": workers, "passed": passed, **report}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="APIBR2 shared model weights")
+    parser.add_argument("--self-check", action="store_true", help="prove N workers share one copy of the weights")
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--dir", default=None)
+    parser.add_argument("--quantization", choices=QUANTIZATION_MODES + ("all",), default="none")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.self_check:
+        modes = QUANTIZATION_MODES if args.quantization == "all" else (args.quantization,)
+        results = [self_check(args.workers, args.size_mb, args.dir, quantization=mode) for mode in modes]
+        print(json.dumps(results if len(results) > 1 else results[0], indent=2))
+        sys.exit(0 if all(r["passed"] for r in results) else 1)
+    parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - Super-Resolution Upscaler
+Pluggable 2x/4x upscalers (Lanczos, ESRGAN-class RRDB networks, the SD x4
+latent upscaler) run over overlapping input tiles. Tiles are handed out through
+a submit callback so a shared batcher can push tiles of several jobs through
+the network together, and each finished tile is written straight into the
+output buffer, so peak memory is the output image plus the tiles in flight.
+"""
+
+import logging
+from collections import deque
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+UPSCALE_FACTORS = (2, 4)
+UPSCALER_MODELS = ("lanczos", "esrgan", "sd-x4")
+
+
+def _axis_spans(size, tile, overlap):
+    """(start, end, own_start, own_end) windows along one axis.
+
+    Windows are `tile` long (the last one flush with the edge) and overlap by at least
+    `overlap`; each owns the pixels up to the middle of its overlaps, so every output
+    pixel comes from the window where it is furthest from an edge.
+    """
+    if size <= tile:
+        return [(0, size, 0, size)]
+    stride = max(tile - overlap, 1)
+    starts = list(range(0, size - tile, stride)) + [size - tile]
+    bounds = [0] + [(nxt + start + tile) // 2 for start, nxt in zip(starts, starts[1:])] + [size]
+    return [(start, start + tile, bounds[i], bounds[i + 1]) for i, start in enumerate(starts)]
+
+
+def tile_plan(width, height, tile, overlap):
+    """[(window, owned)] boxes as (left, top, right, bottom) in input pixels, row by row."""
+    return [
+        ((left, top, right, bottom), (own_left, own_top, own_right, own_bottom))
+        for top, bottom, own_top, own_bottom in _axis_spans(height, tile, overlap)
+        for left, right, own_left, own_right in _axis_spans(width, tile, overlap)
+    ]
+
+
+def upscale_tiled(image, scale, tile, overlap, submit, max_inflight=8):
+    """Upscale a PIL image tile by tile; `submit(tile_array)` returns a Future of the upscaled tile.
+
+    At most `max_inflight` tiles are queued at once; results are copied into the
+    preallocated uint8 output as they complete.
+    """
+    array = np.asarray(image.convert("RGB"))
+    height, width = array.shape[:2]
+    output = np.empty((height * scale, width * scale, 3), dtype=np.uint8)
+    pending = deque()
+
+    def _drain(limit):
+        while len(pending) > limit:
+            future, (left, top, _, _), (own_left, own_top, own_right, own_bottom) = pending.popleft()
+            upscaled = future.result()
+            output[own_top * scale:own_bottom * scale, own_left * scale:own_right * scale] = upscaled[
+                (own_top - top) * scale:(own_bottom - top) * scale,
+                (own_left - left) * scale:(own_right - left) * scale
+            ]
+
+    for window, owned in tile_plan(width, height, tile, overlap):
+        left, top, right, bottom = window
+        pending.append((submit(array[top:bottom, left:right]), window, owned))
+        _drain(max_inflight - 1)
+    _drain(0)
+    return Image.fromarray(output)
+
+
+def _resize_tiles(tiles, height, width):
+    return np.stack([np.asarray(Image.fromarray(t).resize((width, height), Image.LANCZOS)) for t in tiles])
+
+
+class Upscaler:
+    """Upscaler plug-in: `upscale` turns an N x H x W x 3 uint8 batch into N x sH x sW x 3.
+
+    `native_scale` is the factor the model produces (None: any); other factors are
+    reached by resizing its output. `default_tile` is the input tile size it is
+    comfortable with.
+    """
+
+    name = "base"
+    native_scale = None
+    default_tile = 512
+
+    def upscale(self, tiles, scale, prompts=None, seeds=None):
+        raise NotImplementedError
+
+    def _to_scale(self, upscaled, tiles, scale):
+        height, width = tiles.shape[1] * scale, tiles.shape[2] * scale
+        if upscaled.shape[1:3] == (height, width):
+            return upscaled
+        return _resize_tiles(upscaled, height, width)
+
+
+class LanczosUpscaler(Upscaler):
+    """Plain Lanczos resampling; no weights, used when no model is configured."""
+
+    name = "lanczos"
+
+    def upscale(self, tiles, scale, prompts=None, seeds=None):
+        return _resize_tiles(tiles, tiles.shape[1] * scale, tiles.shape[2] * scale)
+
+
+class ResidualDenseBlock(nn.Module):
+    def __init__(self, num_feat=64, num_grow_ch=32):
+        super().__init__()
+        self.conv1 = nn.Conv2d(num_feat, num_grow_ch, 3, 1, 1)
+        self.conv2 = nn.Conv2d(num_feat + num_grow_ch, num_grow_ch, 3, 1, 1)
+        self.conv3 = nn.Conv2d(num_feat + 2 * num_grow_ch, num_grow_ch, 3, 1, 1)
+        self.conv4 = nn.Conv2d(num_feat + 3 * num_grow_ch, num_grow_ch, 3, 1, 1)
+        self.conv5 = nn.Conv2d(num_feat + 4 * num_grow_ch, num_feat, 3, 1, 1)
+        self.lrelu = nn.LeakyReLU(negative_slope=0.2, inplace=True)
+
+    def forward(self, x):
+        x1 = self.lrelu(self.conv1(x))
+        x2 = self.lrelu(self.conv2(torch.cat((x, x1), 1)))
+        x3 = self.lrelu(self.conv3(torch.cat((x, x1, x2), 1)))
+        x4 = self.lrelu(self.conv4(torch.cat((x, x1, x2, x3), 1)))
+        x5 = self.conv5(torch.cat((x, x1, x2, x3, x4), 1))
+        return x5 * 0.2 + x
+
+
+class RRDB(nn.Module):
+    def __init__(self, num_feat, num_grow_ch=32):
+        super().__init__()
+        self.rdb1 = ResidualDenseBlock(num_feat, num_grow_ch)
+        self.rdb2 = ResidualDenseBlock(num_feat, num_grow_ch)
+        self.rdb3 = ResidualDenseBlock(num_feat, num_grow_ch)
+
+    def forward(self, x):
+        return self.rdb3(self.rdb2(self.rdb1(x))) * 0.2 + x
+
+
+class RRDBNet(nn.Module):
+    """ESRGAN / Real-ESRGAN generator; parameter names match the published checkpoints."""
+
+    def __init__(self, scale=4, num_feat=64, num_block=23, num_grow_ch=32):
+        super().__init__()
+        self.scale = scale
+        # x2 / x1 models see the input pixel-unshuffled to a quarter / sixteenth of its size
+        num_in_ch = 3 * {4: 1, 2: 4, 1: 16}[scale]
+        self.conv_first = nn.Conv2d(num_in_ch, num_feat, 3, 1, 1)
+        self.body = nn.Sequential(*[RRDB(num_feat, num_grow_ch) for _ in range(num_block)])
+        self.conv_body = nn.Conv2d(num_feat, num_feat, 3, 1, 1)
+        self.conv_up1 = nn.Conv2d(num_feat, num_feat, 3, 1, 1)
+        self.conv_up2 = nn.Conv2d(num_feat, num_feat, 3, 1, 1)
+        self.conv_hr = nn.Conv2d(num_feat, num_feat, 3, 1, 1)
+        self.conv_last = nn.Conv2d(num_feat, 3, 3, 1, 1)
+        self.lrelu = nn.LeakyReLU(negative_slope=0.2, inplace=True)
+
+    @classmethod
+    def from_state_dict(cls, state):
+        state = state.get("params_ema") or state.get("params") or state
+        if "conv_first.weight" not in state:
+            raise ValueError("not an RRDBNet (Real-ESRGAN style) checkpoint")
+        in_channels = state["conv_first.weight"].shape[1]
+        net = cls(
+            scale={3: 4, 12: 2, 48: 1}[in_channels],
+            num_feat=state["conv_first.weight"].shape[0],
+            num_block=len({key.split(".")[1] for key in state if key.startswith("body.")}),
+            num_grow_ch=state["body.0.rdb1.conv1.weight"].shape[0]
+        )
+        net.load_state_dict(state)
+        return net.eval()
+
+    def forward(self, x):
+        height, width = x.shape[2:]
+        if self.scale < 4:
+            # Pad to a multiple of the unshuffle factor (Real-ESRGAN's mod_pad), cropped off below
+            factor = 4 // self.scale
+            pad_h, pad_w = -height % factor, -width % factor
+            if pad_h or pad_w:
+                mode = "reflect" if min(height, width) > max(pad_h, pad_w) else "replicate"
+                x = F.pad(x, (0, pad_w, 0, pad_h), mode=mode)
+            x = F.pixel_unshuffle(x, factor)
+        feat = self.conv_first(x)
+        feat = feat + self.conv_body(self.body(feat))
+        feat = self.lrelu(self.conv_up1(F.interpolate(feat, scale_factor=2, mode="nearest")))
+        feat = self.lrelu(self.conv_up2(F.interpolate(feat, scale_factor=2, mode="nearest")))
+        output = self.conv_last(self.lrelu(self.conv_hr(feat)))
+        return output[:, :, :height * self.scale, :width * self.scale]
+
+
+class ESRGANUpscaler(Upscaler):
+    """RRDBNet checkpoint (e.g. RealESRGAN_x4plus.pth / x2plus.pth) on `device`."""
+
+    name = "esrgan"
+    default_tile = 192
+
+    def __init__(self, weights_path, device="cpu", dtype=torch.float32):
+        state = torch.load(weights_path, map_location="cpu", weights_only=True)
+        self.net = RRDBNet.from_state_dict(state).to(device, dtype)
+        self.native_scale = self.net.scale
+        self.device, self.dtype = device, dtype
+        logger.info(f"🔎 ESRGAN x{self.native_scale} loaded from {weights_path}")
+
+    def upscale(self, tiles, scale, prompts=None, seeds=None):
+        batch = torch.from_numpy(np.ascontiguousarray(tiles)).permute(0, 3, 1, 2)
+        with torch.no_grad():
+            output = self.net(batch.to(self.device, self.dtype) / 255.0)
+        output = (output.float().clamp(0, 1) * 255).round().byte().permute(0, 2, 3, 1).cpu().numpy()
+        return self._to_scale(output, tiles, scale)
+
+
+class SDLatentUpscaler(Upscaler):
+    """Stable Diffusion x4 upscaler pipeline; tiles of one batch may carry different prompts."""
+
+    name = "sd-x4"
+    native_scale = 4
+    default_tile = 128
+
+    def __init__(self, pipe, steps=20, noise_level=20, guidance_scale=7.5):
+        self.pipe = pipe
+        self.steps, self.noise_level, self.guidance_scale = steps, noise_level, guidance_scale
+        pipe.set_progress_bar_config(disable=True)
+
+    def upscale(self, tiles, scale, prompts=None, seeds=None):
+        count = len(tiles)
+        result = self.pipe(
+            prompt=list(prompts or [""] * count),
+            image=[Image.fromarray(t) for t in tiles],
+            num_inference_steps=self.steps,
+            noise_level=self.noise_level,
+            guidance_scale=self.guidance_scale,
+            generator=[torch.Generator("cpu").manual_seed(seed) for seed in (seeds or [0] * count)]
+        )
+        output = np.stack([np.asarray(image.convert("RGB")) for image in result.images])
+        return self._to_scale(output, tiles, scale)
@@ -0,0 +1,76 @@
+"""
+DeviceCalibrator profile handling: host matching on load, adopting a worker's profile, running in-process.
+"""
+
+import json
+import threading
+
+import pytest
+
+pytest.importorskip("torch")
+
+from calibration import PROFILE_VERSION, DeviceCalibrator, host_fingerprint
+
+
+def _profile(**host):
+    return {
+        "version": PROFILE_VERSION,
+        "host": {**host_fingerprint("cpu"), **host},
+        "dtype": "float32",
+        "compile_mode": "off",
+        "attention": "sliced",
+        "vae_slicing": True,
+        "reference_size": 512,
+        "seconds_per_step": {"256": 0.5, "512": 2.0},
+        "vae_decode_seconds": 1.0
+    }
+
+
+def test_load_accepts_a_profile_from_this_host(tmp_path):
+    path = tmp_path / "profile.json"
+    path.write_text(json.dumps(_profile()))
+    calibrator = DeviceCalibrator(path)
+    assert calibrator.load("cpu", "torch.float32")
+    assert calibrator.estimate(10, 512, 512, None) == 21.0
+
+
+def test_load_rejects_another_thread_count(tmp_path):
+    path = tmp_path / "profile.json"
+    path.write_text(json.dumps(_profile(torch_threads=host_fingerprint("cpu")["torch_threads"] + 8)))
+    calibrator = DeviceCalibrator(path)
+    assert not calibrator.load("cpu", "torch.float32")
+    assert calibrator.estimate(10, 512, 512, "fallback") == "fallback"
+
+
+def test_adopt_uses_a_worker_profile_regardless_of_host(tmp_path):
+    calibrator = DeviceCalibrator(tmp_path / "profile.json")
+    calibrator.adopt(_profile(torch_threads=3))
+    assert calibrator.state == "ready"
+    assert calibrator.default_steps(15) == 15  # 30s target / 2s per step
+    assert calibrator.max_size(10, 640) == 512
+
+
+def test_in_process_calibration_runs_as_a_batch(server, monkeypatch):
+    """It is queued on the generation batcher, so it never runs alongside a real batch."""
+    ran = threading.Event()
+    threads = []
+
+    def calibrate(device, dtype):
+        threads.append(threading.current_thread().name)
+        server.calibrator.adopt(_profile())
+        ran.set()
+        return True
+
+    batches = []
+    batcher = server.GenerationBatcher(lambda key, items: batches.append(key) or server.run_generation_batch(key, items), window_ms=0)
+    monkeypatch.setattr(server, "batcher", batcher)
+    monkeypatch.setattr(server.calibrator, "calibrate", calibrate)
+    monkeypatch.setattr(server.calibrator, "state", "idle")
+    monkeypatch.setattr(server.calibrator, "profile", None)
+
+    assert server.start_calibration_run(force=False)
+    assert not server.start_calibration_run(force=False)  # already running
+    assert ran.wait(10)
+    assert batches == [server.CALIBRATION_BATCH_KEY]
+    assert threads[0].startswith("generation-batcher")
+    assert server.calibrator.state == "ready"
@@ -0,0 +1,144 @@
+"""
+Micro-batching: batches by key, sibling groups, and multi-image requests that coalesce.
+"""
+
+import threading
+import time
+
+from PIL import Image
+
+from generation_batcher import GenerationBatcher
+
+
+class _Recorder:
+    """run_batch that records (key, payloads) and echoes each payload back."""
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, key, items):
+        self.batches.append((key, [item.payload for item in items]))
+        return [item.payload for item in items]
+
+
+def test_items_sharing_a_key_run_together():
+    recorder = _Recorder()
+    batcher = GenerationBatcher(recorder, window_ms=0, max_batch_size=4)
+    group = batcher.group(3)
+    members = [group.member() for _ in range(3)]
+    results = {}
+    threads = [
+        threading.Thread(target=lambda i=i: results.update({i: members[i].submit("k", i, timeout=5)}))
+        for i in range(3)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == {0: 0, 1: 1, 2: 2}
+    assert [sorted(payloads) for _, payloads in recorder.batches] == [[0, 1, 2]]
+
+
+def test_max_batch_size_splits_a_group():
+    recorder = _Recorder()
+    batcher = GenerationBatcher(recorder, window_ms=0, max_batch_size=2)
+    group = batcher.group(3)
+    members = [group.member() for _ in range(3)]
+    threads = [threading.Thread(target=members[i].submit, args=("k", i, 5)) for i in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(len(payloads) for _, payloads in recorder.batches) == [1, 2]
+
+
+def test_group_waits_for_every_member_and_leave_releases_it():
+    recorder = _Recorder()
+    batcher = GenerationBatcher(recorder, window_ms=0)
+    group = batcher.group(2)
+    first, second = group.member(), group.member()
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(value=first.submit("k", "a", timeout=5)))
+    thread.start()
+    time.sleep(0.1)
+    assert recorder.batches == []  # held until the sibling submits or leaves
+    second.leave()
+    thread.join()
+    assert result["value"] == "a"
+
+
+def test_member_submitting_after_leaving_runs_alone():
+    recorder = _Recorder()
+    batcher = GenerationBatcher(recorder, window_ms=0)
+    group = batcher.group(2)
+    first, second = group.member(), group.member()
+    second.leave()
+    first.leave()
+    assert second.submit("k", "late", timeout=5) == "late"
+    second.leave()  # no-op
+    assert recorder.batches == [("k", ["late"])]
+
+
+def _fake_batcher(server, release=None):
+    """GenerationBatcher that answers with blank images, blocking seeds in `release` until it is set."""
+    dispatched = []
+
+    def run_batch(key, items):
+        _, width, height = key[:3]
+        dispatched.append([item.payload["seed"] for item in items])
+        if release is not None and any(item.payload["seed"] in release["seeds"] for item in items):
+            release["event"].wait(10)
+        return [{
+            "image": Image.new("RGB", (width, height)),
+            "width": width,
+            "height": height,
+            "batch_size": len(items),
+            "queue_wait": 0.0,
+            "memory_plan": None
+        } for _ in items]
+
+    return server.GenerationBatcher(run_batch, window_ms=0, max_batch_size=4, concurrency=2), dispatched
+
+
+def _request(server, **overrides):
+    return server.ImageRequest(**{
+        "prompt": "a paper boat", "width": 256, "height": 256, "steps": 2, "cache": "bypass", **overrides
+    })
+
+
+def test_repeated_seeds_are_generated_once(server, monkeypatch):
+    batcher, dispatched = _fake_batcher(server)
+    monkeypatch.setattr(server, "batcher", batcher)
+    assert server.request_seeds(_request(server, seeds=[5, 5, 2**32 + 6, 6])) == [5, 6]
+
+    response, images = server._generate_images(_request(server, seeds=[5, 5, 6]))
+    assert response["metadata"]["seeds"] == [5, 6]
+    assert len(images) == 2
+    assert sorted(sum(dispatched, [])) == [5, 6]
+
+
+def test_follower_does_not_hold_its_group(server, monkeypatch):
+    release = {"seeds": {5}, "event": threading.Event()}
+    batcher, dispatched = _fake_batcher(server, release)
+    monkeypatch.setattr(server, "batcher", batcher)
+
+    leader = threading.Thread(target=server._generate, args=(_request(server, seed=5),))
+    leader.start()
+    deadline = time.time() + 5
+    while [5] not in dispatched and time.time() < deadline:
+        time.sleep(0.01)
+
+    result = {}
+    multi = threading.Thread(target=lambda: result.update(value=server._generate_images(_request(server, seeds=[5, 6]))))
+    multi.start()
+    deadline = time.time() + 5
+    while [6] not in dispatched and time.time() < deadline:
+        time.sleep(0.01)
+    # Seed 6 ran while seed 5 (a follower of the blocked leader) was still waiting
+    assert [6] in dispatched
+    release["event"].set()
+    leader.join(10)
+    multi.join(10)
+    response, images = result["value"]
+    assert len(images) == 2
+    assert response["metadata"]["batch_sizes"] == [1, 1]
@@ -0,0 +1,49 @@
+"""
+Graph compilation helpers: size buckets and batch-size reuse of compiled graphs.
+"""
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from graph_compile import compile_module, parse_buckets, snap_to_bucket, uncompile_module
+
+
+def test_parse_buckets_rounds_to_multiples_of_8():
+    assert parse_buckets("512x512, 515x770,") == [(512, 512), (512, 768)]
+
+
+def test_snap_to_bucket_prefers_aspect_then_area():
+    buckets = parse_buckets("512x512,768x768,512x768,768x512")
+    assert snap_to_bucket(700, 700, buckets) == (768, 768)
+    assert snap_to_bucket(500, 760, buckets) == (512, 768)
+    assert snap_to_bucket(700, 700, buckets, max_size=600) == (512, 512)
+    assert snap_to_bucket(300, 300, [], max_size=600) == (300, 300)
+
+
+class _Block(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(4, 4, 3, padding=1)
+
+    def forward(self, sample, encoder_hidden_states):
+        return self.conv(sample) + encoder_hidden_states.mean(dim=(1, 2)).view(-1, 1, 1, 1)
+
+
+def test_batch_sizes_share_one_compiled_graph():
+    from torch._dynamo.utils import counters
+
+    torch._dynamo.reset()
+    counters.clear()
+    block = _Block().eval()
+    expected = {}
+    with torch.no_grad():
+        for batch in (2, 4, 6, 8):
+            inputs = (torch.randn(batch, 4, 8, 8), torch.randn(batch, 7, 16))
+            expected[batch] = (inputs, block(*inputs))
+        compile_module(block, "default")
+        for batch, (inputs, reference) in expected.items():
+            assert torch.allclose(block(*inputs), reference, atol=1e-5)
+    assert counters["stats"]["unique_graphs"] == 1
+    uncompile_module(block)
+    torch._dynamo.reset()
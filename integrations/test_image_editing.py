@@ -0,0 +1,90 @@
+"""
+Source image URLs: only public http(s) hosts are fetched, without following redirects.
+"""
+
+import pytest
+
+pytest.importorskip("torch")
+
+import image_editing
+from image_editing import check_fetch_url, fetch_image
+
+
+@pytest.mark.parametrize("url", [
+    "http://127.0.0.1/a.png",
+    "http://localhost:8000/a.png",
+    "http://169.254.169.254/latest/meta-data/",
+    "http://10.0.0.5/a.png",
+    "http://192.168.1.1/a.png",
+    "http://[::1]/a.png",
+    "http://[fd00::1]/a.png",
+    "http://0.0.0.0/a.png",
+    "http://224.0.0.1/a.png"
+])
+def test_non_public_addresses_are_refused(url):
+    with pytest.raises(ValueError, match="non-public"):
+        check_fetch_url(url)
+
+
+@pytest.mark.parametrize("url", ["file:///etc/passwd", "ftp://8.8.8.8/a.png", "http:///a.png"])
+def test_only_http_urls_with_a_host(url):
+    with pytest.raises(ValueError, match="http"):
+        check_fetch_url(url)
+
+
+def test_allowlist_limits_hosts():
+    check_fetch_url("https://8.8.8.8/a.png")
+    check_fetch_url("https://8.8.8.8/a.png", allowed_hosts={"8.8.8.8"})
+    with pytest.raises(ValueError, match="not allowed"):
+        check_fetch_url("https://8.8.4.4/a.png", allowed_hosts={"8.8.8.8"})
+
+
+class _Response:
+    def __init__(self, status, body=b"", location=None):
+        self.status_code = status
+        self.is_redirect = location is not None
+        self.body = body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, size):
+        yield self.body
+
+
+def test_redirects_are_not_followed(monkeypatch):
+    calls = []
+
+    def get(url, **kwargs):
+        calls.append(kwargs)
+        return _Response(302, location="http://169.254.169.254/")
+
+    monkeypatch.setattr(image_editing.requests, "get", get)
+    with pytest.raises(ValueError, match="redirects"):
+        fetch_image("http://8.8.8.8/a.png", 1024)
+    assert calls[0]["allow_redirects"] is False
+
+
+def test_size_limit(monkeypatch):
+    monkeypatch.setattr(image_editing.requests, "get", lambda url, **kwargs: _Response(200, b"x" * 2048))
+    assert fetch_image("http://8.8.8.8/a.png", 4096) == b"x" * 2048
+    with pytest.raises(ValueError, match="larger"):
+        fetch_image("http://8.8.8.8/a.png", 1024)
+
+
+def test_server_refuses_urls_unless_enabled(server, monkeypatch):
+    with pytest.raises(server.HTTPException) as error:
+        server._load_input_image(None, "http://8.8.8.8/a.png", "mask", mode="L")
+    assert error.value.status_code == 422
+    assert "mask_url is disabled" in error.value.detail
+
+    monkeypatch.setattr(server, "EDIT_URL_FETCH", True)
+    with pytest.raises(server.HTTPException) as error:
+        server._load_input_image(None, "http://127.0.0.1/a.png", "image")
+    assert "non-public" in error.value.detail
@@ -0,0 +1,95 @@
+"""
+JobQueue journaling: queued jobs survive a restart and replay with their payload intact.
+"""
+
+import json
+import threading
+
+from job_queue import JobQueue
+
+
+def _replay(db_path, payloads):
+    """Journal `payloads` without running them, then restart the queue and collect what replays."""
+    queue = JobQueue(db_path, handler=lambda payload: None)
+    ids = [queue.submit(payload) for payload in payloads]
+
+    replayed = []
+    done = threading.Event()
+
+    def handler(payload):
+        replayed.append(payload)
+        if len(replayed) == len(payloads):
+            done.set()
+        return {"ok": True}
+
+    restarted = JobQueue(db_path, handler=handler)
+    restarted.start()
+    assert done.wait(10)
+    return ids, replayed, restarted
+
+
+def test_queued_jobs_replay_after_restart(tmp_path):
+    payloads = [{"prompt": "a", "n": 1}, {"prompt": "b", "n": 2}]
+    ids, replayed, queue = _replay(tmp_path / "jobs.db", payloads)
+    assert replayed == payloads
+    for job_id in ids:
+        for _ in range(100):
+            if queue.get(job_id)["status"] == "completed":
+                break
+            threading.Event().wait(0.05)
+        assert queue.get(job_id)["result"] == {"ok": True}
+
+
+def test_priority_orders_queued_jobs(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.db", handler=lambda payload: None)
+    low = queue.submit({"n": 1}, priority=0)
+    high = queue.submit({"n": 2}, priority=5)
+    assert queue.get(high)["queue_position"] == 0
+    assert queue.get(low)["queue_position"] == 1
+
+
+def test_journaled_request_keeps_its_size(server, tmp_path):
+    req = server.JobRequest(prompt="a lighthouse", width=768, height=1024, priority=3)
+    _, replayed, _ = _replay(tmp_path / "jobs.db", [json.loads(json.dumps(server.job_payload(req)))])
+    restored = server.ImageRequest(**replayed[0])
+    assert (restored.width, restored.height) == (768, 1024)
+
+
+def test_journaled_size_string_wins_over_defaults(server):
+    req = server.JobRequest(prompt="a lighthouse", size="640x384")
+    restored = server.ImageRequest(**json.loads(json.dumps(server.job_payload(req))))
+    assert (restored.width, restored.height) == (640, 384)
+
+
+def test_finished_jobs_past_retention_are_pruned(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.db", handler=lambda payload: None, retention_hours=1)
+    old, recent, queued = queue.submit({"n": 1}), queue.submit({"n": 2}), queue.submit({"n": 3})
+    queue._finish(old, "completed", result={"ok": True})
+    queue._finish(recent, "failed", error="boom")
+    with queue._lock:
+        queue._db.execute("UPDATE jobs SET finished_at = finished_at - 7200 WHERE id = ?", (old,))
+        queue._db.commit()
+    assert queue.prune() == 1
+    assert queue.get(old) is None
+    assert queue.get(recent)["status"] == "failed"
+    assert queue.get(queued)["status"] == "queued"
+    assert queue.stats()["pruned"] == 1
+
+
+def test_job_results_are_journaled_without_image_bytes(server, tmp_path, monkeypatch):
+    image_path = tmp_path / "image.png"
+    image_path.write_bytes(b"png bytes")
+
+    def generate_images(req):
+        return {"success": True, "data": {"local_path": str(image_path)}, "metadata": {}}, b"png bytes"
+
+    monkeypatch.setattr(server, "_generate_images", generate_images)
+    req = server.JobRequest(prompt="a lighthouse")
+    result = server.run_generation_job(server.job_payload(req))
+    assert "image_base64" not in json.dumps(result)
+
+    job = {"job_id": "j", "status": "completed", "result": json.loads(json.dumps(result))}
+    assert server.job_view(job)["result"]["data"]["image_base64"] == "cG5nIGJ5dGVz"
+
+    url_job = {**job, "result": {**job["result"], "metadata": {"response_format": "url"}}}
+    assert "image_base64" not in server.job_view(url_job)["result"]["data"]
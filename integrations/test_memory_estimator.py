@@ -0,0 +1,76 @@
+"""
+MemoryPlanner candidate ladder: which settings are tried, in which order, and what they cost.
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from memory_estimator import FALLBACK_SIZE, MemoryPlanner
+
+UNET_CONFIG = {"block_out_channels": [320, 640, 1280, 1280], "attention_head_dim": 8}
+VAE_CONFIG = {"block_out_channels": [128, 256, 512, 512]}
+
+
+class AttnProcessor:
+    pass
+
+
+class AttnProcessor2_0:
+    pass
+
+
+class SlicedAttnProcessor:
+    def __init__(self, slice_size):
+        self.slice_size = slice_size
+
+
+def _pipe(processor, vae_slicing=False):
+    unet = SimpleNamespace(config=UNET_CONFIG, dtype=torch.float16, attn_processors={"down.attn1": processor})
+    vae = SimpleNamespace(
+        config=VAE_CONFIG, dtype=torch.float16, use_slicing=vae_slicing, use_tiling=False,
+        enable_tiling=lambda: None, tile_sample_min_size=512
+    )
+    return SimpleNamespace(unet=unet, vae=vae)
+
+
+def _ladder(pipe, size=1024, allow_downscale=True):
+    planner = MemoryPlanner(allow_downscale=allow_downscale)
+    return [
+        (c["attention"], c["attention_slice"], c["vae_slicing"], c["vae_tiling"], c["width"])
+        for c in planner._candidates(pipe, size, size)
+    ]
+
+
+def test_classic_attention_walks_the_full_ladder():
+    assert _ladder(_pipe(AttnProcessor())) == [
+        ("classic", None, False, False, 1024),
+        ("sliced", 4, False, False, 1024),
+        ("sliced", 1, False, False, 1024),
+        ("sliced", 1, True, False, 1024),
+        ("sliced", 1, True, True, 1024),
+        ("sliced", 1, True, True, FALLBACK_SIZE)
+    ]
+
+
+def test_fused_attention_is_never_traded_for_slicing():
+    assert _ladder(_pipe(AttnProcessor2_0())) == [
+        ("fused", None, False, False, 1024),
+        ("fused", None, True, False, 1024),
+        ("fused", None, True, True, 1024),
+        ("fused", None, True, True, FALLBACK_SIZE)
+    ]
+
+
+def test_existing_slicing_is_only_tightened():
+    ladder = _ladder(_pipe(SlicedAttnProcessor(1), vae_slicing=True), size=FALLBACK_SIZE)
+    assert ladder == [("sliced", 1, True, False, FALLBACK_SIZE), ("sliced", 1, True, True, FALLBACK_SIZE)]
+
+
+def test_fused_ladder_estimates_never_grow():
+    pipe = _pipe(AttnProcessor2_0())
+    planner = MemoryPlanner(allow_downscale=False)
+    estimates = [planner._estimate(pipe, 1, True, c) for c in planner._candidates(pipe, 1024, 1024)]
+    assert estimates == sorted(estimates, reverse=True)
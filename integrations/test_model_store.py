@@ -0,0 +1,100 @@
+"""
+Model store: snapshot file selection and manifest fingerprints of stored components.
+"""
+
+import pytest
+
+from model_store import ModelStore, select_files
+
+SD_REPO = [
+    ".gitattributes",
+    "README.md",
+    "model_index.json",
+    "v1-5-pruned.safetensors",
+    "feature_extractor/preprocessor_config.json",
+    "safety_checker/config.json",
+    "safety_checker/model.safetensors",
+    "scheduler/scheduler_config.json",
+    "text_encoder/config.json",
+    "text_encoder/model.safetensors",
+    "text_encoder/model.fp16.safetensors",
+    "text_encoder/pytorch_model.bin",
+    "text_encoder/flax_model.msgpack",
+    "tokenizer/merges.txt",
+    "tokenizer/special_tokens_map.json",
+    "tokenizer/tokenizer_config.json",
+    "tokenizer/vocab.json",
+    "unet/config.json",
+    "unet/diffusion_pytorch_model-00001-of-00002.safetensors",
+    "unet/diffusion_pytorch_model-00002-of-00002.safetensors",
+    "unet/diffusion_pytorch_model.safetensors.index.json",
+    "unet/diffusion_pytorch_model.non_ema.safetensors",
+    "unet/diffusion_pytorch_model.bin",
+    "unet/diffusion_pytorch_model.bin.index.json",
+    "vae/config.json",
+    "vae/diffusion_pytorch_model.bin"
+]
+
+
+def test_safetensors_preferred_and_variants_skipped():
+    files, safetensors_only = select_files(SD_REPO)
+    assert files == sorted([
+        "model_index.json",
+        "feature_extractor/preprocessor_config.json",
+        "scheduler/scheduler_config.json",
+        "text_encoder/config.json",
+        "text_encoder/model.safetensors",
+        "tokenizer/merges.txt",
+        "tokenizer/special_tokens_map.json",
+        "tokenizer/tokenizer_config.json",
+        "tokenizer/vocab.json",
+        "unet/config.json",
+        "unet/diffusion_pytorch_model-00001-of-00002.safetensors",
+        "unet/diffusion_pytorch_model-00002-of-00002.safetensors",
+        "unet/diffusion_pytorch_model.safetensors.index.json",
+        "vae/config.json",
+        "vae/diffusion_pytorch_model.bin"
+    ])
+    assert not safetensors_only  # the VAE only ships .bin weights
+
+
+def test_safetensors_only_repo():
+    files, safetensors_only = select_files(["model_index.json", "unet/config.json", "unet/diffusion_pytorch_model.safetensors"])
+    assert files == ["model_index.json", "unet/config.json", "unet/diffusion_pytorch_model.safetensors"]
+    assert safetensors_only
+
+
+def _store_with(tmp_path, model_name, files):
+    store = ModelStore(tmp_path)
+    model_dir = store.model_dir(model_name)
+    model_dir.mkdir(parents=True)
+    entries = {name: {"size": 1, "sha256": digest} for name, digest in files.items()}
+    store._write_manifest(model_dir, model_name, None, entries, True, "test")
+    return store
+
+
+def test_fingerprint_from_manifest(tmp_path):
+    store = _store_with(tmp_path, "org/model", {
+        "model_index.json": "a", "unet/config.json": "b", "unet/diffusion_pytorch_model.safetensors": "c", "vae/config.json": "d"
+    })
+    unet = store.files_fingerprint("org/model", "unet")
+    assert unet is not None and unet != store.files_fingerprint("org/model", "vae")
+    assert store.files_fingerprint("org/model", "text_encoder") is None
+    assert store.files_fingerprint("org/other", "unet") is None
+
+    changed = _store_with(tmp_path / "changed", "org/model", {
+        "unet/config.json": "b", "unet/diffusion_pytorch_model.safetensors": "e"
+    })
+    assert changed.files_fingerprint("org/model", "unet") != unet
+
+
+def test_files_fingerprint_asks_the_store_first(tmp_path, monkeypatch):
+    component_pool = pytest.importorskip("component_pool")
+    store = _store_with(tmp_path, "org/stored", {"unet/config.json": "b"})
+    monkeypatch.setattr(component_pool, "_fingerprint_sources", [store.files_fingerprint])
+    assert component_pool.files_fingerprint("org/stored", "unet") == store.files_fingerprint("org/stored", "unet")
+
+    # The quantized weight cache keys stored models without hashing their tensors
+    quantization = pytest.importorskip("quantization")
+    monkeypatch.setattr(quantization, "weights_fingerprint", lambda module: pytest.fail("weights were hashed"))
+    quantization.QuantizedWeightCache(tmp_path / "quantized")._path("org/stored", "unet", None, "int8-dynamic")
@@ -0,0 +1,111 @@
+"""
+SingleFlight: identical concurrent calls share one run; timeouts follow the configured policy.
+"""
+
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+from fastapi import HTTPException
+
+from request_coalescer import SingleFlight
+
+
+def _wait_for_follower(flight, timeout=5):
+    deadline = time.time() + timeout
+    while flight.stats()["followers"] < 1 and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def _start_leader(flight, key, result="done", error=None):
+    """Run a leader in a thread that blocks until the returned event is set."""
+    started, release = threading.Event(), threading.Event()
+    outcome = {}
+
+    def fn():
+        started.set()
+        release.wait(5)
+        if error is not None:
+            raise error
+        return result
+
+    def leader():
+        try:
+            outcome["value"] = flight.run(key, fn)
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=leader)
+    thread.start()
+    started.wait(5)
+    return thread, release, outcome
+
+
+def test_followers_share_the_leader_result():
+    flight = SingleFlight()
+    thread, release, outcome = _start_leader(flight, "k" * 16)
+    followed = []
+    follower = threading.Thread(target=lambda: followed.append(
+        flight.run("k" * 16, lambda: "own run", on_follow=lambda: followed.append("left"))
+    ))
+    follower.start()
+    _wait_for_follower(flight)
+    release.set()
+    thread.join()
+    follower.join()
+    assert outcome["value"] == ("done", "leader", 1)
+    assert followed == ["left", ("done", "follower", 1)]
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_leader_error_reaches_followers():
+    flight = SingleFlight()
+    thread, release, outcome = _start_leader(flight, "e" * 16, error=RuntimeError("boom"))
+    errors = []
+
+    def follower():
+        try:
+            flight.run("e" * 16, lambda: "own run")
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    t = threading.Thread(target=follower)
+    t.start()
+    _wait_for_follower(flight)
+    release.set()
+    thread.join()
+    t.join()
+    assert str(outcome["error"]) == "boom"
+    assert errors == ["boom"]
+
+
+def test_different_keys_do_not_coalesce():
+    flight = SingleFlight()
+    assert flight.run("a" * 16, lambda: 1) == (1, "leader", 0)
+    assert flight.run("a" * 16, lambda: 2) == (2, "leader", 0)  # the first run has finished
+    assert flight.stats()["leaders"] == 2
+
+
+@pytest.mark.parametrize("policy", ["run", "fail"])
+def test_follower_timeout_policy(policy):
+    flight = SingleFlight(follower_timeout=0.05, timeout_policy=policy)
+    thread, release, _ = _start_leader(flight, "t" * 16)
+    try:
+        if policy == "run":
+            assert flight.run("t" * 16, lambda: "own run") == ("own run", "independent", 0)
+        else:
+            with pytest.raises(HTTPException) as error:
+                flight.run("t" * 16, lambda: "own run")
+            assert error.value.status_code == 504
+    finally:
+        release.set()
+        thread.join()
+    assert flight.stats()["follower_timeouts"] == 1
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        SingleFlight(timeout_policy="retry")
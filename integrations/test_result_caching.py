@@ -0,0 +1,43 @@
+"""
+Result caching in the generate path: only runs at the requested size answer for its key.
+"""
+
+import io
+
+import pytest
+from PIL import Image
+
+
+def _submit_returning(width, height):
+    def submit(key, payload):
+        return {
+            "image": Image.new("RGB", (width, height)),
+            "width": width,
+            "height": height,
+            "batch_size": 1,
+            "queue_wait": 0.0,
+            "memory_plan": None
+        }
+    return submit
+
+
+def _request(server, **overrides):
+    return server.ImageRequest(**{"prompt": "a red bicycle", "width": 512, "height": 512, "steps": 4, "seed": 11, **overrides})
+
+
+def test_downscaled_run_is_not_cached(server):
+    response, _ = server._generate(_request(server), submit=_submit_returning(256, 256))
+    assert response["data"]["size"] == "256x256"
+    assert response["metadata"]["downscaled_from"] == "512x512"
+
+    with pytest.raises(server.HTTPException) as error:
+        server._generate(_request(server, cache="only"))
+    assert error.value.status_code == 404
+
+
+def test_full_size_run_is_cached(server):
+    server._generate(_request(server, seed=12), submit=_submit_returning(512, 512))
+    response, image_bytes = server._generate(_request(server, seed=12, cache="only"))
+    assert response["metadata"]["cache"] == "hit"
+    assert response["data"]["size"] == "512x512"
+    assert Image.open(io.BytesIO(image_bytes)).size == (512, 512)
@@ -0,0 +1,48 @@
+"""
+Shared weight files: mapped modules compute the same result, int8-dynamic is reported as not shared.
+"""
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from quantization import quantize_module
+from shared_weights import SharedWeightStore, is_shared, packed_layers, process_memory, self_check
+
+
+def _model(quantization="none"):
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(64, 64), torch.nn.GELU(), torch.nn.Linear(64, 16))
+    return model if quantization == "none" else quantize_module(model, quantization)
+
+
+@pytest.mark.parametrize("quantization", ["none", "int8-weight-only"])
+def test_mapped_module_matches_private_copy(tmp_path, quantization):
+    store = SharedWeightStore(tmp_path)
+    model, reference = _model(quantization), _model(quantization)
+    assert store.share_module(model, f"test:{quantization}")
+    assert is_shared(model)
+    x = torch.randn(4, 64)
+    with torch.no_grad():
+        assert torch.equal(model(x), reference(x))
+    assert store.stats()["files"] == 1
+
+
+def test_int8_dynamic_is_reported_not_shared(tmp_path):
+    store = SharedWeightStore(tmp_path)
+    model = _model("int8-dynamic")
+    assert packed_layers(model) == 2
+    assert not store.share_module(model, "test:int8-dynamic")
+    assert not is_shared(model)
+    stats = store.stats()
+    assert stats["files"] == 0 and stats["mapped_mb"] == 0
+    assert "packed params" in stats["not_shared"]["test:int8-dynamic"]
+
+
+def test_workers_share_one_copy_of_the_weights(tmp_path):
+    memory = process_memory()
+    if memory is None or not memory["pss_mb"] or not memory["uss_mb"]:
+        pytest.skip("platform does not report PSS / USS")
+    result = self_check(workers=2, size_mb=128, root=str(tmp_path))
+    assert result["passed"], result
+    assert result["shared"]["total_pss_growth_mb"] < result["private"]["total_pss_growth_mb"]
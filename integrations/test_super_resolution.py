@@ -0,0 +1,70 @@
+"""
+Super-resolution tiling: window plans cover every pixel once, x2 RRDB models take odd tile sizes.
+"""
+
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from PIL import Image
+
+from super_resolution import ESRGANUpscaler, LanczosUpscaler, RRDBNet, _axis_spans, tile_plan, upscale_tiled
+
+
+@pytest.mark.parametrize("size,tile,overlap", [(100, 100, 8), (100, 40, 8), (513, 192, 16), (37, 20, 19)])
+def test_axis_spans_own_every_pixel_once(size, tile, overlap):
+    spans = _axis_spans(size, tile, overlap)
+    assert spans[0][0] == 0 and spans[-1][1] == size
+    owned = [own_end - own_start for _, _, own_start, own_end in spans]
+    assert sum(owned) == size
+    for (start, end, own_start, own_end), nxt in zip(spans, spans[1:] + [None]):
+        assert end - start == min(tile, size)
+        assert start <= own_start < own_end <= end
+        if nxt is not None:
+            assert own_end == nxt[2]
+            assert end - nxt[0] >= min(overlap, tile - 1)
+
+
+def test_tile_plan_is_row_major():
+    plan = tile_plan(50, 30, 20, 4)
+    tops = [window[1] for window, _ in plan]
+    assert tops == sorted(tops)
+    assert len(plan) == len(_axis_spans(50, 20, 4)) * len(_axis_spans(30, 20, 4))
+
+
+def _submit(upscaler, scale):
+    def submit(tile):
+        future = Future()
+        future.set_result(upscaler.upscale(tile[None], scale)[0])
+        return future
+    return submit
+
+
+def test_tiled_lanczos_keeps_the_size():
+    image = Image.fromarray(np.random.default_rng(0).integers(0, 255, (45, 61, 3), dtype=np.uint8))
+    result = upscale_tiled(image, 2, 24, 6, _submit(LanczosUpscaler(), 2), max_inflight=3)
+    assert result.size == (122, 90)
+
+
+@pytest.fixture
+def esrgan_x2(tmp_path):
+    torch.manual_seed(0)
+    path = tmp_path / "x2.pth"
+    torch.save({"params_ema": RRDBNet(scale=2, num_feat=8, num_block=1, num_grow_ch=4).state_dict()}, path)
+    return ESRGANUpscaler(path)
+
+
+@pytest.mark.parametrize("height,width", [(33, 17), (1, 3), (32, 32)])
+def test_x2_model_takes_odd_tile_sizes(esrgan_x2, height, width):
+    assert esrgan_x2.native_scale == 2
+    tiles = np.random.default_rng(0).integers(0, 255, (2, height, width, 3), dtype=np.uint8)
+    assert esrgan_x2.upscale(tiles, 2).shape == (2, height * 2, width * 2, 3)
+
+
+def test_x2_model_over_odd_tiles(esrgan_x2):
+    image = Image.fromarray(np.random.default_rng(1).integers(0, 255, (41, 29, 3), dtype=np.uint8))
+    result = upscale_tiled(image, 2, 25, 8, _submit(esrgan_x2, 2))
+    assert result.size == (58, 82)
@@ -0,0 +1,32 @@
+"""
+Tiled generation windows: equal-shaped windows that cover the whole latent canvas.
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from tiled_diffusion import tile_windows, window_count
+
+
+@pytest.mark.parametrize("height,width,tile,overlap", [(64, 64, 64, 8), (96, 160, 64, 16), (130, 70, 48, 47), (40, 200, 64, 8)])
+def test_windows_cover_the_canvas_with_one_shape(height, width, tile, overlap):
+    windows = tile_windows(height, width, tile, overlap)
+    assert len({(h, w) for _, _, h, w in windows}) == 1
+    covered = np.zeros((height, width), dtype=int)
+    for top, left, h, w in windows:
+        assert top + h <= height and left + w <= width
+        covered[top:top + h, left:left + w] += 1
+    assert covered.min() >= 1
+
+
+def test_neighbours_overlap_by_at_least_the_overlap():
+    windows = tile_windows(64, 200, 64, 16)
+    lefts = [left for _, left, _, _ in windows]
+    assert all(b - a <= 64 - 16 for a, b in zip(lefts, lefts[1:]))
+
+
+def test_window_count_in_pixels():
+    assert window_count(512, 512, 512, 64) == 1
+    assert window_count(1024, 512, 512, 64) == len(tile_windows(64, 128, 64, 8)) == 3
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+APIBR2 - Tiled Generation
+MultiDiffusion-style denoising of canvases larger than a model's comfortable
+size: every step the latent canvas is split into overlapping tile windows,
+the UNet runs on batches of windows and the predictions are blended with
+feathered weights before a single scheduler step on the whole canvas. The VAE
+decodes tile by tile as well, so peak memory follows the tile size, not the
+canvas size.
+"""
+
+import contextlib
+import inspect
+import logging
+
+import numpy as np
+import torch
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+TILING_MODES = ("auto", "off")
+
+
+def _positions(size, tile, stride):
+    """Window starts along one axis covering [0, size), the last one flush with the edge."""
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile, stride))
+    return starts + [size - tile]
+
+
+def tile_windows(latent_height, latent_width, tile, overlap):
+    """(top, left, height, width) latent windows; all the same shape so they batch together."""
+    stride = max(tile - overlap, 1)
+    tile_h, tile_w = min(tile, latent_height), min(tile, latent_width)
+    return [
+        (top, left, tile_h, tile_w)
+        for top in _positions(latent_height, tile_h, stride)
+        for left in _positions(latent_width, tile_w, stride)
+    ]
+
+
+def window_count(width, height, tile, overlap, scale=8):
+    return len(tile_windows(height // scale, width // scale, tile // scale, overlap // scale))
+
+
+def feather_weights(tile_h, tile_w, overlap):
+    """Per-pixel blend weights rising linearly over `overlap` latents from each window edge."""
+    def ramp(n):
+        index = torch.arange(n, dtype=torch.float32)
+        return ((torch.minimum(index + 1, n - index)) / (overlap + 1)).clamp(max=1.0)
+    return ramp(tile_h)[:, None] * ramp(tile_w)[None, :]
+
+
+def initial_latents(seeds, channels, latent_height, latent_width):
+    """Per-seed starting noise drawn exactly like the regular pipeline's prepare_latents."""
+    return torch.cat([
+        torch.randn((1, channels, latent_height, latent_width), generator=torch.Generator("cpu").manual_seed(seed))
+        for seed in seeds
+    ])
+
+
+@contextlib.contextmanager
+def tiled_vae(vae, tile, overlap):
+    """Decode through the VAE's own tiled decoder with our tile geometry, then restore it."""
+    saved = (vae.use_tiling, vae.tile_sample_min_size, vae.tile_latent_min_size, vae.tile_overlap_factor)
+    scale = 2 ** (len(vae.config.block_out_channels) - 1)
+    vae.use_tiling = True
+    vae.tile_sample_min_size = tile
+    vae.tile_latent_min_size = tile // scale
+    vae.tile_overlap_factor = overlap / tile
+    try:
+        yield
+    finally:
+        vae.use_tiling, vae.tile_sample_min_size, vae.tile_latent_min_size, vae.tile_overlap_factor = saved
+
+
+def _to_pil(decoded):
+    array = (decoded / 2 + 0.5).clamp(0, 1).float().cpu().permute(0, 2, 3, 1).numpy()
+    return [Image.fromarray((image * 255).round().astype(np.uint8)) for image in array]
+
+
+def canvas_windows(latent_height, latent_width, tile, overlap, device):
+    """Windows, their feather weights and the per-pixel weight sum for a latent canvas."""
+    windows = tile_windows(latent_height, latent_width, tile, overlap)
+    weights = feather_weights(windows[0][2], windows[0][3], overlap).to(device)
+    weight_sum = torch.zeros(latent_height, latent_width, device=device)
+    for top, left, h, w in windows:
+        weight_sum[top:top + h, left:left + w] += weights
+    return windows, weights, weight_sum
+
+
+def denoise(pipe, embeds, latents, guidances, timesteps, generators, tile=None, overlap=0,
+            tile_batch=4, on_step=None, step_offset=0):
+    """Run the scheduler over `timesteps` on a latent canvas, windowed when `tile` (latents) is set.
+
+    `embeds` holds a (prompt_embeds, negative_prompt_embeds) pair per image;
+    each image's windows run through the UNet `tile_batch` at a time (times two
+    with CFG). Noise predictions are blended rather than per-window denoised
+    latents, so multistep schedulers keep one consistent state for the canvas.
+    `on_step(step_index, timestep, latents)` is called after every step.
+    """
+    unet, scheduler = pipe.unet, pipe.scheduler
+    latent_h, latent_w = latents.shape[-2:]
+    windows, weights, weight_sum = canvas_windows(
+        latent_h, latent_w, tile or max(latent_h, latent_w), overlap, latents.device
+    )
+    step_kwargs = {"generator": generators} if "generator" in inspect.signature(scheduler.step).parameters else {}
+
+    with torch.no_grad():
+        for step_index, t in enumerate(timesteps):
+            model_input = scheduler.scale_model_input(latents, t)
+            noise = torch.zeros_like(latents, dtype=torch.float32)
+            for item, ((cond, uncond), guidance) in enumerate(zip(embeds, guidances)):
+                use_cfg = guidance > 1.0
+                context = torch.cat([uncond, cond]) if use_cfg else cond
+                for start in range(0, len(windows), tile_batch):
+                    chunk = windows[start:start + tile_batch]
+                    tiles = torch.cat([model_input[item:item + 1, :, top:top + h, left:left + w] for top, left, h, w in chunk])
+                    if use_cfg:
+                        tiles = torch.cat([tiles, tiles])
+                    prediction = unet(
+                        tiles.to(unet.dtype), t,
+                        encoder_hidden_states=context.repeat_interleave(len(chunk), dim=0)
+                    ).sample.float()
+                    if use_cfg:
+                        uncond_pred, cond_pred = prediction.chunk(2)
+                        prediction = uncond_pred + guidance * (cond_pred - uncond_pred)
+                    for (top, left, h, w), window_pred in zip(chunk, prediction):
+                        noise[item, :, top:top + h, left:left + w] += window_pred * weights
+            noise /= weight_sum
+            latents = scheduler.step(noise.to(latents.dtype), t, latents, **step_kwargs).prev_sample
+            if on_step is not None:
+                on_step(step_offset + step_index, t, latents)
+    return latents
+
+
+def decode(pipe, latents, tile=None, overlap=0):
+    """Latents to PIL images one at a time, through the tiled VAE decoder when `tile` (pixels) is set."""
+    vae = pipe.vae
+    latents = latents / vae.config.scaling_factor
+    images = []
+    with torch.no_grad(), (tiled_vae(vae, tile, overlap) if tile else contextlib.nullcontext()):
+        for item in range(latents.shape[0]):
+            images.extend(_to_pil(vae.decode(latents[item:item + 1].to(vae.dtype)).sample))
+    return images
+
+
+def vae_scale(pipe):
+    return 2 ** (len(pipe.vae.config.block_out_channels) - 1)
+
+
+def tiled_generate(pipe, embeds, seeds, guidances, steps, width, height, tile=512, overlap=128,
+                   tile_batch=4, on_step=None):
+    """Generate one image per seed on a width x height canvas with a torch SD 1.x/2.x pipeline."""
+    scheduler = pipe.scheduler
+    device = pipe._execution_device
+    scale = vae_scale(pipe)
+    latent_h, latent_w = height // scale, width // scale
+
+    generators = [torch.Generator("cpu").manual_seed(seed) for seed in seeds]
+    latents = initial_latents(seeds, pipe.unet.config.in_channels, latent_h, latent_w).to(device)
+    scheduler.set_timesteps(steps, device=device)
+    latents = latents * scheduler.init_noise_sigma
+
+    windows = len(tile_windows(latent_h, latent_w, tile // scale, overlap // scale))
+    logger.info(f"🧩 Tiled generation {width}x{height}: {windows} windows of {tile}px ({overlap}px overlap)")
+    latents = denoise(
+        pipe, embeds, latents, guidances, scheduler.timesteps, generators,
+        tile=tile // scale, overlap=overlap // scale, tile_batch=tile_batch, on_step=on_step
+    )
+    return decode(pipe, latents, tile, overlap)
@@ -6,22 +6,71 @@ Originally tuned for AMD Radeon RX 6750 XT, but works on CPU/GPU fallbacks
 """
 
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, Response, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from pathlib import Path
+from typing import List, Optional
 import torch
 import uuid
 import time
 import os
-import base64
 import logging
 import gc
+import random
+import asyncio
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
+import numpy as np
 import psutil  # Used to monitor real-time resource usage
 
-# Force PyTorch to use every CPU core (Ryzen 9 7900X = 12c/24t on the target host)
-num_threads = os.cpu_count() or 12  # Fallback to 12 threads if detection fails
+from generation_batcher import BatchItem, GenerationBatcher
+from job_queue import JobQueue
+from model_cache import TieredModelCache, GB, module_nbytes
+from component_pool import ComponentPool, add_fingerprint_source
+from prompt_cache import PromptEmbeddingCache
+from result_cache import ResultStore, generation_key, CACHE_MODES
+from request_coalescer import SingleFlight
+from progress_stream import ProgressHub, ProgressRelay, step_callback_kwargs, step_function
+from calibration import DeviceCalibrator, apply_pipeline_settings
+from model_preloader import ModelPreloader
+from cpu_precision import autocast_context, keep_vae_fp32, resolve_cpu_dtype
+from quantization import (
+    QUANTIZATION_MODES, QuantizedWeightCache, image_similarity, quantize_module, quantize_pipeline
+)
+from cpu_worker_pool import CpuWorkerPool
+from shared_weights import SharedWeightStore, process_memory
+from memory_estimator import MemoryPlanner, applied_plan, is_memory_error
+from tiled_diffusion import TILING_MODES, tiled_generate, window_count
+from hires_fix import UPSCALE_MODES, draft_size, hires_generate, refine_steps
+from image_editing import (
+    LatentCache, decode_image_data, edit_pipeline, effective_steps, fetch_image, masked_source, open_image
+)
+from super_resolution import (
+    UPSCALE_FACTORS, UPSCALER_MODELS, ESRGANUpscaler, LanczosUpscaler, SDLatentUpscaler, upscale_tiled
+)
+from model_store import LPW_PIPELINE_PATH, STORE_MODES, ModelStore
+from onnx_engine import (
+    ENGINES, export_pipeline, initial_latents, is_exported, is_onnx_pipeline, load_onnx_pipeline, onnx_model_dir
+)
+from graph_compile import (
+    COMPILE_MODES, DEFAULT_BUCKETS, compile_pipeline, configure_compile_cache, parse_buckets, snap_to_bucket
+)
+from image_responses import (
+    RESPONSE_FORMATS, image_encoder, media_type, metadata_headers, normalize_format,
+    resolve_output, shard_path, validate_encoding, with_image_payload
+)
+
+# Force PyTorch to use every CPU core this process may run on (Ryzen 9 7900X = 12c/24t on
+# the target host); pool workers are pinned to a subset before this module is imported
+try:
+    num_threads = len(psutil.Process().cpu_affinity())
+except AttributeError:  # No affinity API on macOS
+    num_threads = os.cpu_count() or 12  # Fallback to 12 threads if detection fails
 torch.set_num_threads(num_threads)
 torch.set_num_interop_threads(num_threads)
 
@@ -63,12 +112,201 @@ FORCE_CPU = os.getenv("FORCE_CPU", "false").lower() == "true"
 
 PREFER_CPU = os.getenv("PREFER_CPU", "false").lower() == "true"
 
-# Cache to avoid reloading heavy pipelines on every request
-pipes = {}
+# Micro-batching: how long to hold a request waiting for compatible peers, and the cap per batch
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "50"))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "4"))
+
+# Cap on num_images / len(seeds) per request; the images share batches of up to BATCH_MAX_SIZE,
+# split further when the memory planner says a batch would not fit the device
+MAX_IMAGES_PER_REQUEST = int(os.getenv("MAX_IMAGES_PER_REQUEST", "8"))
+
+# Job mode: SQLite journal for queued work and number of inference worker threads. Results are
+# journaled in url form (base64 is re-read from OUT_DIR on request) and finished jobs are deleted
+# after JOB_RETENTION_HOURS (0 = never)
+JOBS_DB = Path(os.getenv("JOBS_DB", "image_jobs.db"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))
+JOB_RETENTION_HOURS = float(os.getenv("JOB_RETENTION_HOURS", "168"))
+
+# Memory budgets for the model cache (GB, 0 = unlimited). RAM defaults to 75% of host memory.
+MODEL_RAM_BUDGET_GB = float(os.getenv("MODEL_RAM_BUDGET_GB", str(round(psutil.virtual_memory().total * 0.75 / GB, 1))))
+MODEL_VRAM_BUDGET_GB = float(os.getenv("MODEL_VRAM_BUDGET_GB", "0"))
+
+# Pre-flight memory planning: every generation's peak memory is estimated and checked
+# against free VRAM/RAM, and attention/VAE slicing, size (MEMORY_DOWNSCALE) or a CPU
+# replica of the model is chosen before running. DirectML can't report free memory,
+# so DML_VRAM_GB (minus the models cached on the device) stands in for it
+MEMORY_HEADROOM = float(os.getenv("MEMORY_HEADROOM", "0.1"))
+DML_VRAM_GB = float(os.getenv("DML_VRAM_GB", "12"))
+memory_planner = MemoryPlanner(
+    headroom=MEMORY_HEADROOM,
+    allow_downscale=os.getenv("MEMORY_DOWNSCALE", "true").lower() == "true"
+)
+
+# Tiled generation (see tiled_diffusion.py): SD 1.x/2.x torch requests above the device's size
+# cap are denoised in overlapping TILE_SIZE windows (TILE_BATCH per UNet call) and decoded with
+# a tiled VAE instead of being shrunk to the cap; TILED_MAX_SIZE bounds the canvas
+TILED_GENERATION = os.getenv("TILED_GENERATION", "true").lower() == "true"
+TILE_SIZE = int(os.getenv("TILE_SIZE", "512"))
+TILE_OVERLAP = int(os.getenv("TILE_OVERLAP", "128"))
+TILE_BATCH = int(os.getenv("TILE_BATCH", "4"))
+TILED_MAX_SIZE = int(os.getenv("TILED_MAX_SIZE", "2048"))
+
+# Hires fix (see hires_fix.py): `hires` requests draft at HIRES_BASE_SIZE (long side, capped by
+# the device limit), upscale the latents (HIRES_UPSCALE) and refine at the requested size
+HIRES_BASE_SIZE = int(os.getenv("HIRES_BASE_SIZE", "512"))
+HIRES_UPSCALE = os.getenv("HIRES_UPSCALE", "bicubic").lower()
+if HIRES_UPSCALE not in UPSCALE_MODES:
+    logger.warning(f"⚠️ Unknown HIRES_UPSCALE '{HIRES_UPSCALE}', expected one of {UPSCALE_MODES}; using bicubic")
+    HIRES_UPSCALE = "bicubic"
+
+# Image editing (see image_editing.py): /edit runs img2img / inpainting on the cached pipeline's
+# components; VAE encodings of source images stay cached (EDIT_LATENT_CACHE_MB) by pixel hash
+EDIT_LATENT_CACHE_MB = float(os.getenv("EDIT_LATENT_CACHE_MB", "256"))
+EDIT_MAX_INPUT_MB = float(os.getenv("EDIT_MAX_INPUT_MB", "20"))
+# image_url / mask_url make the server fetch from the network, so they are off unless
+# EDIT_URL_FETCH=true; EDIT_URL_HOSTS optionally limits them to a comma-separated host list.
+# Hosts resolving to loopback, private or link-local addresses are always refused.
+EDIT_URL_FETCH = os.getenv("EDIT_URL_FETCH", "false").lower() == "true"
+EDIT_URL_HOSTS = {h.strip().lower() for h in os.getenv("EDIT_URL_HOSTS", "").split(",") if h.strip()}
+latent_cache = LatentCache(max_bytes=EDIT_LATENT_CACHE_MB * 1024 ** 2)
+
+# Super-resolution (see super_resolution.py): /upscale runs UPSCALER_MODEL ("lanczos", "esrgan"
+# with an RRDBNet checkpoint in UPSCALER_WEIGHTS, or "sd-x4") over overlapping input tiles of
+# UPSCALE_TILE pixels (0 = the model's default); tiles of concurrent jobs share network batches
+# of up to UPSCALE_TILE_BATCH collected within UPSCALE_BATCH_WINDOW_MS
+UPSCALER_WEIGHTS = os.getenv("UPSCALER_WEIGHTS", "")
+UPSCALER_MODEL = os.getenv("UPSCALER_MODEL", "esrgan" if UPSCALER_WEIGHTS else "lanczos").lower()
+SD_UPSCALER_MODEL = os.getenv("SD_UPSCALER_MODEL", "stabilityai/stable-diffusion-x4-upscaler")
+UPSCALE_SD_STEPS = int(os.getenv("UPSCALE_SD_STEPS", "20"))
+UPSCALE_TILE = int(os.getenv("UPSCALE_TILE", "0"))
+UPSCALE_TILE_OVERLAP = int(os.getenv("UPSCALE_TILE_OVERLAP", "16"))
+UPSCALE_TILE_BATCH = int(os.getenv("UPSCALE_TILE_BATCH", "4"))
+UPSCALE_BATCH_WINDOW_MS = float(os.getenv("UPSCALE_BATCH_WINDOW_MS", "20"))
+UPSCALE_MAX_INPUT = int(os.getenv("UPSCALE_MAX_INPUT", "2048"))
+
+# Share identical tokenizer/text encoder/VAE/UNet weights between SD 1.5 derived checkpoints
+COMPONENT_SHARING = os.getenv("COMPONENT_SHARING", "true").lower() == "true"
+component_pool = ComponentPool()
+
+# Text encoder outputs for repeated prompts; PROMPT_CACHE_DIR enables .npy spill to disk
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE", "true").lower() == "true"
+prompt_cache = PromptEmbeddingCache(
+    max_bytes=float(os.getenv("PROMPT_CACHE_MB", "256")) * 1024 ** 2,
+    disk_dir=os.getenv("PROMPT_CACHE_DIR") or None
+)
+
+# Finished images for seeded requests, content-addressed by their generation parameters
+result_store = ResultStore(
+    os.getenv("RESULT_CACHE_DIR", "result_cache"),
+    max_bytes=float(os.getenv("RESULT_CACHE_MB", "2048")) * 1024 ** 2
+)
+
+# Single-flight: followers of an identical in-flight request wait up to COALESCE_TIMEOUT
+# seconds, then either run on their own ("run") or give up with a 504 ("fail")
+inflight = SingleFlight(
+    follower_timeout=float(os.getenv("COALESCE_TIMEOUT", "300")),
+    timeout_policy=os.getenv("COALESCE_TIMEOUT_POLICY", "run")
+)
+
+# Per-step progress events for /generate/stream subscribers
+progress_hub = ProgressHub()
+
+# Worker-pool mode: WORKER_PROCESSES > 0 runs inference in that many processes, each pinned
+# to its own CPU set (split by L3/NUMA domain) with a matching intra-op thread count, instead
+# of one process spanning every core. This process then only dispatches and encodes
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "0"))
+
+# CPU pipeline weights moved into files under SHARED_WEIGHTS_DIR that every process maps
+# MAP_SHARED, so N workers (pool processes or uvicorn workers) hold one physical copy.
+# On by default in worker-pool mode; a tmpfs such as /dev/shm keeps them off the disk
+SHARED_WEIGHTS = os.getenv("SHARED_WEIGHTS", "true" if WORKER_PROCESSES > 0 else "false").lower() == "true"
+shared_weights = SharedWeightStore(os.getenv("SHARED_WEIGHTS_DIR", "shared_weights")) if SHARED_WEIGHTS else None
+
+worker_pool = None
+if WORKER_PROCESSES > 0:
+    worker_pool = CpuWorkerPool(WORKER_PROCESSES, env={
+        "WORKER_PROCESSES": "0",
+        "PRELOAD_MODELS": "",
+        "SHARED_WEIGHTS": str(SHARED_WEIGHTS).lower()
+    })
+
+# Opt-in torch.compile (inductor) + channels_last for UNet and VAE decoder on CPU/CUDA.
+# Sizes snap to COMPILE_BUCKETS so compiled graphs are reused; the inductor cache
+# in COMPILE_CACHE_DIR survives restarts
+COMPILE_MODE = os.getenv("COMPILE_MODE", "off").lower()
+if COMPILE_MODE not in COMPILE_MODES:
+    logger.warning(f"⚠️ Unknown COMPILE_MODE '{COMPILE_MODE}', expected one of {COMPILE_MODES}; compilation disabled")
+    COMPILE_MODE = "off"
+COMPILE_BUCKETS = parse_buckets(os.getenv("COMPILE_BUCKETS", DEFAULT_BUCKETS))
+if COMPILE_MODE != "off":
+    logger.info(f"⚙️ COMPILE_MODE={COMPILE_MODE} | inductor cache: {configure_compile_cache(os.getenv('COMPILE_CACHE_DIR', 'compile_cache'))}")
+
+# CPU weights dtype: fp32 (default), bf16, or auto (bf16 only when the CPU has native
+# support and a quick startup benchmark shows it is faster). The VAE always decodes in fp32
+CPU_TORCH_DTYPE, CPU_DTYPE_REPORT = resolve_cpu_dtype(os.getenv("CPU_DTYPE", "fp32"))
+
+# int8 quantization of text encoder + UNet linears for CPU-served models
+# (none, int8-dynamic, int8-weight-only); per-model overrides live in get_model_config
+QUANTIZATION = os.getenv("QUANTIZATION", "none").lower()
+if QUANTIZATION not in QUANTIZATION_MODES:
+    logger.warning(f"⚠️ Unknown QUANTIZATION '{QUANTIZATION}', expected one of {QUANTIZATION_MODES}; using none")
+    QUANTIZATION = "none"
+quant_cache = QuantizedWeightCache(os.getenv("QUANT_CACHE_DIR", "quant_cache"))
+
+# Inference engine for SD 1.x/2.x models: torch, or onnx (ONNX Runtime CPU provider with the
+# text encoder/UNet/VAE decoder exported once into ONNX_CACHE_DIR); per-model overrides live
+# in get_model_config. SDXL and FLUX always run on torch
+ENGINE = os.getenv("ENGINE", "torch").lower()
+if ENGINE not in ENGINES:
+    logger.warning(f"⚠️ Unknown ENGINE '{ENGINE}', expected one of {ENGINES}; using torch")
+    ENGINE = "torch"
+ONNX_CACHE_DIR = Path(os.getenv("ONNX_CACHE_DIR", "onnx_cache"))
+ORT_INTRA_OP_THREADS = int(os.getenv("ORT_INTRA_OP_THREADS", str(num_threads)))
+ORT_INTER_OP_THREADS = int(os.getenv("ORT_INTER_OP_THREADS", "1"))
+
+# Measured host profile (s/step per resolution, attention/VAE slicing choice).
+# CALIBRATION: auto = reuse a matching profile or calibrate in the background at startup (queued
+# on the batcher, so requests wait for it rather than skew it), force = always recalibrate at
+# startup, off = keep the static guesses
+CALIBRATION = os.getenv("CALIBRATION", "auto").lower()
+calibrator = DeviceCalibrator(
+    os.getenv("CALIBRATION_PROFILE", "device_profile.json"),
+    target_seconds=float(os.getenv("TARGET_GENERATION_SECONDS", "30")),
+    max_seconds=float(os.getenv("MAX_GENERATION_SECONDS", "120")),
+    compile_mode=COMPILE_MODE
+)
+
+# Local model store (see model_store.py). prefer: models prefetched into MODEL_STORE_DIR load
+# offline from there, anything else still comes from the Hub; strict: store only, never the
+# network; off: always the Hub
+MODEL_STORE = os.getenv("MODEL_STORE", "prefer").lower()
+if MODEL_STORE not in STORE_MODES:
+    logger.warning(f"⚠️ Unknown MODEL_STORE '{MODEL_STORE}', expected one of {STORE_MODES}; using prefer")
+    MODEL_STORE = "prefer"
+if MODEL_STORE == "strict":
+    os.environ["HF_HUB_OFFLINE"] = "1"
+model_store = ModelStore(os.getenv("MODEL_STORE_DIR", "model_store"), token=os.getenv("HUGGINGFACE_HUB_TOKEN"))
+if MODEL_STORE != "off":
+    # Store-loaded models are not in the Hub cache; fingerprint them from the manifest checksums
+    # so the quantized cache, shared weights and component pool never hash their weights
+    add_fingerprint_source(model_store.files_fingerprint)
+
+# Comma-separated models (ids or aliases) loaded and warmed up in the background at boot
+PRELOAD_MODELS = [m.strip() for m in os.getenv("PRELOAD_MODELS", "").split(",") if m.strip()]
+WARMUP_SIZE = int(os.getenv("WARMUP_SIZE", "64"))
+WARMUP_STEPS = int(os.getenv("WARMUP_STEPS", "1"))
+
+# Cache to avoid reloading heavy pipelines on every request; LRU entries are
+# demoted to host RAM past the VRAM budget and dropped past the RAM budget
+pipes = TieredModelCache(
+    device_budget_bytes=MODEL_VRAM_BUDGET_GB * GB,
+    ram_budget_bytes=MODEL_RAM_BUDGET_GB * GB
+)
 
 class ImageRequest(BaseModel):
     """Simple request schema so FastAPI can validate payloads."""
     prompt: str
+    negative_prompt: Optional[str] = None
     model: str = "runwayml/stable-diffusion-v1-5"
     steps: int = 10  # Default kept small for latency, automatically tuned later
     guidance_scale: float = 7.5
@@ -76,6 +314,18 @@ class ImageRequest(BaseModel):
     height: int = 512
     size: str = "512x512"
     scheduler: str = "auto"  # auto, dpm++, euler_a, ddim
+    seed: Optional[int] = None  # Fixed seed makes the run deterministic and cacheable
+    num_images: int = 1  # Variations from consecutive seeds (starting at `seed`), batched together
+    seeds: Optional[List[int]] = None  # Explicit seed sweep; overrides seed / num_images
+    cache: str = "prefer"  # bypass, prefer, only
+    response_format: str = "base64"  # base64, url, binary
+    image_format: str = "png"  # png, webp, jpeg, avif
+    quality: Optional[int] = None  # 1-100, lossy formats only
+    compress_level: Optional[int] = None  # 0-9, PNG only
+    tiling: str = "auto"  # auto (tile sizes above the device cap), off (shrink to the cap)
+    hires: bool = False  # Two-pass: low-res draft, latent upscale, short refinement at full size
+    hires_strength: float = 0.5  # Share of the noise schedule the refinement pass re-runs
+    hires_steps: Optional[int] = None  # Refinement steps (default: half of steps)
     
     def __init__(self, **data):
         super().__init__(**data)
@@ -89,8 +339,43 @@ class ImageRequest(BaseModel):
             except:
                 pass
 
+class StreamRequest(ImageRequest):
+    """Generation payload plus how often (in steps) to attach a latent preview; 0 disables."""
+    preview_every: int = 0
+
+class EditRequest(ImageRequest):
+    """img2img payload: a source image, an optional inpainting mask and how much to change.
+    
+    Without width/height/size the output keeps the source's size (within the device cap).
+    """
+    image: Optional[str] = None  # Base64 source image (data URLs accepted)
+    image_url: Optional[str] = None  # ...or an http(s) URL to fetch it from (needs EDIT_URL_FETCH=true)
+    mask: Optional[str] = None  # Base64 inpainting mask: white is repainted, black is kept
+    mask_url: Optional[str] = None
+    strength: float = 0.6  # Share of the noise schedule re-run; 1.0 ignores the source entirely
+
+class UpscaleRequest(BaseModel):
+    """Super-resolution payload: a source image, the factor and the upscaler to use."""
+    image: Optional[str] = None  # Base64 source image (data URLs accepted)
+    image_url: Optional[str] = None  # ...or an http(s) URL to fetch it from (needs EDIT_URL_FETCH=true)
+    scale: int = 2  # 2 or 4
+    model: Optional[str] = None  # lanczos, esrgan, sd-x4 (default: UPSCALER_MODEL)
+    prompt: str = ""  # Only guides the sd-x4 upscaler
+    seed: Optional[int] = None  # sd-x4 only; the other upscalers are deterministic
+    tile: Optional[int] = None  # Input tile size in pixels (default: the model's)
+    cache: str = "prefer"  # bypass, prefer, only
+    response_format: str = "base64"  # base64, url, binary
+    image_format: str = "png"  # png, webp, jpeg, avif
+    quality: Optional[int] = None  # 1-100, lossy formats only
+    compress_level: Optional[int] = None  # 0-9, PNG only
+
+class JobRequest(ImageRequest):
+    """Generation payload plus queue priority (higher runs first)."""
+    priority: int = 0
+
+@lru_cache(maxsize=None)
 def detect_device():
-    """Detect the best available compute device honoring override flags."""
+    """Detect the best available compute device honoring override flags (probed once per process)."""
     try:
         if FORCE_CPU:
             logger.info("⚠️ FORCE_CPU enabled - forcing CPU execution")
@@ -133,6 +418,14 @@ def detect_device():
         logger.warning(f"Device detection failed ({e}); falling back to CPU")
         return "cpu"
 
+def pipeline_dtype(device):
+    """Weights dtype used for SD pipelines on `device`."""
+    if device == "cuda":
+        return torch.float16
+    if device == "cpu":
+        return CPU_TORCH_DTYPE
+    return torch.float32
+
 def get_scheduler(pipe, scheduler_name, device="cpu", model_name=""):
     """Attach a scheduler tuned for the current device/model combination."""
     from diffusers import (
@@ -180,13 +473,18 @@ def get_model_config(model_name, device="cpu"):
         base_steps = 15  # CPU-only path needs a balance between time and detail
         scheduler = "dpm++"
     
+    # Once calibrated, pick the step count that fits the latency target on this host
+    base_steps = calibrator.default_steps(base_steps)
+    
     configs = {
         'runwayml/stable-diffusion-v1-5': {
             'steps': base_steps,
             'guidance_scale': 7.5,
             'size': '512x512',
             'scheduler': scheduler,
-            'memory_efficient': True
+            'memory_efficient': True,
+            'quantization': QUANTIZATION,
+            'engine': ENGINE
         },
         'stabilityai/sdxl-turbo': {
             'steps': 4 if device == "dml" else 6,
@@ -194,168 +492,282 @@ def get_model_config(model_name, device="cpu"):
             'size': '512x512',
             'scheduler': 'euler_a',  # Euler A behaves better with Turbo
             'memory_efficient': True,
-            'is_turbo': True  # Flag so Turbo models get special handling downstream
+            'is_turbo': True,  # Flag so Turbo models get special handling downstream
+            'quantization': QUANTIZATION,
+            'engine': ENGINE
         },
         'lykon/dreamshaper-8': {
             'steps': base_steps,
             'guidance_scale': 7.5,
             'size': '512x512',
             'scheduler': 'euler_a',  # DreamShaper behaves better with Euler A
-            'memory_efficient': True
+            'memory_efficient': True,
+            'quantization': QUANTIZATION,
+            'engine': ENGINE
         },
         'prompthero/openjourney': {
             'steps': base_steps,
             'guidance_scale': 7.5,
             'size': '512x512',
             'scheduler': scheduler,
-            'memory_efficient': True
+            'memory_efficient': True,
+            'quantization': QUANTIZATION,
+            'engine': ENGINE
         },
         'Linaqruf/anything-v3.0': {
             'steps': base_steps,
             'guidance_scale': 7.5,
             'size': '512x512',
             'scheduler': scheduler,
-            'memory_efficient': True
+            'memory_efficient': True,
+            'quantization': QUANTIZATION,
+            'engine': ENGINE
         }
     }
     return configs.get(model_name, configs['runwayml/stable-diffusion-v1-5'])
 
+# Short names accepted from clients
+MODEL_ALIASES = {
+    'stable-diffusion-1.5': 'runwayml/stable-diffusion-v1-5',
+    'sd-1.5': 'runwayml/stable-diffusion-v1-5',
+    'sdxl-turbo': 'stabilityai/sdxl-turbo',
+    'dreamshaper': 'lykon/dreamshaper-8',
+    'openjourney': 'prompthero/openjourney',
+    'anything-v3': 'Linaqruf/anything-v3.0',
+    'FLUX.1-dev': 'black-forest-labs/FLUX.1-schnell'
+}
+
+def resolve_model_name(model_name):
+    """Map a client-facing alias to its full Hugging Face model id."""
+    return MODEL_ALIASES.get(model_name, model_name)
+
+# One loader per model: a request arriving mid-preload waits instead of loading a second copy
+_load_locks = {}
+_load_locks_guard = threading.Lock()
+
 def get_pipe(model_name):
     """Lazy-load and memoize a Stable Diffusion pipeline with heavy tweaks."""
     
-    model_mapping = {
-        'stable-diffusion-1.5': 'runwayml/stable-diffusion-v1-5',
-        'sd-1.5': 'runwayml/stable-diffusion-v1-5',
-        'sdxl-turbo': 'stabilityai/sdxl-turbo',
-        'dreamshaper': 'lykon/dreamshaper-8',
-        'openjourney': 'prompthero/openjourney',
-        'anything-v3': 'Linaqruf/anything-v3.0',
-        'FLUX.1-dev': 'black-forest-labs/FLUX.1-schnell'
-    }
+    full_model_name = resolve_model_name(model_name)
     
-    full_model_name = model_mapping.get(model_name, model_name)
+    pipe = pipes.get(full_model_name)
+    if pipe is not None:
+        return pipe
     
-    if full_model_name not in pipes:
-        logger.info(f"Loading model: {full_model_name} (requested: {model_name})")
-        try:
-            device = detect_device()
+    with _load_locks_guard:
+        load_lock = _load_locks.setdefault(full_model_name, threading.Lock())
+    with load_lock:
+        pipe = pipes.get(full_model_name)
+        if pipe is not None:
+            return pipe
+        started = time.time()
+        pipe = _load_pipe(full_model_name, model_name)
+        preloader.record_load(full_model_name, time.time() - started, model_store.timings.get(full_model_name))
+        return pipe
+
+def load_pretrained(pipeline_cls, full_model_name, **kwargs):
+    """`from_pretrained` through the local model store; the Hub is only used outside strict mode."""
+    if MODEL_STORE != "off" and model_store.has(full_model_name):
+        return model_store.load(pipeline_cls, full_model_name, **kwargs)
+    if MODEL_STORE == "strict":
+        raise RuntimeError(
+            f"{full_model_name} is not in the model store ({model_store.root}); prefetch it with "
+            f"POST /models/store/prefetch or `python model_store.py prefetch {full_model_name}`"
+        )
+    return pipeline_cls.from_pretrained(full_model_name, token=os.getenv("HUGGINGFACE_HUB_TOKEN"), **kwargs)
+
+def lpw_pipeline_kwargs():
+    """custom_pipeline arguments for LPW: the vendored copy, else the Hub (never in strict mode)."""
+    if LPW_PIPELINE_PATH.exists():
+        return {"custom_pipeline": str(LPW_PIPELINE_PATH), "trust_remote_code": True}
+    if MODEL_STORE == "strict":
+        logger.warning("⚠️ No vendored LPW pipeline (run `python model_store.py vendor-lpw`); prompts load without weighting")
+        return {}
+    return {"custom_pipeline": "lpw_stable_diffusion"}
+
+def _load_pipe(full_model_name, model_name):
+    """Build a pipeline with device-specific tweaks and place it in the model cache."""
+    logger.info(f"Loading model: {full_model_name} (requested: {model_name})")
+    try:
+        device = detect_device()
+        
+        # --- 1. FLUX Handling (Specific Logic) ---
+        if "flux" in full_model_name.lower():
+            from diffusers import FluxPipeline
+            logger.info("Flux model detected. Using FluxPipeline with bfloat16.")
             
-            # --- 1. FLUX Handling (Specific Logic) ---
-            if "flux" in full_model_name.lower():
-                from diffusers import FluxPipeline
-                logger.info("Flux model detected. Using FluxPipeline with bfloat16.")
-                
-                if device == "dml":
-                    logger.warning("⚠️ FLUX on DirectML (Windows) might be extremely slow or fail. Expect issues.")
-                
-                # Flux requires bfloat16 for best results/compatibility
-                pipes[full_model_name] = FluxPipeline.from_pretrained(
-                    full_model_name,
-                    torch_dtype=torch.bfloat16,
-                    token=os.getenv("HUGGINGFACE_HUB_TOKEN")
-                )
-                
-                # Flux is VRAM hungry; force offload to system RAM even on GPU
-                # This ensures it fits in 12GB VRAM cards alongside Windows overhead
-                try:
-                    pipes[full_model_name].enable_model_cpu_offload()
-                    logger.info("Enabled CPU offload for Flux.")
-                except Exception as e:
-                    logger.warning(f"Could not enable CPU offload for Flux: {e}")
-                    
-                # Return immediately as Flux doesn't use the standard schedulers/optimizations below
-                return pipes[full_model_name]
-
-            # --- 2. Standard SD/SDXL Handling ---
             if device == "dml":
-                torch_dtype = torch.float32
-            elif device == "cuda":
-                torch_dtype = torch.float16
-            else:
-                torch_dtype = torch.float32
-            
-            logger.info(f"Using device: {device}, dtype: {torch_dtype}")
+                logger.warning("⚠️ FLUX on DirectML (Windows) might be extremely slow or fail. Expect issues.")
             
-            from diffusers import StableDiffusionPipeline
+            # Flux requires bfloat16 for best results/compatibility
+            pipe = load_pretrained(FluxPipeline, full_model_name, torch_dtype=torch.bfloat16)
             
-            # Determine if we should apply Long Prompt Weighting (LPW)
-            # Only for SD 1.5 based models. SDXL handles text differently (dual encoders).
-            is_sdxl = "sdxl" in full_model_name.lower()
-            custom_pipe_arg = None
+            # Flux is VRAM hungry; force offload to system RAM even on GPU
+            # This ensures it fits in 12GB VRAM cards alongside Windows overhead
+            try:
+                pipe.enable_model_cpu_offload()
+                logger.info("Enabled CPU offload for Flux.")
+            except Exception as e:
+                logger.warning(f"Could not enable CPU offload for Flux: {e}")
             
+            # Offload hooks own placement, so the cache must never move this pipe
+            # Return immediately as Flux doesn't use the standard schedulers/optimizations below
+            return pipes.put(full_model_name, pipe, device="cpu", movable=False)
+        
+        is_sdxl = "sdxl" in full_model_name.lower()
+        model_config = get_model_config(full_model_name, device)
+        
+        # --- 2. ONNX Runtime (SD 1.x/2.x only) ---
+        if model_config.get('engine', 'torch') == "onnx":
             if not is_sdxl:
-                custom_pipe_arg = "lpw_stable_diffusion"
-                logger.info("Enabling Long Prompt Weighting (LPW) for SD 1.5 model")
-            else:
-                logger.info("SDXL detected - skipping LPW (using native dual-encoder handling)")
-
-            pipes[full_model_name] = StableDiffusionPipeline.from_pretrained(
-                full_model_name, 
-                torch_dtype=torch_dtype,
-                safety_checker=None,  # Disable safety checker for throughput gains
-                requires_safety_checker=False,
-                token=os.getenv("HUGGINGFACE_HUB_TOKEN"), # Updated from use_auth_token
-                custom_pipeline=custom_pipe_arg
-            )
+                return _load_onnx_pipe(full_model_name, model_config)
+            logger.warning(f"⚠️ ENGINE=onnx is not supported for SDXL; loading {full_model_name} on torch")
+        
+        # --- 3. Standard SD/SDXL Handling ---
+        torch_dtype = pipeline_dtype(device)
+        
+        logger.info(f"Using device: {device}, dtype: {torch_dtype}")
+        
+        from diffusers import StableDiffusionPipeline
+        
+        # Determine if we should apply Long Prompt Weighting (LPW)
+        # Only for SD 1.5 based models. SDXL handles text differently (dual encoders).
+        custom_pipe_args = {}
+        
+        if not is_sdxl:
+            custom_pipe_args = lpw_pipeline_kwargs()
+            logger.info("Enabling Long Prompt Weighting (LPW) for SD 1.5 model")
+        else:
+            logger.info("SDXL detected - skipping LPW (using native dual-encoder handling)")
+        
+        # Quantized linears only run on CPU; pool quantized components apart from float ones
+        quantization = model_config.get('quantization', 'none') if device == "cpu" else "none"
+        if quantization != "none" and torch_dtype != torch.float32:
+            logger.info(f"{quantization} needs fp32 activations; loading {full_model_name} in fp32")
+            torch_dtype = torch.float32
+        pool_dtype = torch_dtype if quantization == "none" else f"{torch_dtype}+{quantization}"
+        
+        # Components already resident for another checkpoint are passed in instead of reloaded
+        pooled = component_pool.lookup(full_model_name, pool_dtype) if COMPONENT_SHARING else {}
+        
+        pipe = load_pretrained(
+            StableDiffusionPipeline,
+            full_model_name,
+            torch_dtype=torch_dtype,
+            safety_checker=None,  # Disable safety checker for throughput gains
+            requires_safety_checker=False,
+            **custom_pipe_args,
+            **pooled
+        )
+        
+        if COMPONENT_SHARING:
+            pipe = component_pool.register(pipe, full_model_name, pool_dtype)
+        
+        if quantization != "none":
+            quantize_pipeline(pipe, full_model_name, quantization, quant_cache)
+        
+        # bf16 UNet / text encoder run under autocast; decoding stays fp32 for quality
+        if torch_dtype == torch.bfloat16:
+            keep_vae_fp32(pipe)
+        
+        # Apply Device-Specific Optimizations
+        target_device = device
+        movable = True
+        if device == "dml":
+            try:
+                pipe = pipe.to("dml")
+                logger.info("Using DirectML device: dml")
+            except Exception as e:
+                logger.warning(f"Could not use DirectML with .to('dml'): {e}")
+                try:
+                    import torch_directml
+                    target_device = torch_directml.device()
+                    pipe = pipe.to(target_device)
+                    logger.info(f"Using DirectML device: {target_device}")
+                except Exception as e2:
+                    logger.warning(f"Could not use DirectML, falling back to CPU: {e2}")
+                    pipe = pipe.to("cpu")
+                    device = "cpu"
+                    target_device = "cpu"
             
-            # Apply Device-Specific Optimizations
             if device == "dml":
-                try:
-                    pipes[full_model_name] = pipes[full_model_name].to("dml")
-                    logger.info("Using DirectML device: dml")
-                except Exception as e:
-                    logger.warning(f"Could not use DirectML with .to('dml'): {e}")
-                    try:
-                        import torch_directml
-                        dml_device = torch_directml.device()
-                        pipes[full_model_name] = pipes[full_model_name].to(dml_device)
-                        logger.info(f"Using DirectML device: {dml_device}")
-                    except Exception as e2:
-                        logger.warning(f"Could not use DirectML, falling back to CPU: {e2}")
-                        pipes[full_model_name] = pipes[full_model_name].to("cpu")
-                        device = "cpu"
+                pipe.enable_attention_slicing(1)
+                pipe.enable_vae_slicing()
+                logger.info("Applied AMD GPU optimizations (DirectML)")
                 
-                if device == "dml":
-                    pipes[full_model_name].enable_attention_slicing(1)
-                    pipes[full_model_name].enable_vae_slicing()
-                    logger.info("Applied AMD GPU optimizations (DirectML)")
-                    
-            elif device == "cuda":
-                pipes[full_model_name] = pipes[full_model_name].to("cuda")
-                pipes[full_model_name].enable_attention_slicing()
-                pipes[full_model_name].enable_vae_slicing()
-                try:
-                    pipes[full_model_name].enable_xformers_memory_efficient_attention()
-                    logger.info("Applied NVIDIA GPU optimizations (with xformers)")
-                except:
-                    logger.info("Applied NVIDIA GPU optimizations (without xformers)")
-                    
-            else:
-                pipes[full_model_name] = pipes[full_model_name].to("cpu")
-                pipes[full_model_name].enable_attention_slicing()
-                pipes[full_model_name].enable_vae_slicing()
+        elif device == "cuda":
+            pipe = pipe.to("cuda")
+            pipe.enable_attention_slicing()
+            pipe.enable_vae_slicing()
+            try:
+                pipe.enable_xformers_memory_efficient_attention()
+                logger.info("Applied NVIDIA GPU optimizations (with xformers)")
+            except:
+                logger.info("Applied NVIDIA GPU optimizations (without xformers)")
                 
-                try:
-                    pipes[full_model_name].enable_model_cpu_offload()
-                    logger.info("Applied CPU optimizations with model offload")
-                except:
-                    logger.info("Applied CPU optimizations (standard mode)")
-            
-            # Apply Scheduler Configuration
-            model_config = get_model_config(full_model_name, device)
-            pipes[full_model_name] = get_scheduler(
-                pipes[full_model_name], 
-                model_config['scheduler'],
-                device
-            )
-            
-            logger.info(f"✅ Model {full_model_name} loaded successfully")
+        else:
+            pipe = pipe.to("cpu")
+            pipe.enable_attention_slicing()
+            pipe.enable_vae_slicing()
             
-        except Exception as e:
-            logger.error(f"❌ Error loading model {full_model_name}: {e}")
-            raise HTTPException(status_code=500, detail=f"Error loading model: {str(e)}")
+            try:
+                pipe.enable_model_cpu_offload()
+                movable = False
+                logger.info("Applied CPU optimizations with model offload")
+            except:
+                logger.info("Applied CPU optimizations (standard mode)")
+        
+        # The calibrated attention / VAE slicing choice beats the per-device defaults above
+        if calibrator.profile:
+            apply_pipeline_settings(pipe, calibrator.profile)
+        
+        if COMPILE_MODE != "off" and device in ("cpu", "cuda"):
+            compile_pipeline(pipe, COMPILE_MODE)
+        
+        # Last, so the mapped copy already has its final dtype, quantization and memory format
+        if shared_weights is not None and device == "cpu":
+            shared = shared_weights.share_pipeline(pipe, full_model_name)
+            if shared:
+                logger.info(f"🔗 Mapped shared weights for {full_model_name}: {', '.join(shared)}")
+        
+        # Apply Scheduler Configuration
+        pipe = get_scheduler(
+            pipe, 
+            model_config['scheduler'],
+            device
+        )
+        
+        logger.info(f"✅ Model {full_model_name} loaded successfully")
+        
+    except Exception as e:
+        logger.error(f"❌ Error loading model {full_model_name}: {e}")
+        raise HTTPException(status_code=500, detail=f"Error loading model: {str(e)}")
+    
+    return pipes.put(full_model_name, pipe, device=target_device, movable=movable)
+
+def _load_onnx_pipe(full_model_name, model_config):
+    """Export the model to ONNX on first use, then serve it from ONNX Runtime on CPU."""
+    model_dir = onnx_model_dir(ONNX_CACHE_DIR, full_model_name)
+    if not is_exported(model_dir):
+        from diffusers import StableDiffusionPipeline
+        logger.info(f"📦 No ONNX export of {full_model_name} yet, exporting to {model_dir}")
+        torch_pipe = load_pretrained(
+            StableDiffusionPipeline,
+            full_model_name,
+            torch_dtype=torch.float32,
+            safety_checker=None,
+            requires_safety_checker=False
+        )
+        export_pipeline(torch_pipe, model_dir)
+        del torch_pipe
+        gc.collect()
+    
+    pipe = load_onnx_pipeline(model_dir, ORT_INTRA_OP_THREADS, ORT_INTER_OP_THREADS)
+    pipe = get_scheduler(pipe, model_config['scheduler'], "cpu")
+    logger.info(f"✅ Model {full_model_name} loaded on ONNX Runtime (intra-op threads: {ORT_INTRA_OP_THREADS})")
     
-    return pipes[full_model_name]
+    # ORT sessions own their memory; the cache may evict them but never moves them
+    return pipes.put(full_model_name, pipe, device="cpu", movable=False)
 
 @app.get("/health")
 def health_check():
@@ -375,28 +787,745 @@ def health_check():
         "gpu": "AMD Radeon RX 6750 XT (12GB)" if device == "dml" else "N/A",
         "ram": "32GB DDR5 5600MHz",
         "timestamp": datetime.now().isoformat(),
-        "loaded_models": list(pipes.keys()),
+        "loaded_models": pipes.keys(),
+        "model_loading": preloader.status()["models"],
+        "model_cache": pipes.stats(),
+        "component_pool": component_pool.summary(),
         "system_usage": {
             "cpu_percent": cpu_percent,
             "ram_percent": ram_percent
         },
+        "batching": {
+            "window_ms": BATCH_WINDOW_MS,
+            "max_batch_size": BATCH_MAX_SIZE,
+            "queue_depth": batcher.queue_depth(),
+            **batcher.stats
+        },
+        "jobs": jobs.stats(),
+        "workers": worker_pool.stats() if worker_pool is not None else {"mode": "in-process", "threads": num_threads},
+        "memory": {
+            "process": process_memory(),
+            "workers": [
+                process_memory(w["pid"]) for w in worker_pool.stats()["workers"] if w["pid"]
+            ] if worker_pool is not None else [],
+            "shared_weights": shared_weights.stats() if shared_weights is not None else {"enabled": False},
+            "planner": memory_planner.stats()
+        },
+        "prompt_cache": prompt_cache.stats(),
+        "latent_cache": latent_cache.stats(),
+        "upscaler": {
+            "default": UPSCALER_MODEL,
+            "loaded": list(_upscalers),
+            "queue_depth": upscale_batcher.queue_depth(),
+            **upscale_batcher.stats
+        },
+        "result_cache": result_store.stats(),
+        "coalescing": inflight.stats(),
+        "image_encoder": image_encoder.stats(),
+        "quantization": {"default": QUANTIZATION, "cache": quant_cache.stats()},
+        "engine": {
+            "default": ENGINE,
+            "onnx_cache_dir": str(ONNX_CACHE_DIR),
+            "onnx_models": [key for key in pipes.keys() if is_onnx_pipeline(pipes.peek(key))]
+        },
+        "cpu_dtype": CPU_DTYPE_REPORT,
+        "model_store": {"mode": MODEL_STORE, "root": str(model_store.root), "models": [m["model"] for m in model_store.list()]},
+        "calibration": calibrator.state,
         "optimizations": {
             "scheduler": "DPM++ 2M (default)",
-            "attention_slicing": "enabled",
-            "vae_slicing": "enabled",
-            "safety_checker": "disabled"
+            "attention_slicing": (calibrator.profile["attention"] == "sliced") if calibrator.profile else "enabled",
+            "vae_slicing": calibrator.profile["vae_slicing"] if calibrator.profile else "enabled",
+            "safety_checker": "disabled",
+            "compile_mode": COMPILE_MODE
         },
         "important_note": "⚠️ DirectML still runs on CPU. Use device='cpu' to free VRAM."
     }
     
     return health_info
 
+def _call_pipe(pipe, batch, steps, width, height):
+    """Run one batched pipeline call with per-item prompts, guidance and generators."""
+    if is_onnx_pipeline(pipe):
+        return _call_onnx_pipe(pipe, batch, steps, width, height)
+    if batch.get("edit"):
+        return _call_edit_pipe(pipe, batch, steps, width, height)
+    if batch.get("hires"):
+        return _call_hires_pipe(pipe, batch, steps, width, height)
+    if batch.get("tile"):
+        return _call_tiled_pipe(pipe, batch, steps, width, height)
+    
+    guidances = batch["guidances"]
+    generators = [torch.Generator("cpu").manual_seed(seed) for seed in batch["seeds"]]
+    prompt_args = _prompt_args(pipe, batch)
+    hook = _guidance_hook(pipe, guidances)
+    
+    # Step callbacks are only attached when a /generate/stream client is listening
+    progress_args = step_callback_kwargs(pipe, batch["progress_keys"], steps, progress_hub)
+    
+    try:
+        with autocast_context(pipe):
+            return pipe(
+                **prompt_args,
+                **progress_args,
+                num_inference_steps=steps,
+                guidance_scale=max(guidances),
+                height=height,
+                width=width,
+                generator=generators
+            )
+    finally:
+        if hook is not None:
+            hook.remove()
+
+def _prompt_args(pipe, batch):
+    """Cached text encoder outputs as pipeline kwargs; raw prompts when the pipeline can't take them."""
+    embeds = None
+    if PROMPT_CACHE_ENABLED:
+        with autocast_context(pipe):
+            embeds = prompt_cache.encode(pipe, batch["model"], batch["prompts"], batch["negative_prompts"])
+    if embeds is not None:
+        return {"prompt_embeds": embeds[0], "negative_prompt_embeds": embeds[1]}
+    return {
+        "prompt": batch["prompts"],
+        "negative_prompt": [n or "" for n in batch["negative_prompts"]]
+    }
+
+def _guidance_hook(pipe, guidances):
+    """UNet hook giving each item its own guidance scale, or None when they all agree.
+    
+    Pipelines only accept a scalar guidance_scale (the batch maximum); the hook rescales
+    the text branch per item so each image ends up with noise = uncond + g_i * (text - uncond).
+    """
+    guidance = max(guidances)
+    if len(set(guidances)) > 1 and guidance > 1.0 and hasattr(pipe, "unet"):
+        ratios = torch.tensor([max(g, 1.0) / guidance for g in guidances])
+        
+        def _per_item_guidance(module, args, output):
+            sample = output[0] if isinstance(output, tuple) else output.sample
+            uncond, text = sample.chunk(2)
+            ratio = ratios.to(sample.device, sample.dtype).view(-1, 1, 1, 1)
+            sample = torch.cat([uncond, uncond + ratio * (text - uncond)])
+            return (sample,) if isinstance(output, tuple) else type(output)(sample=sample)
+        
+        return pipe.unet.register_forward_hook(_per_item_guidance)
+    return None
+
+def _call_onnx_pipe(pipe, batch, steps, width, height):
+    """ONNX Runtime variant of _call_pipe.
+    
+    Seeds become starting latents drawn exactly as on torch, and since there is no UNet
+    hook to rescale guidance per item, each distinct guidance value gets its own call.
+    """
+    from diffusers.pipelines.stable_diffusion import StableDiffusionPipelineOutput
+    
+    groups = {}
+    for index, guidance in enumerate(batch["guidances"]):
+        groups.setdefault(guidance, []).append(index)
+    
+    images = [None] * len(batch["seeds"])
+    for guidance, indices in groups.items():
+        result = pipe(
+            prompt=[batch["prompts"][i] for i in indices],
+            negative_prompt=[batch["negative_prompts"][i] or "" for i in indices],
+            latents=initial_latents([batch["seeds"][i] for i in indices], width, height),
+            num_inference_steps=steps,
+            guidance_scale=guidance,
+            height=height,
+            width=width,
+            **step_callback_kwargs(pipe, [batch["progress_keys"][i] for i in indices], steps, progress_hub)
+        )
+        for i, image in zip(indices, result.images):
+            images[i] = image
+    return StableDiffusionPipelineOutput(images=images, nsfw_content_detected=None)
+
+def supports_latent_loop(model_name, model_config):
+    """Tiled and hires generation drive the UNet themselves: torch SD 1.x/2.x only (no SDXL, FLUX or ONNX)."""
+    full_model_name = resolve_model_name(model_name).lower()
+    return (
+        "flux" not in full_model_name
+        and "sdxl" not in full_model_name
+        and model_config.get('engine', 'torch') == "torch"
+    )
+
+def _prompt_pairs(pipe, batch):
+    """(prompt_embeds, negative_prompt_embeds) per image for the tiled / hires loops.
+    
+    Those loops call the UNet themselves, so they always take embeddings; one pair per
+    image keeps LPW prompts of different lengths apart.
+    """
+    with autocast_context(pipe):
+        embeds = [
+            prompt_cache.encode(pipe, batch["model"], [prompt], [negative_prompt])
+            for prompt, negative_prompt in zip(batch["prompts"], batch["negative_prompts"])
+        ]
+    if any(e is None for e in embeds):
+        raise HTTPException(status_code=422, detail="Tiled and hires generation need a torch SD 1.x/2.x model")
+    return embeds
+
+def _call_tiled_pipe(pipe, batch, steps, width, height):
+    """Tiled variant of _call_pipe for canvases above the size cap (see tiled_diffusion.py)."""
+    from diffusers.pipelines.stable_diffusion import StableDiffusionPipelineOutput
+    
+    embeds = _prompt_pairs(pipe, batch)
+    on_step = step_function(pipe, step_callback_kwargs(pipe, batch["progress_keys"], steps, progress_hub))
+    with autocast_context(pipe):
+        images = tiled_generate(
+            pipe, embeds, batch["seeds"], batch["guidances"], steps, width, height,
+            tile=batch["tile"], overlap=TILE_OVERLAP, tile_batch=TILE_BATCH, on_step=on_step
+        )
+    return StableDiffusionPipelineOutput(images=images, nsfw_content_detected=None)
+
+def _call_hires_pipe(pipe, batch, steps, width, height):
+    """Two-pass variant of _call_pipe (see hires_fix.py); the output carries a `hires` report."""
+    from diffusers.pipelines.stable_diffusion import StableDiffusionPipelineOutput
+    
+    draft_width, draft_height, strength, hires_steps = batch["hires"]
+    embeds = _prompt_pairs(pipe, batch)
+    on_step = step_function(
+        pipe, step_callback_kwargs(pipe, batch["progress_keys"], steps + hires_steps, progress_hub)
+    )
+    with autocast_context(pipe):
+        images, report = hires_generate(
+            pipe, embeds, batch["seeds"], batch["guidances"], steps, width, height,
+            min(draft_width, width), min(draft_height, height),
+            strength=strength, hires_steps=hires_steps, upscale=HIRES_UPSCALE,
+            tile=batch.get("tile"), overlap=TILE_OVERLAP, tile_batch=TILE_BATCH, on_step=on_step
+        )
+    output = StableDiffusionPipelineOutput(images=images, nsfw_content_detected=None)
+    output.hires = report
+    return output
+
+def _call_edit_pipe(pipe, batch, steps, width, height):
+    """img2img / inpaint variant of _call_pipe (see image_editing.py); the output carries an `edit` report.
+    
+    Sources go in as cached latents, and only the last `strength` of the `steps`
+    schedule is denoised.
+    """
+    strength, inpaint = batch["edit"]
+    edit_pipe = edit_pipeline(pipe, inpaint=inpaint)
+    
+    with autocast_context(pipe):
+        encoded = [
+            latent_cache.encode(pipe, batch["model"], image, digest, width, height)
+            for image, digest in zip(batch["images"], batch["image_digests"])
+        ]
+    latents = torch.cat([latent for latent, _ in encoded])
+    mask_args = {}
+    if inpaint:
+        # Masked-image conditioning only matters to 9-channel inpainting UNets; regular
+        # checkpoints blend the source latents back outside the mask instead
+        masked = latents
+        if pipe.unet.config.in_channels == 9:
+            with autocast_context(pipe):
+                masked = torch.cat([
+                    latent_cache.encode(
+                        pipe, batch["model"],
+                        masked_source(image, mask),
+                        f"{digest}/{mask_digest}", width, height
+                    )[0]
+                    for image, digest, mask, mask_digest in zip(
+                        batch["images"], batch["image_digests"], batch["masks"], batch["mask_digests"]
+                    )
+                ])
+        mask_args = {"mask_image": batch["masks"], "masked_image_latents": masked, "height": height, "width": width}
+    
+    guidances = batch["guidances"]
+    generators = [torch.Generator("cpu").manual_seed(seed) for seed in batch["seeds"]]
+    prompt_args = _prompt_args(pipe, batch)
+    hook = _guidance_hook(pipe, guidances)
+    run_steps = effective_steps(steps, strength)
+    progress_args = step_callback_kwargs(edit_pipe, batch["progress_keys"], run_steps, progress_hub)
+    try:
+        with autocast_context(pipe):
+            output = edit_pipe(
+                **prompt_args,
+                **progress_args,
+                **mask_args,
+                image=latents,
+                strength=strength,
+                num_inference_steps=steps,
+                guidance_scale=max(guidances),
+                generator=generators
+            )
+    finally:
+        if hook is not None:
+            hook.remove()
+    output.edit = {
+        "mode": "inpaint" if inpaint else "img2img",
+        "strength": strength,
+        "denoise_steps": run_steps,
+        "latent_cache": ["hit" if hit else "miss" for _, hit in encoded]
+    }
+    return output
+
+def get_cpu_replica(model_name):
+    """fp32 CPU copy of a model for fallback runs, cached apart from its device pipeline.
+    
+    The cached device pipeline is never moved to the CPU: other requests may be using it
+    and moving it back would cost a full reload of its weights.
+    """
+    full_model_name = resolve_model_name(model_name)
+    key = f"{full_model_name}@cpu"
+    replica = pipes.get(key)
+    if replica is not None:
+        return replica
+    
+    with _load_locks_guard:
+        load_lock = _load_locks.setdefault(key, threading.Lock())
+    with load_lock:
+        replica = pipes.get(key)
+        if replica is not None:
+            return replica
+        from diffusers import StableDiffusionPipeline
+        logger.info(f"🧊 Loading CPU replica of {full_model_name} for fallback runs")
+        replica = load_pretrained(
+            StableDiffusionPipeline,
+            full_model_name,
+            torch_dtype=torch.float32,
+            safety_checker=None,
+            requires_safety_checker=False,
+            **(lpw_pipeline_kwargs() if "sdxl" not in full_model_name.lower() else {})
+        ).to("cpu")
+        replica.enable_attention_slicing()
+        replica.enable_vae_slicing()
+        return pipes.put(key, replica, device="cpu", movable=False)
+
+def plan_memory(pipe, batch_size, width, height, guidance, device):
+    """Pre-flight memory plan for a generation on `pipe` (see memory_estimator.py)."""
+    return memory_planner.plan(
+        pipe, batch_size, width, height, guidance > 1.0, device,
+        device_capacity=DML_VRAM_GB * GB,
+        device_used=pipes.stats()["usage_gb"]["device"] * GB
+    )
+
+def _run_on_cpu_replica(pipe, batch, steps, width, height):
+    """Run a batch on the model's CPU replica with the same scheduler as `pipe`."""
+    replica = get_cpu_replica(batch["model"])
+    replica.scheduler = type(pipe.scheduler).from_config(pipe.scheduler.config)
+    # Own prompt-cache namespace: the device pipeline's embeddings live on another device/dtype
+    replica_batch = {**batch, "model": f"{batch['model']}@cpu"}
+    plan, replica_batch, width, height = _plan_batch(replica, replica_batch, width, height, "cpu")
+    if not plan["fits"]:
+        raise HTTPException(
+            status_code=507,
+            detail=f"Not enough memory for {len(batch['prompts'])}x {width}x{height} on the CPU either: "
+                   f"needs ~{plan['needed_gb']} GB, {plan['available_gb']} GB free"
+        )
+    with applied_plan(replica, plan):
+        return _call_pipe(replica, replica_batch, steps, width, height), plan, width, height
+
+def _plan_batch(pipe, batch, width, height, device):
+    """Plan a batch; returns (plan, batch, width, height) adjusted to it.
+    
+    Tiled batches hold TILE_BATCH windows of one image at a time, so they are planned at
+    tile size, and a smaller planned size shrinks the tile rather than the canvas.
+    """
+    tile = batch.get("tile")
+    if not tile:
+        plan = plan_memory(pipe, len(batch["prompts"]), width, height, max(batch["guidances"]), device)
+        return plan, batch, plan["width"], plan["height"]
+    tile_w, tile_h = min(tile, width), min(tile, height)
+    plan = plan_memory(pipe, TILE_BATCH, tile_w, tile_h, max(batch["guidances"]), device)
+    if (plan["width"], plan["height"]) != (tile_w, tile_h):
+        batch = {**batch, "tile": plan["width"]}
+    return plan, batch, width, height
+
+def _run_pipe_with_fallbacks(pipe, batch, steps, width, height):
+    """Call the pipeline with slicing/size planned to fit in memory up front.
+    
+    When the device can't fit the run, or fails anyway, it goes to a CPU replica.
+    Returns (result, width, height, plan).
+    """
+    device = detect_device()
+    requested = (width, height)
+    plan, batch, width, height = _plan_batch(pipe, batch, width, height, device)
+    if not plan["fits"]:
+        raise HTTPException(
+            status_code=507,
+            detail=f"Not enough memory for {len(batch['prompts'])}x {width}x{height}: needs ~{plan['needed_gb']} GB, "
+                   f"{plan['available_gb']} GB free"
+        )
+    if (width, height) != requested:
+        logger.warning(f"⚠️ {requested[0]}x{requested[1]} does not fit in memory; generating {width}x{height}")
+    
+    if plan["target"] == "cpu-replica":
+        logger.warning(f"⚠️ Needs ~{plan['needed_gb']} GB, {device} has too little free; running on the CPU replica")
+        result, plan, width, height = _run_on_cpu_replica(pipe, batch, steps, *requested)
+        return result, width, height, {**plan, "target": "cpu-replica"}
+    
+    measure = device == "cuda" and plan["planned"]
+    if measure:
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated()
+    try:
+        with applied_plan(pipe, plan):
+            result = _call_pipe(pipe, batch, steps, width, height)
+    except Exception as gen_error:
+        error_str = str(gen_error).lower()
+        dml_error = "dml" in error_str or "privateuseone" in error_str
+        if device == "cpu" or not (is_memory_error(gen_error) or dml_error):
+            raise
+        logger.warning(f"⚠️ {'DirectML' if dml_error else 'Memory'} error despite the plan: {gen_error}")
+        logger.info("Falling back to the CPU replica...")
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        result, plan, width, height = _run_on_cpu_replica(pipe, batch, steps, *requested)
+        logger.info("✅ Generation completed on the CPU replica")
+        return result, width, height, {**plan, "target": "cpu-replica"}
+    
+    if measure:
+        memory_planner.observe(plan, torch.cuda.max_memory_allocated() - baseline)
+    return result, width, height, plan
+
+# Batch key of an in-process calibration run (see start_calibration_run)
+CALIBRATION_BATCH_KEY = ("calibration",)
+
+def run_generation_batch(key, items):
+    """Batcher callback: one pipeline run for every queued request sharing `key`."""
+    if key == CALIBRATION_BATCH_KEY:
+        # Timed on the dispatcher thread, so no real batch competes with the measurement
+        device = detect_device()
+        calibrator.calibrate(device, pipeline_dtype(device))
+        return [calibrator.profile for _ in items]
+    if worker_pool is not None:
+        return _dispatch_to_worker(key, items)
+    
+    # variant: None, ("hires", draft_width, draft_height, strength, hires_steps) or ("edit", strength, inpaint)
+    model, width, height, steps, scheduler, variant = key
+    kind = variant[0] if variant else None
+    current_device = detect_device()
+    
+    pipe = get_pipe(model)
+    
+    if scheduler != "auto":
+        pipe = get_scheduler(pipe, scheduler, current_device, model)
+    
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    
+    batch = {
+        "model": model,
+        "prompts": [item.payload["prompt"] for item in items],
+        "negative_prompts": [item.payload["negative_prompt"] for item in items],
+        "guidances": [item.payload["guidance_scale"] for item in items],
+        "seeds": [item.payload["seed"] for item in items],
+        "progress_keys": [item.payload["progress_key"] for item in items],
+        # Items sharing a key share their size, so they agree on tiling too
+        "tile": items[0].payload.get("tile"),
+        "hires": variant[1:] if kind == "hires" else None,
+        "edit": variant[1:] if kind == "edit" else None
+    }
+    if kind == "edit":
+        batch.update({
+            "images": [item.payload["image"] for item in items],
+            "image_digests": [item.payload["image_digest"] for item in items],
+            "masks": [item.payload["mask"] for item in items],
+            "mask_digests": [item.payload["mask_digest"] for item in items]
+        })
+    
+    if len(items) > 1:
+        logger.info(f"📦 Batched {len(items)} requests | Model: {model} | {width}x{height} | Steps: {steps}")
+    
+    results = []
+    for chunk in _split_for_memory(pipe, batch, width, height, current_device):
+        result, chunk_width, chunk_height, plan = _run_pipe_with_fallbacks(pipe, chunk, steps, width, height)
+        memory_plan = {
+            k: plan[k] for k in ("target", "attention_slice", "vae_slicing", "vae_tiling", "needed_gb", "available_gb")
+        } if plan["planned"] else None
+        edit = getattr(result, "edit", None)
+        results.extend(
+            {
+                "image": image,
+                "width": chunk_width,
+                "height": chunk_height,
+                "batch_size": len(chunk["prompts"]),
+                "memory_plan": memory_plan,
+                "hires": getattr(result, "hires", None),
+                "edit": {**edit, "latent_cache": edit["latent_cache"][index]} if edit else None
+            }
+            for index, image in enumerate(result.images)
+        )
+    
+    for item, result in zip(items, results):
+        result["queue_wait"] = item.queue_wait
+    return results
+
+def _split_for_memory(pipe, batch, width, height, device):
+    """Split a batch into the largest chunks the device fits at the requested size.
+    
+    Tiled and hires batches already take images through the UNet one at a time, so they
+    are never split; a single image still gets the planner's slicing/downscale/replica path.
+    """
+    total = len(batch["prompts"])
+    if total == 1 or batch.get("tile") or batch.get("hires"):
+        return [batch]
+    size = total
+    while size > 1:
+        plan = plan_memory(pipe, size, width, height, max(batch["guidances"]), device)
+        if plan["fits"] and plan["target"] == "device" and (plan["width"], plan["height"]) == (width, height):
+            break
+        size = (size + 1) // 2
+    if size < total:
+        logger.info(f"🧮 Batch of {total} split into chunks of {size} to fit in memory")
+    return [
+        {k: v[start:start + size] if isinstance(v, list) else v for k, v in batch.items()}
+        for start in range(0, total, size)
+    ]
+
+def _dispatch_to_worker(key, items):
+    """Run a batch on the next idle pool worker, relaying its step events to our progress hub."""
+    payloads = []
+    for item in items:
+        # Workers only stream steps somebody is listening to
+        progress_key = item.payload["progress_key"]
+        payloads.append({**item.payload, "progress_key": progress_key if progress_hub.has_subscribers(progress_key) else None})
+    results = worker_pool.submit(
+        ("generate", key, payloads),
+        on_event=lambda event: progress_hub.publish(
+            event[0], event[1], torch.from_numpy(event[2]) if event[2] is not None else None
+        )
+    )
+    for item, result in zip(items, results):
+        result["queue_wait"] = item.queue_wait
+    return results
+
+def pool_worker_init(index, emit):
+    """Entry point inside a WORKER_PROCESSES child; returns the handler for dispatched tasks."""
+    global progress_hub
+    progress_hub = ProgressRelay(emit)
+    logger.info(f"👷 Worker #{index} (pid {os.getpid()}) using {num_threads} threads")
+    # FastAPI startup hooks never run in workers; a profile measured at this thread count
+    # loads here, otherwise the dispatcher sends one once a worker has calibrated
+    if CALIBRATION == "auto":
+        device = detect_device()
+        calibrator.load(device, pipeline_dtype(device))
+    
+    def handle(task):
+        op, *args = task
+        if op == "generate":
+            key, payloads = args
+            return run_generation_batch(key, [BatchItem(key, payload) for payload in payloads])
+        if op == "load":
+            get_pipe(args[0])
+            return None
+        if op == "warmup":
+            warm_up_model(args[0])
+            return None
+        if op == "estimate":
+            return _estimate_memory(*args)
+        if op == "calibrate":
+            force = args[0]
+            if force or calibrator.profile is None:
+                device = detect_device()
+                calibrator.calibrate(device, pipeline_dtype(device))
+            return calibrator.profile
+        if op == "calibration":
+            use_calibration_profile(args[0])
+            return None
+        raise ValueError(f"Unknown worker task: {op}")
+    
+    return handle
+
+# Requests sharing model/size/steps/scheduler within the window run as one batch;
+# in worker-pool mode one batch per worker process can be in flight
+batcher = GenerationBatcher(
+    run_generation_batch,
+    window_ms=BATCH_WINDOW_MS,
+    max_batch_size=BATCH_MAX_SIZE,
+    concurrency=max(WORKER_PROCESSES, 1)
+)
+
+# Loaded upscaler plug-ins by name; small next to the SD pipelines, so kept for the process lifetime
+_upscalers = {}
+_upscalers_lock = threading.Lock()
+
+def get_upscaler(name):
+    with _upscalers_lock:
+        upscaler = _upscalers.get(name)
+        if upscaler is None:
+            upscaler = _upscalers[name] = _load_upscaler(name)
+        return upscaler
+
+def _load_upscaler(name):
+    """Build upscaler plug-in `name` on CUDA when available, else on the CPU in fp32."""
+    device = "cuda" if detect_device() == "cuda" else "cpu"
+    dtype = torch.float16 if device == "cuda" else torch.float32
+    if name == "lanczos":
+        return LanczosUpscaler()
+    if name == "esrgan":
+        if not UPSCALER_WEIGHTS:
+            raise HTTPException(status_code=422, detail="The esrgan upscaler needs an RRDBNet checkpoint in UPSCALER_WEIGHTS")
+        return ESRGANUpscaler(UPSCALER_WEIGHTS, device, dtype)
+    from diffusers import StableDiffusionUpscalePipeline
+    logger.info(f"🔎 Loading {SD_UPSCALER_MODEL} for sd-x4 upscaling")
+    pipe = load_pretrained(StableDiffusionUpscalePipeline, SD_UPSCALER_MODEL, torch_dtype=dtype).to(device)
+    pipe.enable_attention_slicing()
+    return SDLatentUpscaler(pipe, steps=UPSCALE_SD_STEPS)
+
+def run_upscale_batch(key, items):
+    """Upscale batcher callback: one network call for same-shaped tiles, whichever jobs they belong to."""
+    model, scale, _, _ = key
+    tiles = np.stack([item.payload["tile"] for item in items])
+    jobs = len({item.payload["job"] for item in items})
+    if jobs > 1:
+        logger.info(f"📦 Upscaling {len(items)} tiles from {jobs} jobs together | {model} x{scale}")
+    output = get_upscaler(model).upscale(
+        tiles, scale,
+        prompts=[item.payload["prompt"] for item in items],
+        seeds=[item.payload["seed"] for item in items]
+    )
+    return list(output)
+
+# Upscale tiles run in this process (also in worker-pool mode) on their own batcher, so long
+# upscales never hold up generation batches
+upscale_batcher = GenerationBatcher(
+    run_upscale_batch,
+    window_ms=UPSCALE_BATCH_WINDOW_MS,
+    max_batch_size=UPSCALE_TILE_BATCH
+)
+
+def _cached_response(req, cache_key, cached, lookup_time):
+    """Build the /generate payload for a result served from the result cache."""
+    image_bytes, stored = cached
+    return {
+        "success": True,
+        "data": {
+            "image_url": f"http://apibr.giesel.com.br/results/{cache_key}",
+            "local_path": str(result_store.path_for(cache_key)),
+            "prompt": req.prompt,
+            "model": req.model,
+            "size": stored.get("size", f"{req.width}x{req.height}"),
+            "timestamp": datetime.now().isoformat()
+        },
+        "metadata": {
+            **{k: v for k, v in stored.items() if k not in ("prompt", "size")},
+            "generation_time": round(lookup_time, 3),
+            "original_generation_time": stored.get("generation_time"),
+            "cache": "hit",
+            "cache_key": cache_key,
+            "timestamp": datetime.now().isoformat()
+        }
+    }, image_bytes
+
+def render_image_response(response, image_bytes, response_format):
+    """Shape a generation result as base64 JSON, URL-only JSON or raw image bytes."""
+    if response_format == "binary":
+        return Response(
+            content=image_bytes,
+            media_type=media_type(response["metadata"].get("image_format", "png")),
+            headers=metadata_headers(response["metadata"], response["data"]["image_url"])
+        )
+    return with_image_payload(response, image_bytes, response_format)
+
 @app.post("/generate")
 def generate_image(req: ImageRequest):
     """Main image generation endpoint with aggressive fallbacks."""
+    if req.response_format == "binary" and request_seeds(req) is not None:
+        raise HTTPException(status_code=422, detail="response_format 'binary' returns one image; use base64 or url with num_images/seeds")
+    response, image_bytes = _generate_images(req)
+    return render_image_response(response, image_bytes, req.response_format)
+
+def request_seeds(req):
+    """Seeds of a multi-image request, or None for a plain single-image one."""
+    if req.seeds:
+        # A repeated seed is the same image; it would only coalesce behind its twin
+        seeds = list(dict.fromkeys(seed % 2**32 for seed in req.seeds))
+    elif req.num_images > 1:
+        base = req.seed if req.seed is not None else random.randint(0, 2**32 - 1)
+        seeds = [(base + i) % 2**32 for i in range(req.num_images)]
+    elif req.num_images < 1:
+        raise HTTPException(status_code=422, detail="num_images must be at least 1")
+    else:
+        return None
+    if len(seeds) > MAX_IMAGES_PER_REQUEST:
+        raise HTTPException(status_code=422, detail=f"At most {MAX_IMAGES_PER_REQUEST} images per request")
+    return seeds
+
+def _generate_images(req, progress=None, edit=None):
+    """_generate for a single image, or every seed of a multi-image request sharing batches.
+    
+    Each seed runs as its own seeded request (so it is cached and coalesced on its own)
+    but they are queued together, run as batched pipeline calls and reuse the prompt
+    embedding. Returns (response, image_bytes), or (response, [image_bytes, ...]) with
+    the images and their seeds under data.images for several images.
+    """
+    seeds = request_seeds(req)
+    if seeds is None:
+        return _generate(req, progress, edit=edit)
+    
+    started = time.time()
+    group = batcher.group(len(seeds))
+    
+    def _one(index, seed):
+        member = group.member()
+        item_progress = None
+        if progress is not None:
+            item_progress = lambda event, render_preview: progress({**event, "image_index": index}, render_preview)
+        try:
+            return _generate(
+                req.model_copy(update={"seed": seed, "num_images": 1, "seeds": None}),
+                progress=item_progress,
+                submit=member.submit,
+                edit=edit,
+                leave=member.leave
+            )
+        finally:
+            member.leave()  # no-op once submitted; cache hits and failures must not hold the group
+    
+    logger.info(f"🖼️ {len(seeds)} images | seeds {seeds[0]}..{seeds[-1]}")
+    with ThreadPoolExecutor(max_workers=len(seeds), thread_name_prefix="multi-image") as pool:
+        results = [f.result() for f in [pool.submit(_one, i, seed) for i, seed in enumerate(seeds)]]
+    
+    first = results[0][0]
+    images = [
+        {
+            "image_url": response["data"]["image_url"],
+            "local_path": response["data"]["local_path"],
+            "seed": seed,
+            "cache": response["metadata"].get("cache")
+        }
+        for seed, (response, _) in zip(seeds, results)
+    ]
+    return {
+        "success": True,
+        "data": {**first["data"], "images": images},
+        "metadata": {
+            **first["metadata"],
+            "seed": seeds[0],
+            "seeds": seeds,
+            "num_images": len(seeds),
+            "batch_sizes": [response["metadata"].get("batch_size") for response, _ in results],
+            "generation_time": round(time.time() - started, 2)
+        }
+    }, [image_bytes for _, image_bytes in results]
+
+def _generate(req, progress=None, submit=None, edit=None, leave=None):
+    """Shared generation path returning (response, image_bytes).
+    
+    `progress(event, render_preview)` receives per-step events while the pipeline runs.
+    `submit` replaces batcher.submit (multi-image requests queue their images as a group);
+    `leave()` is called if the request attaches to an identical in-flight one instead.
+    `edit` (see _edit_source) turns the request into img2img / inpainting of a source image.
+    """
     try:
         logger.info(f"🎨 Generating: {req.prompt[:50]}... | Model: {req.model}")
         
+        if req.cache not in CACHE_MODES:
+            raise HTTPException(status_code=422, detail=f"cache must be one of: {', '.join(CACHE_MODES)}")
+        if req.response_format not in RESPONSE_FORMATS:
+            raise HTTPException(status_code=422, detail=f"response_format must be one of: {', '.join(RESPONSE_FORMATS)}")
+        if req.tiling not in TILING_MODES:
+            raise HTTPException(status_code=422, detail=f"tiling must be one of: {', '.join(TILING_MODES)}")
+        if req.hires and not 0.0 < req.hires_strength <= 1.0:
+            raise HTTPException(status_code=422, detail="hires_strength must be in (0, 1]")
+        try:
+            req.image_format = normalize_format(req.image_format)
+            validate_encoding(req.quality, req.compress_level)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        
         start_time = time.time()
         current_device = detect_device()
         
@@ -409,21 +1538,20 @@ def generate_image(req: ImageRequest):
             logger.warning(f"DirectML: Limiting steps from {req.steps} to 25 for performance")
             req.steps = 25
         
-        pipe = get_pipe(req.model)
-        
-        if req.scheduler != "auto":
-            pipe = get_scheduler(pipe, req.scheduler, current_device, req.model)
-        
-        gc.collect()
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        
         if current_device == "dml":
             max_size = 512
         elif current_device == "cuda":
             max_size = 768
         else:
             max_size = 640  # CPU can stretch a bit further than DirectML
+        max_size = calibrator.max_size(req.steps, max_size)
+        device_max_size = max_size
+        
+        # Past the cap, SD 1.x/2.x torch models generate in tiles of at most the cap instead of shrinking
+        tile_size = None
+        if (req.width > max_size or req.height > max_size) and req.tiling == "auto" and TILED_GENERATION and supports_latent_loop(req.model, model_config):
+            tile_size = min(TILE_SIZE, max_size) // 8 * 8
+            max_size = TILED_MAX_SIZE
         
         original_width = req.width
         original_height = req.height
@@ -443,133 +1571,209 @@ def generate_image(req: ImageRequest):
         req.width = max(req.width, 256)
         req.height = max(req.height, 256)
         
+        # Compiled graphs are shape-specialized; a few fixed sizes keep them reusable
+        # (tiled canvases only ever feed the UNet tile-sized windows)
+        if COMPILE_MODE != "off" and tile_size is None:
+            req.width, req.height = snap_to_bucket(req.width, req.height, COMPILE_BUCKETS, max_size)
+        
+        # Hires: the base steps run at a draft size (a compile bucket when compiling), then refine
+        hires = None
+        if req.hires:
+            if not supports_latent_loop(req.model, model_config):
+                logger.warning(f"⚠️ hires needs a torch SD 1.x/2.x model; generating {req.model} directly")
+            else:
+                base = min(HIRES_BASE_SIZE, device_max_size)
+                draft_width, draft_height = draft_size(req.width, req.height, base)
+                if COMPILE_MODE != "off":
+                    draft_width, draft_height = snap_to_bucket(draft_width, draft_height, COMPILE_BUCKETS, base)
+                if (draft_width, draft_height) != (req.width, req.height):
+                    hires = (draft_width, draft_height, req.hires_strength, refine_steps(req.steps, req.hires_steps))
+                else:
+                    logger.info(f"hires skipped: {req.width}x{req.height} is already at the draft size")
+        
         logger.info(f"📐 Size: {req.width}x{req.height} | Steps: {req.steps} | Device: {current_device}")
         
+        # Uncalibrated fallbacks; the measured profile replaces them when available
         if current_device == "dml":
             estimated_time = req.steps * 3  # Roughly 3s per step on DirectML
-            logger.warning(f"⏱️ DirectML: Estimated time ~{estimated_time}s")
         elif current_device == "cpu":
             estimated_time = req.steps * 2  # Around 2s per step on the Ryzen 9 7900X
-            logger.info(f"⏱️ CPU: Estimated time ~{estimated_time}s")
         else:
             estimated_time = req.steps * 0.5  # CUDA stacks can hit ~0.5s per step
-            logger.info(f"⏱️ GPU: Estimated time ~{estimated_time}s")
+        per_step_guess = estimated_time / max(req.steps, 1)
+        direct_estimate = calibrator.estimate(req.steps, req.width, req.height, estimated_time)
         
-        try:
-            guidance = req.guidance_scale
-            if "turbo" in req.model.lower():
-                guidance = 0.0
-            
-            result = pipe(
-                req.prompt,
-                num_inference_steps=req.steps,
-                guidance_scale=guidance,
-                height=req.height,
-                width=req.width
-            )
-            
-        except Exception as gen_error:
-            error_str = str(gen_error).lower()
-            
-            if "memory" in error_str or "not enough" in error_str or "allocate" in error_str:
-                logger.warning(f"⚠️ Memory error: {gen_error}")
-                
-                if req.width > 512 or req.height > 512:
-                    logger.info("Trying reduced size 512x512...")
-                    req.width = 512
-                    req.height = 512
-                    try:
-                        result = pipe(
-                            req.prompt,
-                            num_inference_steps=req.steps,
-                            guidance_scale=guidance,
-                            height=req.height,
-                            width=req.width
-                        )
-                        logger.info("✅ Generation completed with reduced size")
-                    except:
-                        logger.info("Falling back to CPU...")
-                        pipe_cpu = pipe.to("cpu")
-                        result = pipe_cpu(
-                            req.prompt,
-                            num_inference_steps=req.steps,
-                            guidance_scale=guidance,
-                            height=req.height,
-                            width=req.width
-                        )
-                        logger.info("✅ Generation completed on CPU")
-                else:
-                    logger.info("Falling back to CPU...")
-                    pipe_cpu = pipe.to("cpu")
-                    result = pipe_cpu(
-                        req.prompt,
-                        num_inference_steps=req.steps,
-                        guidance_scale=guidance,
-                        height=req.height,
-                        width=req.width
-                    )
-                    logger.info("✅ Generation completed on CPU")
-                    
-            elif "dml" in error_str or "privateuseone" in error_str:
-                logger.warning(f"⚠️ DirectML error: {gen_error}")
-                logger.info("Falling back to CPU...")
-                pipe_cpu = pipe.to("cpu")
-                result = pipe_cpu(
-                    req.prompt,
-                    num_inference_steps=req.steps,
-                    guidance_scale=guidance,
-                    height=req.height,
-                    width=req.width
-                )
-                logger.info("✅ Generation completed on CPU (DirectML fallback)")
-            else:
-                raise
+        def _estimate(steps, width, height):
+            if tile_size is not None:
+                windows = window_count(width, height, tile_size, TILE_OVERLAP)
+                return calibrator.estimate(steps, tile_size, tile_size, per_step_guess * steps) * windows
+            return calibrator.estimate(steps, width, height, per_step_guess * steps)
         
-        image = result.images[0]
-        generation_time = time.time() - start_time
+        if tile_size is not None:
+            logger.info(f"🧩 Tiled: {window_count(req.width, req.height, tile_size, TILE_OVERLAP)} windows of {tile_size}px")
+        if hires is not None:
+            estimated_time = calibrator.estimate(req.steps, hires[0], hires[1], per_step_guess * req.steps) + _estimate(hires[3], req.width, req.height)
+            logger.info(f"🔍 Hires: draft {hires[0]}x{hires[1]}, {hires[3]} refinement steps (direct ~{direct_estimate}s)")
+        elif edit is not None:
+            estimated_time = _estimate(effective_steps(req.steps, edit["strength"]), req.width, req.height)
+        else:
+            estimated_time = _estimate(req.steps, req.width, req.height)
+        estimated_time = round(estimated_time, 1)
+        logger.info(f"⏱️ {current_device.upper()}: Estimated time ~{estimated_time}s")
         
-        # Salvar imagem
-        timestamp = int(time.time())
-        model_short_name = req.model.split('/')[-1] if '/' in req.model else req.model
-        filename = f"{model_short_name}_{timestamp}_{uuid.uuid4().hex[:8]}.png"
-        filepath = OUT_DIR / filename
+        guidance = req.guidance_scale
+        if "turbo" in req.model.lower():
+            guidance = 0.0
         
-        image.save(filepath)
-        logger.info(f"✅ Image saved: {filename} | Time: {generation_time:.2f}s")
+        seed = req.seed if req.seed is not None else random.randint(0, 2**32 - 1)
         
-        # Convert to base64 for inline API responses
-        with open(filepath, "rb") as image_file:
-            image_base64 = base64.b64encode(image_file.read()).decode('utf-8')
+        params = {
+            "prompt": req.prompt,
+            "negative_prompt": req.negative_prompt or "",
+            "model": resolve_model_name(req.model),
+            "width": req.width,
+            "height": req.height,
+            "steps": req.steps,
+            "scheduler": req.scheduler,
+            "guidance_scale": guidance,
+            "seed": req.seed,
+            "image_format": req.image_format,
+            "quality": req.quality,
+            "compress_level": req.compress_level
+        }
+        if tile_size is not None:
+            params["tiling"] = f"{tile_size}/{TILE_OVERLAP}"
+        if hires is not None:
+            params["hires"] = f"{hires[0]}x{hires[1]}/{hires[2]}/{hires[3]}/{HIRES_UPSCALE}"
+        if edit is not None:
+            params["edit"] = f"{edit['image_digest']}/{edit['mask_digest']}/{edit['strength']}"
+        flight_key = generation_key(params)
         
-        # Free any leftover GPU memory allocations
-        gc.collect()
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
+        # Only seeded requests are reproducible, so only they can be served from cache
+        cache_key = None
+        cache_status = "bypass"
+        if req.cache != "bypass" and req.seed is not None:
+            cache_key = flight_key
+            cached = result_store.get(cache_key)
+            if cached is not None:
+                logger.info(f"⚡ Result cache hit: {cache_key[:12]}")
+                return _cached_response(req, cache_key, cached, time.time() - start_time)
+            cache_status = "miss"
         
-        return {
-            "success": True,
-            "data": {
-                "image_base64": image_base64,
-                "image_url": f"http://apibr.giesel.com.br/images/{filename}",
-                "local_path": str(filepath),
-                "prompt": req.prompt,
-                "model": req.model,
-                "size": f"{req.width}x{req.height}",
-                "timestamp": datetime.now().isoformat()
-            },
-            "metadata": {
+        if req.cache == "only":
+            raise HTTPException(status_code=404, detail="Result not cached (cache='only' requires a seeded request that was generated before)")
+        
+        variant = None
+        if hires is not None:
+            variant = ("hires", *hires)
+        elif edit is not None:
+            variant = ("edit", edit["strength"], edit["mask"] is not None)
+        
+        def _run():
+            batch_result = (submit or batcher.submit)(
+                (req.model, req.width, req.height, req.steps, req.scheduler, variant),
+                {
+                    "prompt": req.prompt,
+                    "negative_prompt": req.negative_prompt,
+                    "guidance_scale": guidance,
+                    "seed": seed,
+                    "progress_key": flight_key,
+                    "tile": tile_size,
+                    **({k: edit[k] for k in ("image", "image_digest", "mask", "mask_digest")} if edit else {})
+                }
+            )
+            
+            image = batch_result["image"]
+            requested_size = (req.width, req.height)
+            req.width = batch_result["width"]
+            req.height = batch_result["height"]
+            downscaled = (req.width, req.height) != requested_size
+            generation_time = time.time() - start_time
+            
+            # Salvar imagem
+            timestamp = int(time.time())
+            model_short_name = req.model.split('/')[-1] if '/' in req.model else req.model
+            filename = f"{model_short_name}_{timestamp}_{uuid.uuid4().hex[:8]}.{req.image_format}"
+            filepath = shard_path(OUT_DIR, filename)
+            
+            # Compression and the disk write run on the encoder pool, off the inference worker
+            image_bytes, encode_time = image_encoder.encode(
+                image, filepath, req.image_format, req.quality, req.compress_level
+            ).result()
+            logger.info(f"✅ Image encoded: {filename} | Time: {generation_time:.2f}s | Encode: {encode_time:.3f}s")
+            
+            # Free any leftover GPU memory allocations
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            
+            metadata = {
                 "model": req.model,
                 "generation_time": round(generation_time, 2),
+                "encode_time": round(encode_time, 3),
+                "image_format": req.image_format,
+                "image_bytes": len(image_bytes),
                 "steps": req.steps,
                 "guidance_scale": req.guidance_scale,
                 "scheduler": req.scheduler,
+                "seed": seed,
                 "device": current_device,
+                "batch_size": batch_result["batch_size"],
+                "queue_wait": round(batch_result["queue_wait"], 3),
+                "memory_plan": batch_result.get("memory_plan"),
+                "tiling": params.get("tiling", "off"),
+                "hires": {**batch_result["hires"], "direct_estimate": direct_estimate} if batch_result.get("hires") else None,
+                "edit": batch_result.get("edit"),
+                "cache": cache_status,
+                "downscaled_from": f"{requested_size[0]}x{requested_size[1]}" if downscaled else None,
                 "optimization_level": "ultra_v2",
                 "estimated_vs_actual": f"{estimated_time}s vs {generation_time:.1f}s",
                 "timestamp": datetime.now().isoformat()
             }
-        }
+            
+            # The key names the requested size; a downscaled or replica-planned run must not answer for it
+            if cache_key is not None and downscaled:
+                logger.info(f"Result not cached: generated {req.width}x{req.height} instead of {requested_size[0]}x{requested_size[1]}")
+            elif cache_key is not None:
+                try:
+                    result_store.put(cache_key, image_bytes, req.image_format, {
+                        **metadata,
+                        "prompt": req.prompt,
+                        "size": f"{req.width}x{req.height}"
+                    })
+                except OSError as e:
+                    logger.warning(f"Could not store result in cache: {e}")
+            
+            return {
+                "success": True,
+                "data": {
+                    "image_url": f"http://apibr.giesel.com.br/images/{filename}",
+                    "local_path": str(filepath),
+                    "prompt": req.prompt,
+                    "model": req.model,
+                    "size": f"{req.width}x{req.height}",
+                    "timestamp": datetime.now().isoformat()
+                },
+                "metadata": metadata
+            }, image_bytes
+        
+        # Identical requests already in flight share the leader's result instead of re-running
+        if progress is not None:
+            progress_hub.subscribe(flight_key, progress)
+        try:
+            # A follower never submits, so it must not keep its batch group waiting for it
+            (response, image_bytes), role, followers = inflight.run(flight_key, _run, on_follow=leave)
+        finally:
+            if progress is not None:
+                progress_hub.unsubscribe(flight_key, progress)
+        metadata = {**response["metadata"], "coalesced": role, "followers": followers}
+        if role == "follower":
+            metadata["leader_generation_time"] = metadata["generation_time"]
+            metadata["generation_time"] = round(time.time() - start_time, 2)
+        return {**response, "metadata": metadata}, image_bytes
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Error: {str(e)}")
         gc.collect()
@@ -577,6 +1781,438 @@ def generate_image(req: ImageRequest):
             torch.cuda.empty_cache()
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/edit")
+def edit_image(req: EditRequest):
+    """img2img / inpainting of a source image on the cached text-to-image pipeline."""
+    if req.response_format == "binary" and request_seeds(req) is not None:
+        raise HTTPException(status_code=422, detail="response_format 'binary' returns one image; use base64 or url with num_images/seeds")
+    edit = _edit_source(req)
+    response, image_bytes = _generate_images(req, edit=edit)
+    return render_image_response(response, image_bytes, req.response_format)
+
+def _load_input_image(data, url, field, mode="RGB"):
+    """(image, digest) from a base64 field or its *_url twin, or (None, None) when neither is set."""
+    if data is None and url is None:
+        return None, None
+    if data is None and not EDIT_URL_FETCH:
+        raise HTTPException(status_code=422, detail=f"{field}_url is disabled on this server (EDIT_URL_FETCH); send {field} as base64")
+    max_bytes = int(EDIT_MAX_INPUT_MB * 1024 ** 2)
+    try:
+        content = decode_image_data(data) if data is not None else fetch_image(url, max_bytes, allowed_hosts=EDIT_URL_HOSTS)
+        if len(content) > max_bytes:
+            raise ValueError(f"{field} is larger than {EDIT_MAX_INPUT_MB:g} MB")
+        return open_image(content, mode)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f"{field}: {e}")
+
+def _edit_source(req):
+    """Validate an EditRequest and load its source / mask into the `edit` spec _generate takes.
+    
+    Sizes the request to the source unless width/height/size were given; edits are never
+    tiled or hires (sizes above the cap shrink to it).
+    """
+    if not 0.0 < req.strength <= 1.0:
+        raise HTTPException(status_code=422, detail="strength must be in (0, 1]")
+    if req.hires:
+        raise HTTPException(status_code=422, detail="hires is not available for edits")
+    if not supports_latent_loop(req.model, get_model_config(req.model, detect_device())):
+        raise HTTPException(status_code=422, detail="Image editing needs a torch SD 1.x/2.x model")
+    
+    image, image_digest = _load_input_image(req.image, req.image_url, "image")
+    if image is None:
+        raise HTTPException(status_code=422, detail="Send the source as image (base64) or image_url")
+    mask, mask_digest = _load_input_image(req.mask, req.mask_url, "mask", mode="L")
+    
+    if not {"width", "height", "size"} & req.model_fields_set:
+        req.width, req.height = image.size
+    req.tiling = "off"
+    
+    steps = get_model_config(req.model, detect_device())['steps'] if req.steps == 10 else req.steps
+    if effective_steps(steps, req.strength) < 1:
+        raise HTTPException(status_code=422, detail=f"strength {req.strength} leaves no denoising steps out of {steps}")
+    
+    logger.info(f"🖌️ {'Inpainting' if mask is not None else 'img2img'} {image.width}x{image.height} source | strength {req.strength}")
+    return {
+        "image": image,
+        "image_digest": image_digest,
+        "mask": mask,
+        "mask_digest": mask_digest,
+        "strength": req.strength
+    }
+
+@app.post("/upscale")
+def upscale_image(req: UpscaleRequest):
+    """Tiled 2x/4x super-resolution; tiles of concurrent requests are batched together."""
+    response, image_bytes = _upscale(req)
+    return render_image_response(response, image_bytes, req.response_format)
+
+def _upscale(req):
+    """Shared upscale path returning (response, image_bytes)."""
+    model = (req.model or UPSCALER_MODEL).lower()
+    if model not in UPSCALER_MODELS:
+        raise HTTPException(status_code=422, detail=f"model must be one of: {', '.join(UPSCALER_MODELS)}")
+    if req.scale not in UPSCALE_FACTORS:
+        raise HTTPException(status_code=422, detail=f"scale must be one of: {', '.join(map(str, UPSCALE_FACTORS))}")
+    if req.cache not in CACHE_MODES:
+        raise HTTPException(status_code=422, detail=f"cache must be one of: {', '.join(CACHE_MODES)}")
+    if req.response_format not in RESPONSE_FORMATS:
+        raise HTTPException(status_code=422, detail=f"response_format must be one of: {', '.join(RESPONSE_FORMATS)}")
+    try:
+        req.image_format = normalize_format(req.image_format)
+        validate_encoding(req.quality, req.compress_level)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    
+    start_time = time.time()
+    image, digest = _load_input_image(req.image, req.image_url, "image")
+    if image is None:
+        raise HTTPException(status_code=422, detail="Send the source as image (base64) or image_url")
+    if max(image.size) > UPSCALE_MAX_INPUT:
+        raise HTTPException(status_code=422, detail=f"Source is {image.width}x{image.height}; at most {UPSCALE_MAX_INPUT}px per side")
+    
+    upscaler = get_upscaler(model)
+    tile = max(req.tile or UPSCALE_TILE or upscaler.default_tile, 2 * UPSCALE_TILE_OVERLAP + 8)
+    stochastic = model == "sd-x4"
+    seed = (req.seed if req.seed is not None else random.randint(0, 2**32 - 1)) if stochastic else None
+    
+    params = {
+        "operation": "upscale",
+        "image": digest,
+        "model": model,
+        "scale": req.scale,
+        "tile": f"{tile}/{UPSCALE_TILE_OVERLAP}",
+        "prompt": req.prompt if stochastic else "",
+        "seed": req.seed if stochastic else None,
+        "image_format": req.image_format,
+        "quality": req.quality,
+        "compress_level": req.compress_level
+    }
+    if stochastic:
+        params["steps"] = UPSCALE_SD_STEPS
+    elif model == "esrgan":
+        params["weights"] = Path(UPSCALER_WEIGHTS).name
+    
+    # Deterministic upscalers are always reproducible; sd-x4 only with a fixed seed
+    cache_key = None
+    cache_status = "bypass"
+    if req.cache != "bypass" and (not stochastic or req.seed is not None):
+        cache_key = generation_key(params)
+        cached = result_store.get(cache_key)
+        if cached is not None:
+            logger.info(f"⚡ Result cache hit: {cache_key[:12]}")
+            image_bytes, stored = cached
+            return {
+                "success": True,
+                "data": {
+                    "image_url": f"http://apibr.giesel.com.br/results/{cache_key}",
+                    "local_path": str(result_store.path_for(cache_key)),
+                    "size": stored.get("size"),
+                    "source_size": stored.get("source_size"),
+                    "timestamp": datetime.now().isoformat()
+                },
+                "metadata": {
+                    **{k: v for k, v in stored.items() if k not in ("size", "source_size")},
+                    "generation_time": round(time.time() - start_time, 3),
+                    "original_generation_time": stored.get("generation_time"),
+                    "cache": "hit",
+                    "cache_key": cache_key,
+                    "timestamp": datetime.now().isoformat()
+                }
+            }, image_bytes
+        cache_status = "miss"
+    if req.cache == "only":
+        raise HTTPException(status_code=404, detail="Result not cached (cache='only' requires an upscale that was run before)")
+    
+    job = uuid.uuid4().hex
+    tiles = 0
+    
+    def _submit(tile_array):
+        nonlocal tiles
+        item = BatchItem(
+            (model, req.scale, *tile_array.shape[:2]),
+            {"tile": tile_array, "job": job, "prompt": req.prompt, "seed": (seed + tiles) % 2**32 if stochastic else 0}
+        )
+        tiles += 1
+        upscale_batcher.enqueue([item])
+        return item.future
+    
+    logger.info(f"🔎 Upscaling {image.width}x{image.height} x{req.scale} | {model} | {tile}px tiles")
+    try:
+        output = upscale_tiled(image, req.scale, tile, UPSCALE_TILE_OVERLAP, _submit, max_inflight=2 * UPSCALE_TILE_BATCH)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Upscale error: {e}")
+        raise HTTPException(status_code=507 if is_memory_error(e) else 500, detail=str(e))
+    generation_time = time.time() - start_time
+    
+    filename = f"upscaled_{model}_x{req.scale}_{int(time.time())}_{uuid.uuid4().hex[:8]}.{req.image_format}"
+    filepath = shard_path(OUT_DIR, filename)
+    image_bytes, encode_time = image_encoder.encode(
+        output, filepath, req.image_format, req.quality, req.compress_level
+    ).result()
+    logger.info(f"✅ Upscaled to {output.width}x{output.height}: {filename} | {tiles} tiles | Time: {generation_time:.2f}s")
+    
+    metadata = {
+        "model": model,
+        "scale": req.scale,
+        "tiles": tiles,
+        "tile": tile,
+        "tile_overlap": UPSCALE_TILE_OVERLAP,
+        "seed": seed,
+        "generation_time": round(generation_time, 2),
+        "encode_time": round(encode_time, 3),
+        "image_format": req.image_format,
+        "image_bytes": len(image_bytes),
+        "cache": cache_status,
+        "timestamp": datetime.now().isoformat()
+    }
+    size = f"{output.width}x{output.height}"
+    source_size = f"{image.width}x{image.height}"
+    if cache_key is not None:
+        try:
+            result_store.put(cache_key, image_bytes, req.image_format, {**metadata, "size": size, "source_size": source_size})
+        except OSError as e:
+            logger.warning(f"Could not store result in cache: {e}")
+    
+    return {
+        "success": True,
+        "data": {
+            "image_url": f"http://apibr.giesel.com.br/images/{filename}",
+            "local_path": str(filepath),
+            "size": size,
+            "source_size": source_size,
+            "timestamp": datetime.now().isoformat()
+        },
+        "metadata": metadata
+    }, image_bytes
+
+@app.post("/generate/stream")
+def generate_image_stream(req: StreamRequest):
+    """Server-Sent Events: `progress` per step (with optional previews), then `result` or `error`."""
+    events = queue.Queue()
+    
+    def on_progress(event, render_preview):
+        if req.preview_every > 0 and event["step"] % req.preview_every == 0:
+            event = {**event, "preview_jpeg_base64": render_preview()}
+        events.put(("progress", event))
+    
+    def worker():
+        try:
+            response, image_bytes = _generate_images(req, progress=on_progress)
+            events.put(("result", with_image_payload(response, image_bytes, _json_format(req))))
+        except HTTPException as e:
+            events.put(("error", {"status_code": e.status_code, "detail": e.detail}))
+        except Exception as e:
+            events.put(("error", {"status_code": 500, "detail": str(e)}))
+    
+    threading.Thread(target=worker, name="stream-generation", daemon=True).start()
+    
+    def event_stream():
+        yield f"event: queued\ndata: {json.dumps({'queue_depth': batcher.queue_depth()})}\n\n"
+        while True:
+            try:
+                kind, data = events.get(timeout=15)
+            except queue.Empty:
+                # Comment lines keep reverse proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+                continue
+            yield f"event: {kind}\ndata: {json.dumps(data)}\n\n"
+            if kind in ("result", "error"):
+                break
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def _json_format(req):
+    """Raw bytes can't travel inside JSON (jobs, SSE), so `binary` degrades to `url` there."""
+    return "url" if req.response_format == "binary" else req.response_format
+
+def job_payload(req):
+    """Journal form of a JobRequest.
+    
+    ImageRequest.__init__ re-parses `size` over width/height on replay, so it is rewritten
+    from the effective width/height rather than journaled as the "512x512" default.
+    """
+    return {**req.model_dump(exclude={"priority"}), "size": f"{req.width}x{req.height}"}
+
+def run_generation_job(payload):
+    """Job worker callback: replay a journaled request through the regular pipeline path.
+    
+    The result is journaled without image bytes; job_view attaches base64 when it was asked for.
+    """
+    req = ImageRequest(**payload)
+    response, _ = _generate_images(req)
+    return {**response, "metadata": {**response["metadata"], "response_format": _json_format(req)}}
+
+def job_view(job):
+    """A job as the API returns it, with base64 images re-read from disk for base64 requests."""
+    result = (job or {}).get("result")
+    if result is None or result["metadata"].get("response_format") != "base64":
+        return job
+    data = result["data"]
+    paths = [entry["local_path"] for entry in data["images"]] if "images" in data else data["local_path"]
+    try:
+        image_bytes = [Path(p).read_bytes() for p in paths] if isinstance(paths, list) else Path(paths).read_bytes()
+    except OSError as e:
+        logger.warning(f"Job {job['job_id']} images are gone ({e}); returning URLs only")
+        return job
+    return {**job, "result": with_image_payload(result, image_bytes, "base64")}
+
+jobs = JobQueue(JOBS_DB, run_generation_job, workers=JOB_WORKERS, retention_hours=JOB_RETENTION_HOURS)
+
+def warm_up_model(model_name):
+    """Tiny throwaway generation so first-run kernel setup doesn't land on a user request.
+    
+    Goes through the batcher so it never runs concurrently with real traffic on the same pipeline.
+    """
+    model_config = get_model_config(resolve_model_name(model_name), detect_device())
+    width = height = WARMUP_SIZE
+    if COMPILE_MODE != "off":
+        # Warm up on a real bucket so the compile happens here, not on the first request
+        width, height = snap_to_bucket(width, height, COMPILE_BUCKETS)
+    batcher.submit(
+        (model_name, width, height, WARMUP_STEPS, "auto", None),
+        {
+            "prompt": "warm-up",
+            "negative_prompt": None,
+            "guidance_scale": model_config["guidance_scale"],
+            "seed": 0,
+            "progress_key": None
+        }
+    )
+
+if worker_pool is not None:
+    # Every worker holds its own pipelines, so preloading and warm-up run on all of them.
+    # With shared weights, workers load one after another so only one transient private
+    # copy exists at a time and the later ones just map the first one's files
+    preloader = ModelPreloader(
+        lambda model: worker_pool.broadcast(("load", model), parallel=not SHARED_WEIGHTS),
+        lambda model: worker_pool.broadcast(("warmup", model))
+    )
+else:
+    preloader = ModelPreloader(get_pipe, warm_up_model)
+
+@app.on_event("startup")
+def start_worker_pool():
+    if worker_pool is not None:
+        worker_pool.start()
+
+@app.on_event("shutdown")
+def stop_worker_pool():
+    if worker_pool is not None:
+        worker_pool.stop()
+
+@app.on_event("startup")
+def start_job_workers():
+    jobs.start()
+
+@app.on_event("startup")
+def start_preloading():
+    preloader.start([resolve_model_name(m) for m in PRELOAD_MODELS])
+
+@app.get("/ready")
+def readiness_check():
+    """Readiness probe: 200 once every PRELOAD_MODELS entry is loaded and warmed up, else 503."""
+    status = preloader.status()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+def use_calibration_profile(profile):
+    """Adopt a profile and apply its attention / VAE slicing to the torch pipelines already loaded."""
+    calibrator.adopt(profile)
+    for key in pipes.keys():
+        pipe = pipes.get(key)
+        if pipe is not None and hasattr(pipe, "unet") and not is_onnx_pipeline(pipe):
+            apply_pipeline_settings(pipe, profile)
+
+def _calibrate_on_worker(force):
+    """Pool mode: calibrate on one worker, at the thread count requests actually run with.
+    
+    The dispatcher only estimates, so it adopts that worker's profile instead of measuring
+    on every core while competing with the workers, and the other workers get it too.
+    """
+    calibrator.state = "running"
+    try:
+        profile = worker_pool.submit(("calibrate", force))
+        if profile is None:
+            raise RuntimeError("calibration failed on the worker; see its log")
+        calibrator.adopt(profile)
+        worker_pool.broadcast(("calibration", profile))
+    except Exception as e:
+        calibrator.error = str(e)
+        calibrator.state = "ready" if calibrator.profile else "failed"
+        logger.error(f"❌ Calibration failed: {e}")
+
+def _calibrate_in_batcher():
+    """In-process: calibrate as a batch of its own, queued like warm_up_model, so it never overlaps traffic."""
+    try:
+        batcher.submit(CALIBRATION_BATCH_KEY, None)
+    except Exception as e:
+        calibrator.error = str(e)
+        calibrator.state = "ready" if calibrator.profile else "failed"
+        logger.error(f"❌ Calibration failed: {e}")
+
+def start_calibration_run(force):
+    """Calibrate in the background: through the batcher in-process, or on one pool worker in worker-pool mode."""
+    if calibrator.state == "running":
+        return False
+    target, args = (_calibrate_on_worker, (force,)) if worker_pool is not None else (_calibrate_in_batcher, ())
+    calibrator.state = "running"
+    threading.Thread(target=target, args=args, daemon=True, name="calibration").start()
+    return True
+
+@app.on_event("startup")
+def start_calibration():
+    if CALIBRATION == "off":
+        return
+    if worker_pool is None and CALIBRATION == "auto":
+        device = detect_device()
+        if calibrator.load(device, pipeline_dtype(device)):
+            return
+    start_calibration_run(force=CALIBRATION == "force")
+
+@app.get("/calibration")
+def get_calibration():
+    """Current host profile and calibration state."""
+    return calibrator.status()
+
+@app.post("/calibration")
+def run_calibration():
+    """Re-run calibration in the background (e.g. after a driver or hardware change)."""
+    started = start_calibration_run(force=True)
+    return {"started": started, **calibrator.status()}
+
+@app.post("/jobs")
+def create_job(req: JobRequest):
+    """Queue a generation and return immediately with a job id."""
+    payload = job_payload(req)
+    job_id = jobs.submit(payload, priority=req.priority)
+    logger.info(f"📥 Job {job_id} queued | Priority: {req.priority} | Model: {req.model}")
+    return job_view(jobs.get(job_id))
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """Current status of a job, including its result once completed."""
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_view(job)
+
+@app.get("/jobs/{job_id}/wait")
+async def wait_job(job_id: str, timeout: float = 30.0):
+    """Long-poll until the job finishes or `timeout` seconds pass (capped at 120s)."""
+    deadline = time.time() + min(max(timeout, 0.0), 120.0)
+    while True:
+        job = jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        if job["status"] in ("completed", "failed") or time.time() >= deadline:
+            return job_view(job)
+        await asyncio.sleep(0.5)
+
 @app.get("/models")
 def list_models():
     """List available pipelines plus recommended schedulers/steps."""
@@ -676,19 +2312,163 @@ def list_models():
         }
     }
 
+@app.get("/models/loaded")
+def list_loaded_models():
+    """Residency of cached pipelines (device/host tier) plus cache budgets and counters."""
+    return {
+        "models": pipes.residency(),
+        "load_metrics": preloader.status()["models"],
+        **pipes.stats(),
+        "component_pool": component_pool.summary()
+    }
+
+class ModelStoreRequest(BaseModel):
+    model: str
+    revision: Optional[str] = None
+
+@app.get("/memory/estimate")
+def estimate_memory(model: str = "runwayml/stable-diffusion-v1-5", width: int = 512, height: int = 512,
+                    batch_size: int = 1, guidance_scale: float = 7.5):
+    """Pre-flight memory plan for a generation, without running it (loads the model if needed)."""
+    if worker_pool is not None:
+        return worker_pool.submit(("estimate", model, width, height, batch_size, guidance_scale))
+    return _estimate_memory(model, width, height, batch_size, guidance_scale)
+
+def _estimate_memory(model, width, height, batch_size, guidance_scale):
+    device = detect_device()
+    plan = plan_memory(get_pipe(model), batch_size, width, height, guidance_scale, device)
+    return {"model": resolve_model_name(model), "device": device, "requested": f"{width}x{height}", **plan}
+
+@app.get("/models/store")
+def get_model_store():
+    """Models in the local store, running prefetches and per-component load timings."""
+    return {"mode": MODEL_STORE, **model_store.status()}
+
+@app.post("/models/store/prefetch")
+def prefetch_model(req: ModelStoreRequest):
+    """Download a model snapshot into the local store in the background (poll GET /models/store)."""
+    full_model_name = resolve_model_name(req.model)
+    started = model_store.prefetch_async(full_model_name, req.revision)
+    return {"model": full_model_name, "started": started, **model_store.status()["prefetch"][full_model_name]}
+
+@app.post("/models/store/verify")
+def verify_model(req: ModelStoreRequest):
+    """Re-hash a stored model's files against its manifest."""
+    result = model_store.verify(resolve_model_name(req.model))
+    if result.get("error"):
+        raise HTTPException(status_code=404, detail=result["error"])
+    return result
+
 @app.get("/images/{filename}")
 def serve_image(filename: str):
     """Serve generated images directly from disk."""
     try:
-        filepath = OUT_DIR / filename
-        if filepath.exists():
-            return FileResponse(filepath, media_type='image/png')
+        image_type = media_type(Path(filename).suffix.lstrip(".") or "png")
+        pending = image_encoder.pending(shard_path(OUT_DIR, filename))
+        if pending is not None:
+            return Response(content=pending, media_type=image_type)
+        filepath = resolve_output(OUT_DIR, filename)
+        if filepath is not None:
+            return FileResponse(filepath, media_type=image_type)
         else:
             raise HTTPException(status_code=404, detail="Image not found")
+    except HTTPException:
+        raise
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Image not found")
     except Exception as e:
         logger.error(f"Error serving image: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/results/{cache_key}")
+def serve_cached_result(cache_key: str):
+    """Serve an image straight from the result cache."""
+    filepath = result_store.path_for(cache_key)
+    if filepath is None or not filepath.exists():
+        raise HTTPException(status_code=404, detail="Result not found")
+    return FileResponse(filepath, media_type=media_type(filepath.suffix.lstrip(".")))
+
+class QuantizationBenchmarkRequest(BaseModel):
+    model: str = "runwayml/stable-diffusion-v1-5"
+    prompt: str = "a lighthouse on a cliff at sunset, detailed, photograph"
+    steps: int = 10
+    width: int = 512
+    height: int = 512
+    seed: int = 42
+    modes: list[str] = ["int8-dynamic", "int8-weight-only"]
+
+@app.post("/benchmark/quantization")
+def benchmark_quantization(req: QuantizationBenchmarkRequest):
+    """Compare speed, weight memory and image similarity of int8 modes against fp32 on CPU.
+    
+    Works on a private fp32 copy of the model, so cached pipelines are left untouched.
+    """
+    import copy
+    from diffusers import StableDiffusionPipeline
+    
+    invalid = [m for m in req.modes if m not in QUANTIZATION_MODES]
+    if invalid:
+        raise HTTPException(status_code=422, detail=f"modes must be in: {', '.join(QUANTIZATION_MODES)}")
+    
+    full_model_name = resolve_model_name(req.model)
+    base = load_pretrained(
+        StableDiffusionPipeline,
+        full_model_name,
+        torch_dtype=torch.float32,
+        safety_checker=None,
+        requires_safety_checker=False,
+        **({} if "sdxl" in full_model_name.lower() else lpw_pipeline_kwargs())
+    ).to("cpu")
+    base = get_scheduler(base, get_model_config(full_model_name, "cpu")['scheduler'], "cpu", full_model_name)
+    
+    results = {}
+    reference = None
+    for mode in ["none"] + [m for m in req.modes if m != "none"]:
+        components = dict(base.components)
+        quantize_time = 0.0
+        if mode != "none":
+            started = time.time()
+            for name in ("text_encoder", "unet"):
+                components[name] = quantize_module(copy.deepcopy(base.components[name]), mode)
+            quantize_time = time.time() - started
+        pipe = type(base)(**components)
+        
+        started = time.time()
+        image = pipe(
+            req.prompt,
+            num_inference_steps=req.steps,
+            width=req.width,
+            height=req.height,
+            generator=torch.Generator("cpu").manual_seed(req.seed)
+        ).images[0]
+        generation_time = time.time() - started
+        
+        weight_bytes = sum(module_nbytes(components[name]) for name in ("text_encoder", "unet"))
+        results[mode] = {
+            "generation_time": round(generation_time, 2),
+            "seconds_per_step": round(generation_time / req.steps, 3),
+            "quantize_time": round(quantize_time, 2),
+            "text_encoder_unet_mb": round(weight_bytes / 1024 ** 2, 1)
+        }
+        if reference is None:
+            reference = image
+        else:
+            results[mode]["similarity_vs_fp32"] = image_similarity(reference, image)
+            results[mode]["speedup_vs_fp32"] = round(results["none"]["generation_time"] / generation_time, 2)
+            results[mode]["memory_ratio_vs_fp32"] = round(weight_bytes / (results["none"]["text_encoder_unet_mb"] * 1024 ** 2), 3)
+        logger.info(f"📊 Quantization benchmark {mode}: {results[mode]}")
+        del pipe
+        gc.collect()
+    
+    return {
+        "model": full_model_name,
+        "prompt": req.prompt,
+        "steps": req.steps,
+        "size": f"{req.width}x{req.height}",
+        "seed": req.seed,
+        "results": results
+    }
+
 @app.get("/benchmark")
 def benchmark_info():
     """Expose the reference hardware profile used for tuning."""
@@ -724,6 +2504,20 @@ def benchmark_info():
         "current_device": device
     }
     
+    if calibrator.profile:
+        steps = calibrator.default_steps(15)
+        benchmarks["measured_performance"] = {
+            "default_steps": steps,
+            "attention": calibrator.profile["attention"],
+            "vae_slicing": calibrator.profile["vae_slicing"],
+            "seconds_per_step": calibrator.profile["seconds_per_step"],
+            "estimated_seconds": {
+                f"{size}x{size}_{steps}steps": calibrator.estimate(steps, int(size), int(size), None)
+                for size in calibrator.profile["seconds_per_step"]
+            },
+            "calibrated_at": calibrator.profile["created"]
+        }
+    
     return benchmarks
 
 if __name__ == "__main__":
@@ -5,7 +5,7 @@ Servidor que funciona com CPU e otimiza para melhor performance
 """
 
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from pathlib import Path
@@ -13,10 +13,13 @@ import torch
 import uuid
 import time
 import os
-import base64
 import logging
 from datetime import datetime
 
+from image_responses import (
+    RESPONSE_FORMATS, encode_image, image_encoder, metadata_headers, with_image_payload
+)
+
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -47,6 +50,7 @@ class ImageRequest(BaseModel):
     width: int = 512  # Reduzido para CPU
     height: int = 512
     size: str = "512x512"
+    response_format: str = "base64"  # base64, url, binary
 
 def detect_device():
     """Detectar o melhor device disponível"""
@@ -151,6 +155,8 @@ def health_check():
 @app.post("/generate")
 def generate_image(req: ImageRequest):
     """Endpoint para geração real de imagem"""
+    if req.response_format not in RESPONSE_FORMATS:
+        raise HTTPException(status_code=422, detail=f"response_format must be one of: {', '.join(RESPONSE_FORMATS)}")
     try:
         logger.info(f"Generating image with model: {req.model}, prompt: {req.prompt}")
         
@@ -178,17 +184,14 @@ def generate_image(req: ImageRequest):
         filename = f"{model_short_name}_{timestamp}_{uuid.uuid4().hex[:8]}.png"
         filepath = OUT_DIR / filename
         
-        image.save(filepath)
-        logger.info(f"Image saved: {filepath}")
-        
-        # Converter para base64
-        with open(filepath, "rb") as image_file:
-            image_base64 = base64.b64encode(image_file.read()).decode('utf-8')
+        # Codificar uma vez em memória; a gravação em disco roda em background
+        image_bytes = encode_image(image)
+        image_encoder.write(filepath, image_bytes)
+        logger.info(f"Image encoded: {filepath}")
         
-        return {
+        response = {
             "success": True,
             "data": {
-                "image_base64": image_base64,
                 "image_url": f"http://apibr.giesel.com.br/images/{filename}",
                 "local_path": str(filepath),
                 "prompt": req.prompt,
@@ -206,6 +209,14 @@ def generate_image(req: ImageRequest):
             }
         }
         
+        if req.response_format == "binary":
+            return Response(
+                content=image_bytes,
+                media_type="image/png",
+                headers=metadata_headers(response["metadata"], response["data"]["image_url"])
+            )
+        return with_image_payload(response, image_bytes, req.response_format)
+        
     except Exception as e:
         logger.error(f"Error generating image: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -254,6 +265,9 @@ def serve_image(filename: str):
     """Servir imagens geradas"""
     try:
         filepath = OUT_DIR / filename
+        pending = image_encoder.pending(filepath)
+        if pending is not None:
+            return Response(content=pending, media_type='image/png')
         if filepath.exists():
             return FileResponse(filepath, media_type='image/png')
         else: